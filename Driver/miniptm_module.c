@@ -415,6 +415,8 @@ static int __init miniptm_module_init(void)
 	dev_list->i2c_adapter.name[sizeof(dev_list->i2c_adapter.name) - 1] = '\0';
 
 	dev_list->i2c_adapter.algo_data = &dev_list->i2c_bit_data;
+	// Адаптер - дочернее устройство PCI функции, в sysfs виден под ней
+	dev_list->i2c_adapter.dev.parent = &pdev->dev;
 	dev_list->i2c_adapter.nr = -1;  // Автоматическое назначение номера шины
 	
 
@@ -17,9 +17,41 @@ from renesas_cm_gpio import gpiomode
 from enum import Enum
 # Одна плата MiniPTM характеризуется своей информацией PCIe и адаптером i2c
 
+# Кросс-таймстемпинг I225 SYSTIM и TOD DPLL
+from crosstimestamp_miniptm import PHCTODCrossTimestamper
+from phase_sampler_miniptm import PhaseSampler
+from frame_sync_miniptm import FrameSyncCoordinator
+from tod_capture_miniptm import TODSecondaryGroup
+
 # Импорт модуля для работы с DPLL через оптоволокно
 from dpll_over_fiber_miniptm import DPOF_Top
 
+# Команды EEPROM (младший байт, старший байт всегда 0xEE)
+EEPROM_CMD_READ = 0x1
+EEPROM_CMD_WRITE = 0x2
+EEPROM_CMD_HIGH = 0xEE
+# Буфер EEPROM_DATA занимает 0xCF80-0xCFFF, но 0xCFFC-0xCFFF при
+# однобайтовой адресации I2C - это регистр страницы, поэтому передачи
+# ограничены 64 байтами (половина страницы EEPROM)
+EEPROM_TRANSFER_MAX = 64
+EEPROM_POLL_INTERVAL = 0.001
+EEPROM_SIZE = 0x20000  # 1 Мбит, два блока по 64 КБ (0x54 и 0x55)
+
+# GPIO светодиодов 0, 1, 2 на плате
+BOARD_LED_GPIOS = [13, 5, 6]
+
+
+def encode_dpll_loop_params(loopbw=1000, loopbw_units=1, decimator_bw_mult=4, psl=0):
+    """
+    Байты DPLL_CTRL с DPLL_DECIMATOR_BW_MULT (0x3) по DPLL_PSL_15_8 (0x7)
+    loopbw_units - как DPLL_BW_1.BW_UNIT
+    """
+    return [decimator_bw_mult & 0xff,
+            loopbw & 0xff,
+            ((loopbw >> 8) & 0x3f) + ((loopbw_units & 0x3) << 6),
+            psl & 0xff,
+            (psl >> 8) & 0xff]
+
 # Класс ПИ-регулятора (пропорционально-интегральный регулятор)
 class PIController:
     def __init__(self, kp, ki):
@@ -45,22 +77,28 @@ class PIController:
 
 # Класс для работы с одной платой MiniPTM
 class Single_MiniPTM:
-    def __init__(self, board_num, devinfo, adap_num):
+    def __init__(self, board_num, devinfo, adap_num, i2c_factory=miniptm_i2c):
         """
         Инициализация платы MiniPTM
         board_num - номер платы
-        devinfo - информация об устройстве PCIe
+        devinfo - информация об устройстве PCIe, None для платы без PCIe
         adap_num - номер адаптера I2C
+        i2c_factory - создание объекта I2C по номеру адаптера (подмена шины
+                      в симуляторе)
         """
         self.board_num = board_num
         self.devinfo = devinfo
-        self.bar = devinfo[1]  # Base Address Register PCIe
-        self.bar_size = devinfo[2]  # Размер BAR
+        self.bar = None
+        self.bar_size = None
+        self.PCIe = None
         self.adap_num = adap_num
 
         # Создание объектов для работы с PCIe и I2C
-        self.PCIe = MiniPTM_PCIe(self.bar, self.bar_size)
-        self.i2c = miniptm_i2c(adap_num)
+        if devinfo is not None:
+            self.bar = devinfo[1]  # Base Address Register PCIe
+            self.bar_size = devinfo[2]  # Размер BAR
+            self.PCIe = MiniPTM_PCIe(self.bar, self.bar_size, devinfo[0])
+        self.i2c = i2c_factory(adap_num)
         self.best_clock_quality_seen = 255 - board_num  # Хак для отслеживания качества часов
         #print(f"Register MiniPTM device {devinfo[0]} I2C bus {adap_num}")
 
@@ -70,6 +108,13 @@ class Single_MiniPTM:
                          self.i2c.write_dpll_reg_direct,
                          self.i2c.write_dpll_multiple)
 
+        # Два буфера снимков I225 для read_nic_snapshot, создаются по запросу
+        self.nic_snapshots = None
+        # Кросс-таймстемперы I225/TOD, создаются по запросу
+        self.cross_timestampers = {}
+        # Четыре TODReadSecondary на общем триггере
+        self.tod_secondary = TODSecondaryGroup(self)
+
         # Инициализация DPOF (DPLL Over Fiber - DPLL через оптоволокно)
         self.dpof = DPOF_Top(self)
 
@@ -78,6 +123,37 @@ class Single_MiniPTM:
         for i in range(4):
             self.tod_pi.append( PIController(0.6, 0.2) )
 
+    def read_nic_snapshot(self):
+        """
+        Снимок регистров I225 (время, SDP, линк) в один проход
+        Буфер снимка выделяется один раз и переиспользуется
+        Возвращает (снимок, изменения с прошлого вызова)
+        """
+        self.require_pcie()
+        if self.nic_snapshots is None:
+            self.nic_snapshots = [self.PCIe.snapshot(), self.PCIe.snapshot()]
+            return self.nic_snapshots[1], {}
+        previous, current = self.nic_snapshots[1], self.nic_snapshots[0]
+        self.PCIe.snapshot(into=current)
+        self.nic_snapshots = [previous, current]
+        return current, current.diff(previous)
+
+    def require_pcie(self):
+        """ Для функций I225: плата без PCIe (devinfo=None) их не поддерживает """
+        if self.PCIe is None:
+            raise ValueError(f"Board {self.board_num} has no PCIe device")
+
+    def cross_timestamp(self, tod_num=0, count=16):
+        """
+        Оценка смещения TOD tod_num относительно PTP часов I225
+        count - число отсчётов, возвращается отсчёт с наименьшей неопределённостью
+        Возвращает CrossTimestamp
+        """
+        self.require_pcie()
+        if tod_num not in self.cross_timestampers:
+            self.cross_timestampers[tod_num] = PHCTODCrossTimestamper(self, tod_num)
+        return self.cross_timestampers[tod_num].best(count)
+
     def led_visual_test(self):
         """
         Визуальный тест светодиодов - мигание всеми светодиодами
@@ -86,15 +162,13 @@ class Single_MiniPTM:
             # Простое мигание несколько раз
             print(f"*********LEDS OFF**********")
             # Выключаем все светодиоды
-            for led in range(4):
-                self.set_board_led(led, 0)
+            self.set_board_leds(0x0)
 
             time.sleep(0.25)
 
             print(f"*********LEDS ON***********")
             # Включаем все светодиоды
-            for led in range(4):
-                self.set_board_led(led, 1)
+            self.set_board_leds(0x7)
             time.sleep(0.25)
 
     def set_led_id_code(self):
@@ -102,11 +176,23 @@ class Single_MiniPTM:
         Установка светодиодов в соответствии с ID платы
         Используется двоичное представление номера платы
         """
-        # Устанавливаем светодиоды на основе ID платы
-        self.set_board_led(0, self.board_num & 0x1)        # Младший бит
-        self.set_board_led(1, (self.board_num >> 1) & 0x1) # Второй бит
-        self.set_board_led(2, (self.board_num >> 2) & 0x1) # Третий бит
-        self.set_board_led(3, (self.board_num >> 3) & 0x1) # Старший бит
+        # Младшие биты номера платы на светодиоды 0-2 одной записью
+        self.set_board_leds(self.board_num & 0x7)
+
+    def set_board_leds(self, values, leds=0x7):
+        """
+        Установка нескольких светодиодов одной записью защёлки GPIO
+        values - битовая маска состояний, бит N - светодиод N
+        leds - маска изменяемых светодиодов
+        """
+        outputs = 0
+        levels = 0
+        for led_num, gpio_num in enumerate(BOARD_LED_GPIOS):
+            if leds & (1 << led_num):
+                outputs |= 1 << gpio_num
+                if values & (1 << led_num):
+                    levels |= 1 << gpio_num
+        self.dpll.gpio.configure_pins(outputs=outputs, levels=levels)
 
     def set_board_led(self, led_num, val):
         """
@@ -117,15 +203,8 @@ class Single_MiniPTM:
         if (led_num < 0 or led_num > 2):
             print(f"Invalid LED number {led_num}")
             return
-        if ( led_num == 0 ):
-            # GPIO13 управляет первым светодиодом
-            self.dpll.gpio.configure_pin(13, gpiomode.OUTPUT,val)
-        if ( led_num == 1 ):
-            # GPIO5 управляет вторым светодиодом
-            self.dpll.gpio.configure_pin(5, gpiomode.OUTPUT,val)
-        if ( led_num == 2 ):
-            # GPIO6 управляет третьим светодиодом
-            self.dpll.gpio.configure_pin(6, gpiomode.OUTPUT,val)
+        # GPIO13, GPIO5, GPIO6 управляют светодиодами 0, 1, 2
+        self.set_board_leds((1 << led_num) if val else 0, 1 << led_num)
 
 
 
@@ -149,11 +228,29 @@ class Single_MiniPTM:
                 0, "EEPROM_I2C_ADDR", "I2C_ADDR", addr)
             self.eeprom_addr = addr
 
-    def write_to_eeprom(self, offset, data):
+    def wait_eeprom_done(self, timeout=0.5):
         """
-        Запись данных в EEPROM
-        offset - смещение в памяти
-        data - данные для записи (массив байтов)
+        Ожидание завершения команды EEPROM
+        Прошивка DPLL обнуляет EEPROM_CMD после выполнения команды
+        timeout - максимальное время ожидания в секундах
+        Возвращает True если команда завершилась
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            cmd = self.dpll.modules["EEPROM"].read_reg_mul(0, "EEPROM_CMD_LOW", 2)
+            if cmd[0] == 0 and cmd[1] == 0:
+                return True
+            if time.monotonic() > deadline:
+                print(f"Board {self.board_num} EEPROM command timeout, cmd={cmd}")
+                return False
+            time.sleep(EEPROM_POLL_INTERVAL)
+
+    def eeprom_command(self, offset, size, cmd_low):
+        """
+        Запуск команды EEPROM и ожидание её завершения
+        offset - смещение в памяти EEPROM
+        size - количество байтов
+        cmd_low - младший байт команды (0x1 чтение, 0x2 запись)
         """
         # Выбираем блок памяти в зависимости от смещения
         if (offset > 0xffff):
@@ -161,53 +258,99 @@ class Single_MiniPTM:
         else:
             self.init_eeprom_addr(0)
 
-        # Форматируем данные для отладочного вывода
-        hex_values = [f"{value:02x}" for value in data]
-        print(
-            f"Write Board {self.board_num} EEPROM offset 0x{offset:x} data {hex_values}")
-
-        # Записываем смещение (младший и старший байты)
-        self.dpll.modules["EEPROM"].write_field(0, "EEPROM_OFFSET_LOW", "EEPROM_OFFSET",
-                                                offset & 0xff)
-        self.dpll.modules["EEPROM"].write_field(0, "EEPROM_OFFSET_HIGH", "EEPROM_OFFSET",
-                                                (offset >> 8) & 0xff)
-
-        # Записываем количество байтов (максимум 128)
-        data_len = len(data)
-        if (data_len > 128):
-            data_len = 128
-            data = data[:128]
-
-        self.dpll.modules["EEPROM"].write_field(
-            0, "EEPROM_SIZE", "BYTES", data_len)
+        # Размер и смещение - соседние регистры, пишем одним блоком
+        self.dpll.modules["EEPROM"].write_reg_mul(
+            0, "EEPROM_SIZE", [size, offset & 0xff, (offset >> 8) & 0xff])
+        # Старший байт команды запускает операцию
+        self.dpll.modules["EEPROM"].write_reg_mul(
+            0, "EEPROM_CMD_LOW", [cmd_low, EEPROM_CMD_HIGH])
+        return self.wait_eeprom_done()
 
-        # Записываем данные в буфер
-        for i in range(data_len):
-            reg = f"BYTE_OTP_EEPROM_PWM_BUFF_{i}"
-            self.dpll.modules["EEPROM_DATA"].write_reg(0, reg, data[i])
-
-        # Записываем команду для выполнения операции записи
-        self.dpll.modules["EEPROM"].write_field(
-            0, "EEPROM_CMD_LOW", "EEPROM_CMD", 0x2)  # Команда записи в EEPROM
-        self.dpll.modules["EEPROM"].write_field(
-            0, "EEPROM_CMD_HIGH", "EEPROM_CMD", 0xEE)  # Старший байт команды
-
-        # Даем время на выполнение записи (0.5мс на байт)
-        time.sleep(0.0005 * data_len)
+    def write_to_eeprom(self, offset, data):
+        """
+        Запись данных в EEPROM
+        Данные делятся на передачи по EEPROM_TRANSFER_MAX байтов, буфер
+        EEPROM_DATA заполняется одной блочной записью на передачу
+        offset - смещение в памяти
+        data - данные для записи (массив байтов)
+        """
+        print(
+            f"Write Board {self.board_num} EEPROM offset 0x{offset:x} {len(data)} bytes")
+
+        pos = 0
+        while pos < len(data):
+            cur_offset = offset + pos
+            # Передача не пересекает выровненную границу EEPROM_TRANSFER_MAX
+            chunk_len = min(len(data) - pos,
+                            EEPROM_TRANSFER_MAX - (cur_offset % EEPROM_TRANSFER_MAX))
+            self.i2c.write_dpll_block(
+                EEPROM_DATA.BASE_ADDRESSES[0], data[pos:pos + chunk_len])
+            if not self.eeprom_command(cur_offset, chunk_len, EEPROM_CMD_WRITE):
+                return False
+            pos += chunk_len
+        return True
+
+    def read_from_eeprom(self, offset, length):
+        """
+        Чтение данных из EEPROM через буфер EEPROM_DATA
+        offset - смещение в памяти
+        length - количество байтов
+        Возвращает bytearray или None при ошибке
+        """
+        data = bytearray()
+        while len(data) < length:
+            cur_offset = offset + len(data)
+            chunk_len = min(length - len(data),
+                            EEPROM_TRANSFER_MAX - (cur_offset % EEPROM_TRANSFER_MAX))
+            if not self.eeprom_command(cur_offset, chunk_len, EEPROM_CMD_READ):
+                return None
+            data += self.i2c.read_dpll_block(
+                EEPROM_DATA.BASE_ADDRESSES[0], chunk_len)
+        return data
+
+    def write_eeprom_file_incremental(self, eeprom_file, page_size=128):
+        """
+        Инкрементальная запись файла Intel HEX в EEPROM
+        Читает каждую страницу, записывает только отличающиеся и
+        проверяет их повторным чтением
+        eeprom_file - путь к файлу в формате Intel HEX
+        Возвращает (число записанных страниц, список непроверенных страниц)
+        """
+        hex_image = load_intel_hex_image(eeprom_file)
+        self.eeprom_addr = 0  # Сбрасываем адрес EEPROM
+        written = 0
+        failed = []
+        for addr, page in hex_image.pages(page_size):
+            current = self.read_from_eeprom(addr, len(page))
+            if current == page:
+                continue
+            written += 1
+            if not self.write_to_eeprom(addr, page):
+                print(f"Board {self.board_num} EEPROM write timed out at 0x{addr:x}")
+                failed.append(addr)
+                continue
+            if self.read_from_eeprom(addr, len(page)) != page:
+                print(f"Board {self.board_num} EEPROM verify failed at 0x{addr:x}")
+                failed.append(addr)
+        print(f"Board {self.board_num} EEPROM {written} pages written, {len(failed)} failed verify")
+        return written, failed
 
     def write_eeprom_file(self, eeprom_file="8A34002_MiniPTMV3_12-29-2023_Julian_AllPhaseMeas_EEPROM.hex"):
         """
         Запись файла Intel HEX в EEPROM
         eeprom_file - путь к файлу в формате Intel HEX
+        Возвращает список страниц, запись которых не завершилась
         """
-        # Парсим Intel HEX файл
-        hex_file_data, non_data_records_debug = parse_intel_hex_file(
-            eeprom_file)
+        # Образ Intel HEX файла (из кэша, если файл уже разбирался)
+        hex_image = load_intel_hex_image(eeprom_file)
         self.eeprom_addr = 0  # Сбрасываем адрес EEPROM
-        # Записываем данные по адресам
-        for addr in hex_file_data.keys():
-            # print(f"Write addr {addr:02x} = {hex_file_data[addr]}")
-            self.write_to_eeprom(addr, hex_file_data[addr])
+        failed = []
+        # Записываем выровненными страницами по 128 байтов прямо из образа
+        for addr, page in hex_image.pages(128):
+            if not self.write_to_eeprom(addr, page):
+                print(f"Board {self.board_num} EEPROM write timed out at 0x{addr:x}")
+                failed.append(addr)
+        return failed
 
     def is_configured(self) -> bool:
         # check GPIO config registers for GPIOs used by DPLL for LEDs on MiniPTM
@@ -263,25 +406,37 @@ class Single_MiniPTM:
         #print(f"Read pcie clk phase board {self.board_num} val = {average}")
         return average
 
+    def phase_sampler(self, channels=(1,), capacity=4096, unwrap=True,
+                      frequency_offset=None, restart_on_discontinuity=False):
+        """
+        Потоковый сбор фазы DPLLn_PHASE_STATUS с метками времени
+        channels - номера каналов DPLL, capacity - размер буфера в отсчётах
+        unwrap - развёртка 36-битной фазы вместо перезапуска измерения
+        frequency_offset - известное смещение частоты (доля) для развёртки
+        Возвращает PhaseSampler, запуск через start() или run()
+        """
+        return PhaseSampler(self, channels, capacity, unwrap,
+                            frequency_offset, restart_on_discontinuity)
+
 
 
     # loopbw_units same as DPL_CTRL_0.DPLL_BW definitions
     def set_dpll_loop_params(self, dpll_num=0,
             loopbw=1000, loopbw_units = 1,
             decimator_bw_mult=4, psl=0):
+        self.set_dpll_loop_params_multi([dpll_num], loopbw, loopbw_units,
+                decimator_bw_mult, psl)
 
-        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
-                "DPLL_PSL_7_0", psl & 0xff)
-        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
-                "DPLL_PSL_15_8", (psl >> 8) & 0xff)
-        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
-                "DPLL_DECIMATOR_BW_MULT", decimator_bw_mult & 0xff)
-        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
-                "DPLL_BW_0", loopbw & 0xff)
-        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
-                "DPLL_BW_1", ((loopbw>>8) & 0x3f) + (loopbw_units << 6) )
-
-        
+    def set_dpll_loop_params_multi(self, dpll_nums,
+            loopbw=1000, loopbw_units = 1,
+            decimator_bw_mult=4, psl=0):
+        # DECIMATOR_BW_MULT, BW_0, BW_1, PSL_7_0, PSL_15_8 are contiguous,
+        # one block write per DPLL channel
+        data = encode_dpll_loop_params(loopbw, loopbw_units,
+                decimator_bw_mult, psl)
+        for dpll_num in dpll_nums:
+            self.dpll.modules["DPLL_Ctrl"].write_reg_mul(dpll_num,
+                    "DPLL_DECIMATOR_BW_MULT", data)
 
 
 
@@ -490,66 +645,21 @@ class Single_MiniPTM:
         return []
 
 
+    def arm_tod_secondary_all(self, cmd, pwm_decoder=None, ref_index=None):
+        # all four secondary TOD reads latch on the same trigger
+        self.tod_secondary.arm(cmd, pwm_decoder, ref_index)
+
+    def read_tod_secondary_all(self):
+        # coherent 4-tuple of 11-byte TODs from one bulk read
+        return self.tod_secondary.read()
+
+
     # tod_num is which TOD to use to check frame sync mode with
     # dpll_frame_sync is list of dplls that are frame syncing at the same time 
     def wait_for_frame_sync_loopback_stable(self, tod_num=0, dpll_frame_sync=[0], clkin=13, timeout=30, good_count_threshold=10):
-        start_time = time.time()
-        tod_vals = []
-        count = 0
-        good_count = 0
-
-        # make sure frame sync mode is enabled and trigger it
-
-        for dpll_num in dpll_frame_sync:
-            self.dpll.modules["DPLL_Config"].write_field(dpll_num,
-                    "DPLL_CTRL_2", "FRAME_SYNC_MODE", 1)
-            self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num, 
-                    "DPLL_FRAME_PULSE_SYNC", 0x1)
-
-        while time.time() - start_time <= timeout:
-            # trigger TOD with frame sync loopback clkin
-            tod_val = self.get_tod_trigger_from_pps(tod_num, True, False, clkin)
-            if not len(tod_val):
-                continue # didnt get a valid reading, go again
-
-            # got a valid reading
-            tod_ns = time_to_nanoseconds(tod_val)
-            print(f"Count {count}, Board {self.board_num}, wait for frame sync, TOD{tod_num} = {tod_ns}")
-            count += 1
-            tod_vals.append(tod_ns)
-            if len(tod_vals) >= 2:
-                diff = tod_vals[-1] - tod_vals[-2]
-                print(f"Difference: {diff}")
-                if ( diff == 1e9 ):
-                    # difference is exactly 1e9 nanoseconds, as it should be
-                    good_count += 1
-                tod_vals = tod_vals[-2:]
-
-            if ( good_count >= good_count_threshold ):
-                # seen at least some number of exact 1e9 nanosecond tod values
-                # disable frame sync mode on both channels
-                print(f"Saw {good_count} exact 1e9 frame sync pulses, trying disable frame sync")
-                for dpll_num in dpll_frame_sync:
-                    self.dpll.modules["DPLL_Config"].write_field(dpll_num,
-                            "DPLL_CTRL_2", "FRAME_SYNC_MODE", 0)
-                 
-                # check tod again
-                tod_val = self.get_tod_trigger_from_pps(tod_num, True, False, clkin)
-                tod_ns = time_to_nanoseconds(tod_val)
-                tod_diff = tod_ns - tod_vals[-2]
-                if not len(tod_val) or tod_diff != 1e9:
-                    print(f"After frame sync disable, didn't get 1e9 timestamp, restart, {tod_ns} , {tod_vals[-2]}")
-                    for dpll_num in dpll_frame_sync:
-                        self.dpll.modules["DPLL_Config"].write_field(dpll_num,
-                                "DPLL_CTRL_2", "FRAME_SYNC_MODE", 1)
-                        self.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num, 
-                                "DPLL_FRAME_PULSE_SYNC", 0x1)
-                    good_count = 0
-                    tod_vals = []
-                    count = 0
-                else:
-                    print(f"After frame sync disable, got 1e9 timestamp, slave frame sync good!")
-                    return True
-        return False # timeout expired
+        # same convergence as MiniPTM.frame_sync_all_boards, for this board only
+        coordinator = FrameSyncCoordinator([self], tod_num, dpll_frame_sync,
+                clkin, good_count_threshold)
+        return coordinator.run(timeout)[self.board_num]
 
 
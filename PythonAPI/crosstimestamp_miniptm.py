@@ -0,0 +1,99 @@
+
+import time
+
+#########
+# Кросс-таймстемпинг PTP часов I225 (SYSTIM) и TOD DPLL 8A34002
+# Запись команды немедленного чтения TODReadPrimary защёлкивает TOD в
+# конце I2C транзакции. Транзакция обрамляется двумя чтениями SYSTIM
+# через BAR, момент защёлкивания лежит между ними:
+#   смещение = TOD - середина(SYSTIM до, SYSTIM после)
+#   неопределённость = половина ширины окна
+
+TOD_READ_CMD_DISABLE = 0x0
+TOD_READ_CMD_IMMEDIATE = 0x1
+
+
+def tod_bytes_to_nanoseconds(tod):
+    """
+    11 байтов TOD (subns, ns 0-31, секунды 0-47) в целые наносекунды
+    Доли наносекунды (tod[0] / 256) не входят, float не хватает точности
+    """
+    nanoseconds = int.from_bytes(bytes(tod[1:5]), byteorder='little')
+    seconds = int.from_bytes(bytes(tod[5:11]), byteorder='little')
+    return seconds * 1000000000 + nanoseconds
+
+
+class CrossTimestamp:
+    """
+    Один отсчёт
+    phc_ns - время I225 в середине окна
+    tod_ns - защёлкнутое время TOD, целые наносекунды
+    offset_ns - tod_ns - phc_ns с учётом долей наносекунды TOD
+    uncertainty_ns - половина окна между двумя чтениями SYSTIM
+    host_time - time.monotonic() в момент отсчёта
+    """
+    __slots__ = ("phc_ns", "tod_ns", "offset_ns", "uncertainty_ns", "host_time")
+
+    def __init__(self, phc_ns, tod_ns, tod_subns, uncertainty_ns, host_time):
+        self.phc_ns = phc_ns
+        self.tod_ns = tod_ns
+        self.offset_ns = (tod_ns - phc_ns) + tod_subns / 256
+        self.uncertainty_ns = uncertainty_ns
+        self.host_time = host_time
+
+    def __repr__(self):
+        return (f"offset {self.offset_ns:.1f} ns +/- {self.uncertainty_ns:.1f} ns "
+                f"(phc {self.phc_ns}, tod {self.tod_ns})")
+
+
+class PHCTODCrossTimestamper:
+    """
+    Кросс-таймстемпинг одной платы: I225 SYSTIM против TOD tod_num
+    """
+
+    def __init__(self, board, tod_num=0):
+        """
+        board - Single_MiniPTM
+        tod_num - номер TOD (0-3), читается через TODReadPrimary
+        """
+        self.board = board
+        self.tod_num = tod_num
+        self.module = board.dpll.modules["TODReadPrimary"]
+        base_addr = self.module.BASE_ADDRESSES[tod_num]
+        self.cmd_addr = base_addr + self.module.LAYOUT["TOD_READ_PRIMARY_CMD"]["offset"]
+        self.last = None
+
+    def sample(self):
+        """
+        Один отсчёт, возвращает CrossTimestamp
+        """
+        i2c = self.board.i2c
+        pcie = self.board.PCIe
+        # Страница не должна смениться между сбросом и командой
+        with i2c.lock:
+            # Сброс команды, заодно выбирает страницу регистра команды
+            i2c.write_dpll_reg_direct(self.cmd_addr, TOD_READ_CMD_DISABLE)
+
+            host_time = time.monotonic()
+            phc_before = pcie.read_systim_ns()
+            i2c.write_dpll_reg_current_page(self.cmd_addr, TOD_READ_CMD_IMMEDIATE)
+            phc_after = pcie.read_systim_ns()
+
+        tod = self.module.read_reg_mul(self.tod_num, "TOD_READ_PRIMARY_SUBNS", 11)
+        window = phc_after - phc_before
+        cross_ts = CrossTimestamp(phc_before + window // 2,
+                                  tod_bytes_to_nanoseconds(tod), tod[0],
+                                  window / 2, host_time)
+        self.last = cross_ts
+        return cross_ts
+
+    def run(self, count=16):
+        """ count отсчётов подряд, возвращает список CrossTimestamp """
+        return [self.sample() for i in range(count)]
+
+    def best(self, count=16):
+        """
+        Отсчёт с наименьшей неопределённостью из count
+        Узкое окно - меньше влияние планировщика и задержек шины
+        """
+        return min(self.run(count), key=lambda cross_ts: cross_ts.uncertainty_ns)
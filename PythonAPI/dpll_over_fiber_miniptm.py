@@ -1,7 +1,10 @@
+import threading
 import time
 from collections import deque  # Двусторонняя очередь для эффективной работы с данными
 from board_miniptm import *
 from renesas_cm_registers import *
+from filters_miniptm import AverageFilter
+from dpof_scheduler_miniptm import DecoderScheduler
 import random
 
 
@@ -51,6 +54,16 @@ import random
 """
 
 
+# How often a channel needs to run while waiting on something
+# PWM_USER_DATA CMD_STS moves on PWM byte timing
+DPOF_FIFO_POLL_SEC = 0.005
+# New handshake bytes show up with a decoded PWM TOD frame, once per second
+# at an unknown phase, so poll well inside the second
+DPOF_DECODER_POLL_SEC = 0.05
+# Nothing pending on this channel
+DPOF_IDLE_POLL_SEC = 0.25
+
+
 """
 RX is the most constrained , so it needs the most logic
 
@@ -60,24 +73,6 @@ RX is the most constrained , so it needs the most logic
     b. is the PWM encoder on the other side trying to initiate a request
 """
 
-class AverageFilter:
-    def __init__(self):
-        self.values = []
-
-    def update(self, value):
-        self.values.append(value)
-
-    def get_count(self):
-        return len(self.values)
-
-    def get_average(self, clear_avg=False):
-        if ( len(self.values) ):
-            avg = sum(self.values) / len(self.values)
-            if ( clear_avg ):
-                self.values = []
-            return avg
-        return 0
-
 # basically control TOD , a single PWM Encoder, and a single decoder
 # Secondary feature of this,
 # Record TOD at reception of PPS from this decoder on each TOD using SecondaryTODRead
@@ -107,6 +102,8 @@ class dpof_single_channel():
         self.time_tx_enabled = False
         self.current_transaction_id_tx = 0
         self.fifo_to_send = []
+        # counts own transactions the far side finished with 0x2
+        self.tx_done_count = 0
 
         # rx variables
         self.decoder = decoder_num
@@ -117,6 +114,8 @@ class dpof_single_channel():
 
         self.rx_enabled = False
         self.decoder_time_slice_sec = decoder_time_slice_sec
+        # DecoderScheduler sets the slice length when present
+        self.scheduler = None
         self.last_data_this_decoder = []
 
         self.fifo_grant = False
@@ -303,11 +302,7 @@ class dpof_single_channel():
             if (self.DEBUG_PRINT):
                 print(f"RX slave respond query wait fifo tx, got tx ack")
                 print(f" Sending fifo {self.fifo_to_send}")
-            for i in range(len(self.fifo_to_send)):
-                reg_name = f"BYTE_OTP_EEPROM_PWM_BUFF_{i}"
-                #print(f"RX Slave respond query wait fifo write i={i} {self.fifo_to_send}")
-                self.board.dpll.modules["EEPROM_DATA"].write_reg(0,
-                                                                 reg_name, self.fifo_to_send[i])
+            self.board.dpll.modules["EEPROM_DATA"].write_fifo(self.fifo_to_send)
 
             # start transmission
             self.board.dpll.modules["PWM_USER_DATA"].write_reg(0,
@@ -383,12 +378,8 @@ class dpof_single_channel():
                 print(
                     f"Slave wait write Received {fifo_byte_count} through FIFO")
 
-            fifo_data = []
-
-            for i in range(fifo_byte_count):
-                reg_name = f"BYTE_OTP_EEPROM_PWM_BUFF_{i}"
-                fifo_data.append(self.board.dpll.modules["EEPROM_DATA"].read_reg(0,
-                                                                                 reg_name))
+            fifo_data = self.board.dpll.modules["EEPROM_DATA"].read_fifo(
+                min(fifo_byte_count, EEPROM_DATA_FIFO_SIZE))
 
             if (self.DEBUG_PRINT):
                 print(f"Slave wait write Received fifo data: {fifo_data}")
@@ -500,10 +491,7 @@ class dpof_single_channel():
         if (self.DEBUG_PRINT):
             print(f"Transmit write state, check PWM user status, {pwm_status}")
         if (pwm_status == 0x3):  # got tx ack, can send data now
-            for i in range(len(self.fifo_to_send)):
-                reg_name = f"BYTE_OTP_EEPROM_PWM_BUFF_{i}"
-                self.board.dpll.modules["EEPROM_DATA"].write_reg(0,
-                                                                 reg_name, self.fifo_to_send[i])
+            self.board.dpll.modules["EEPROM_DATA"].write_fifo(self.fifo_to_send)
 
             # start transmission
             self.board.dpll.modules["PWM_USER_DATA"].write_reg(0,
@@ -538,12 +526,8 @@ class dpof_single_channel():
             if (self.DEBUG_PRINT):
                 print(f"Received {fifo_byte_count} through FIFO")
 
-            fifo_data = []
-
-            for i in range(fifo_byte_count):
-                reg_name = f"BYTE_OTP_EEPROM_PWM_BUFF_{i}"
-                fifo_data.append(self.board.dpll.modules["EEPROM_DATA"].read_reg(0,
-                                                                                 reg_name))
+            fifo_data = self.board.dpll.modules["EEPROM_DATA"].read_fifo(
+                min(fifo_byte_count, EEPROM_DATA_FIFO_SIZE))
 
             if (self.DEBUG_PRINT):
                 print(f"Received fifo data: {fifo_data}")
@@ -568,6 +552,7 @@ class dpof_single_channel():
                 if (handshake_state_rx == 0x2):  # got ack from other side
                     if (self.DEBUG_PRINT):
                         print(f"Transmit query state got 0x2, done")
+                    self.tx_done_count += 1
                     self.stop_tx()
                     self.state = dpof_single_channel.IDLE
                     return self.disable_decoder_if_time_over(), False
@@ -608,11 +593,27 @@ class dpof_single_channel():
             if (handshake_state_rx == 0x2):  # got ack from other side
                 if (self.DEBUG_PRINT):
                     print(f"Transmit done wait state got 0x2, done")
+                self.tx_done_count += 1
                 self.stop_tx()
                 self.state = dpof_single_channel.IDLE
 
         return self.disable_decoder_if_time_over(), False
 
+    # states waiting on PWM_USER_DATA CMD_STS or on the FIFO grant
+    FIFO_WAIT_STATES = (RX_SLAVE, RX_SLAVE_RESPOND_QUERY_WAIT_FIFO_TX,
+                        RX_SLAVE_RESPOND_QUERY_WAIT_FIFO_TX_DONE, RX_SLAVE_WAIT_WRITE,
+                        TRANSMIT_WON, TRANSMIT_WRITE, TRANSMIT_QUERY)
+
+    # how long until top_state_machine could see something new
+    def next_poll_interval(self):
+        if (self.state in dpof_single_channel.FIFO_WAIT_STATES):
+            return DPOF_FIFO_POLL_SEC
+        if (not self.rx_enabled):
+            return DPOF_IDLE_POLL_SEC
+        # waiting on decoder data, but also wake up when the time slice ends
+        slice_left = self.get_decoder_time_slice() - self.get_how_long_decoder_on()
+        return max(0, min(DPOF_DECODER_POLL_SEC, slice_left))
+
     # returns [bool, bool] value
     # First bool, whether decoder is now disabled or enabled, True for enabled
     # Second bool, if PWM FIFO is needed
@@ -681,6 +682,9 @@ class dpof_single_channel():
             return True
         return False
 
+    def is_idle(self):
+        return self.state == dpof_single_channel.IDLE
+
     def start_tx(self, handshake_id=0, transaction_id=0, fifo_data=[]):
         if (self.tx_enabled == True):  # already enabled
             self.stop_tx()
@@ -803,12 +807,17 @@ class dpof_single_channel():
             # undefined
         return []
 
+    def get_decoder_time_slice(self):
+        if (self.scheduler is not None):
+            return self.scheduler.slice_limit(self)
+        return self.decoder_time_slice_sec
+
     # returns False if decoder disabled, true if still enabled
     def disable_decoder_if_time_over(self):
-        if (self.get_how_long_decoder_on() >= self.decoder_time_slice_sec):
+        if (self.get_how_long_decoder_on() >= self.get_decoder_time_slice()):
             if (self.DEBUG_PRINT):
                 print(
-                    f"Stopping RX, {self.get_how_long_decoder_on()}, {self.decoder_time_slice_sec}")
+                    f"Stopping RX, {self.get_how_long_decoder_on()}, {self.get_decoder_time_slice()}")
             # time slice elapsed
             self.stop_rx()
             return False
@@ -822,36 +831,29 @@ class dpof_single_channel():
         # simple, turn off decoder
         self.board.dpll.modules["PWMDecoder"].write_field(self.decoder,
                                                           "PWM_DECODER_CMD", "ENABLE", 0)
-        self.rx_enable = False
+        self.rx_enabled = False
+        if (self.scheduler is not None):
+            self.scheduler.on_slice_end(self)
 
     def start_rx(self):
         if (self.DEBUG_PRINT):
             print(f"Board {self.board.board_num} start rx {self.decoder}")
         # record what PWM TOD is to detect change after enabling decoder
-        self.pwm_tod_before_start_rx = self.read_raw_hardware_buffer()
+        raw_buffer = self.read_raw_hardware_buffer(True)
+        self.pwm_tod_before_start_rx = raw_buffer[-2:]
 
-        self.last_tod_push = []
+        # TOD already in the buffer came through the previous decoder
+        self.last_tod_push = raw_buffer[:-2]
 
         # Secondary feature, record TOD at reception of PPS from this decoder
         # on each TOD using SecondaryTODRead
 
-        # clear any previous triggers
-        for i in range(4):  # 4 TODs
-
-            if (self.DEBUG_PRINT):
-                print(
-                    f"Enable TOD Secondary {i} read using decoder {self.decoder}")
-
-            self.board.dpll.modules["TODReadSecondary"].write_field(i,
-                                                                    "TOD_READ_SECONDARY_CMD", "TOD_READ_TRIGGER", 0x0)
-
-            # configure this decoder as trigger source
-            self.board.dpll.modules["TODReadSecondary"].write_field(i,
-                                                                    "TOD_READ_SECONDARY_SEL_CFG_0", "PWM_DECODER_INDEX", self.decoder)
+        if (self.DEBUG_PRINT):
+            print(f"Enable TOD Secondary reads using decoder {self.decoder}")
 
-            # configure continous TOD read on PWM Decoder 1PPS output
-            self.board.dpll.modules["TODReadSecondary"].write_reg(i,
-                                                                  "TOD_READ_SECONDARY_CMD", 0x14)
+        # clear any previous triggers, this decoder as trigger source and
+        # continous TOD read on PWM Decoder 1PPS output, all 4 TODs together
+        self.board.arm_tod_secondary_all(0x14, pwm_decoder=self.decoder)
 
         # enable decoder with frame access
         self.board.dpll.modules["PWMDecoder"].write_field(self.decoder,
@@ -860,6 +862,8 @@ class dpof_single_channel():
         # record time when started decoder
         self.start_time_on_this_decoder = time.time()
         self.rx_enabled = True
+        if (self.scheduler is not None):
+            self.scheduler.on_slice_start(self)
 
     def get_how_long_decoder_on(self):
         if (self.rx_enabled):
@@ -875,10 +879,10 @@ class dpof_single_channel():
         
         local_tod_save = []
 
-        for i in range(4):  # read back TODs as well
-            local_tod = self.board.dpll.modules["TODReadSecondary"].read_reg_mul(i,
-                     "TOD_READ_SECONDARY_SUBNS", 11)
-            local_tod = local_tod[:-2]
+        # read back TODs as well, all 4 latched on the same decoder PPS
+        local_tods = self.board.read_tod_secondary_all()
+        for i in range(4):
+            local_tod = local_tods[i][:-2]
             tod_compare.append(local_tod)
             if ( i == self.decoder/2 ):
                 local_tod_save = list(local_tod)
@@ -922,14 +926,18 @@ class dpof_single_channel():
 
             if ((pwm_stale) or
                     (data_hs == self.last_data_this_decoder)):
-                print(f"Not new decoder data, pwm_stale={pwm_stale} ")
+                if (self.DEBUG_PRINT):
+                    print(f"Not new decoder data, pwm_stale={pwm_stale} ")
 
                 if ( not pwm_tod_stale ): 
                     # got new data, but not new handshake data
                     #this is fine for TOD compare
-                    print(f"Pushing tod compare even though no new decoder data")
+                    if (self.DEBUG_PRINT):
+                        print(f"Pushing tod compare even though no new decoder data")
                     self.push_tod_compare_data(data)
                     self.last_tod_push = data_nonhs
+                    if (self.scheduler is not None):
+                        self.scheduler.on_frame(self, False)
 
                 # nothing new
                 return []
@@ -947,6 +955,8 @@ class dpof_single_channel():
                 # Secondary feature, record TODs from TODReadSecondary and this PWM frame
                 self.push_tod_compare_data(data)
                 self.last_tod_push = data_nonhs
+                if (self.scheduler is not None):
+                    self.scheduler.on_frame(self, True)
                 return data_hs
         return []
 
@@ -1001,6 +1011,11 @@ class DPOF_Top():
         self.channels = [dpof_single_channel(
             self.board, i, i, i*2, 5) for i in range(4)]  # decoders skip one
 
+        # activity based time slices instead of a fixed 5 seconds per decoder
+        self.decoder_scheduler = DecoderScheduler(self.channels)
+        for chan in self.channels:
+            chan.scheduler = self.decoder_scheduler
+
         # enable one
         #self.channels[self.active_decoder].start_rx()
 
@@ -1019,9 +1034,31 @@ class DPOF_Top():
         # TX Logic variables
         self.DEBUG_PRINT = DEBUG_PRINT
 
+        # tick() may run from a DPOFRuntime thread, API calls take the lock
+        self.lock = threading.RLock()
+        # set by API calls that start something, wakes the runtime early
+        self.wake_event = threading.Event()
+        # called as listener(self) at the end of every tick, under the lock
+        self.tick_listeners = []
+
     # top level function
 
     def tick(self):
+        with self.lock:
+            self._tick()
+            for listener in list(self.tick_listeners):
+                listener(self)
+
+    def add_tick_listener(self, listener):
+        with self.lock:
+            self.tick_listeners.append(listener)
+
+    def remove_tick_listener(self, listener):
+        with self.lock:
+            if listener in self.tick_listeners:
+                self.tick_listeners.remove(listener)
+
+    def _tick(self):
         for index, chan in enumerate(self.channels):
             if ( self.DEBUG_PRINT ):
                 print(f"Board {self.board.board_num} DPOF tick, chan {index}")
@@ -1033,8 +1070,8 @@ class DPOF_Top():
             if (not decoder_enabled):  # it turned itself off
                 if (index == self.active_decoder):  # it was enabled
                     # enable next one
-                    self.active_decoder = (
-                        self.active_decoder + 1) % len(self.channels)
+                    self.active_decoder = self.decoder_scheduler.next_channel(
+                        self.active_decoder)
                     if ( self.DEBUG_PRINT ):
                         print(
                             f"Board {self.board.board_num} switch to decoder {self.active_decoder}")
@@ -1059,50 +1096,78 @@ class DPOF_Top():
                     print(
                         f"DPOF Top Tick, got query data back! {chan.pwm_query_data}")
 
+    # seconds until some channel could make progress
+    def next_tick_interval(self):
+        with self.lock:
+            return min(chan.next_poll_interval() for chan in self.channels)
+
+    # True if query, write or TOD compare data is waiting to be popped
+    def has_results(self):
+        with self.lock:
+            for chan in self.channels:
+                if (len(chan.pwm_query_data) or len(chan.pwm_write_data)
+                        or len(chan.tod_compare_data)):
+                    return True
+            return False
+
     # returns a single query data entry, [channel, query_id, [query data]]
     # or returns empty list
 
     def pop_query_data(self):
-        for index, chan in enumerate(self.channels):
-            if (len(chan.pwm_query_data) > 0):
-                data = chan.pwm_query_data.pop(0)
-                return data
-        return []
-
-    def pop_write_data(self):
-        for index, chan in enumerate(self.channels):
-            if (len(chan.pwm_write_data) > 0):
-                data = chan.pwm_write_data.pop(0)
-                return data
-        return []
+        with self.lock:
+            for index, chan in enumerate(self.channels):
+                if (len(chan.pwm_query_data) > 0):
+                    data = chan.pwm_query_data.pop(0)
+                    return data
+            return []
+
+    # write_ids limits which write transaction ids are popped, None for any
+    def pop_write_data(self, write_ids=None):
+        with self.lock:
+            for index, chan in enumerate(self.channels):
+                for pos, data in enumerate(chan.pwm_write_data):
+                    if (write_ids is None or data[1] in write_ids):
+                        return chan.pwm_write_data.pop(pos)
+            return []
+
+    # per decoder stats, {decoder: {slices, time_on, frames, handshakes, ...}}
+    def get_decoder_stats(self):
+        with self.lock:
+            return self.decoder_scheduler.get_stats()
 
     def get_chan_tx_ready(self, channel_num=0):
-        return self.channels[channel_num].can_tx()
+        with self.lock:
+            return self.channels[channel_num].can_tx()
 
     def dpof_query(self, channel_num=0, query_id=0):
-        if (self.channels[channel_num].can_tx()):
-            if ( self.DEBUG_PRINT ):
-                print(
-                    f"Board {self.board.board_num} can TX, starting TX chan={channel_num} query_id={query_id}")
-            self.channels[channel_num].start_tx(transaction_id=query_id)
-            return True
-        return False
+        with self.lock:
+            if (self.channels[channel_num].can_tx()):
+                if ( self.DEBUG_PRINT ):
+                    print(
+                        f"Board {self.board.board_num} can TX, starting TX chan={channel_num} query_id={query_id}")
+                self.channels[channel_num].start_tx(transaction_id=query_id)
+                self.wake_event.set()
+                return True
+            return False
 
     def dpof_write(self, channel_num=0, write_id=0, data=[]):
-        if (self.channels[channel_num].can_tx()):
-            self.channels[channel_num].start_tx(transaction_id=write_id,
-                                                fifo_data=data)
-            return True
-        return False
+        with self.lock:
+            if (self.channels[channel_num].can_tx()):
+                self.channels[channel_num].start_tx(transaction_id=write_id,
+                                                    fifo_data=data)
+                self.wake_event.set()
+                return True
+            return False
 
     def get_tod_compare(self):
-        data = []
-        for index, chan in enumerate(self.channels):
-            if (len(chan.tod_compare_data) > 0):
-                val = chan.tod_compare_data.pop(0)
-                print(f"Chan {index} had tod_compare_data {val}")
-                data.append( val )
-        return data
+        with self.lock:
+            data = []
+            for index, chan in enumerate(self.channels):
+                if (len(chan.tod_compare_data) > 0):
+                    val = chan.tod_compare_data.pop(0)
+                    print(f"Chan {index} had tod_compare_data {val}")
+                    data.append( val )
+            return data
 
     def write_tod_absolute(self, tod_num=0, tod_subns=0, tod_ns=0, tod_sec=0):
         data = []
@@ -1200,31 +1265,35 @@ class DPOF_Top():
         return self.average_tod_errors[channel_num].get_average(clear_avg)
 
     def get_average_tod_count(self, channel_num):
-        return self.average_tod_errors[channel_num].has_data()
+        return self.average_tod_errors[channel_num].get_count()
 
 
     def inform_new_master(self, decoder_num):
-        self.master_decoder = decoder_num
-        self.following_master = True
-        self.master_tod_differences = [] # for averaging
+        with self.lock:
+            self.master_decoder = decoder_num
+            self.following_master = True
+            self.master_tod_differences = [] # for averaging
 
     #### Top level call, when following far side,
     # should call these after doing initial TOD adjustment to far side
     def start_follow_far_side(self, decoder_num):
-        self.channels[decoder_num//2].set_follow_far_side()
-        self.inform_new_master(decoder_num//2)
+        with self.lock:
+            self.channels[decoder_num//2].set_follow_far_side()
+            self.inform_new_master(decoder_num//2)
 
     def stop_follow_far_side(self):
-        self.channels[self.master_decoder//2].stop_follow_far_side()
-        self.master_decoder = -1
-        self.following_master = False
+        with self.lock:
+            self.channels[self.master_decoder//2].stop_follow_far_side()
+            self.master_decoder = -1
+            self.following_master = False
 
     def get_channels_following(self):
-        channels_following = []
-        for index, chan in enumerate(self.channels):
-            if ( chan.far_side_following ):
-                channels_following.append(index)
-        return channels_following
+        with self.lock:
+            channels_following = []
+            for index, chan in enumerate(self.channels):
+                if ( chan.far_side_following ):
+                    channels_following.append(index)
+            return channels_following
 
   
 
@@ -0,0 +1,443 @@
+
+import argparse
+import heapq
+import random
+import threading
+import time
+
+from i2c_miniptm import miniptm_i2c
+from board_miniptm import Single_MiniPTM
+from renesas_cm_registers import (TODWrite, TODReadPrimary, TODReadSecondary,
+                                  PWMDecoder, PWM_USER_DATA, EEPROM_DATA)
+from dpof_runtime_miniptm import DPOFRuntimeGroup
+from dpof_transport_miniptm import DPOFMessageTransport
+
+#########
+# Симулятор линии DPLL over fiber между двумя платами
+# Каждая плата - настоящие Single_MiniPTM, DPLL и DPOF_Top поверх модели
+# шины I2C с памятью 8A34002. Модель повторяет то, что видит DPOF:
+#   - кодировщики каждую frame_period отправляют свой TOD, декодер соседа
+#     (если включён) кладёт кадр в общий приёмный буфер 0xCE80 и
+#     защёлкивает TODReadSecondary, настроенные на этот декодер
+#   - TOD_WRITE (абсолютная запись и сдвиг), TOD_READ_PRIMARY
+#   - PWM_USER_DATA CMD_STS: запрос 0x1 -> 0x3 когда сосед готов (0x0),
+#     0x2 -> 0x5 у отправителя, 0xb и данные в EEPROM_DATA у получателя
+# Задержка линии, потеря кадров TOD и порча байтов user data задаются
+# параметрами. Канал DPOF i соединяет кодировщик i одной платы с
+# декодером 2*i другой, остальные декодеры слушают пустую линию.
+# Время настоящее (time.monotonic), события обрабатывает отдельный поток.
+
+SIM_PWM_RX_BUFFER = 0xCE80
+SIM_TOD_BYTES = 11
+SIM_DPLL_ADDRESS = 0x58
+SIM_PAGE_REGISTER = 0xFC
+NS_PER_SECOND = 1000000000
+
+PWM_USER_DATA_SIZE_ADDR = PWM_USER_DATA.BASE_ADDRESSES[0] + \
+    PWM_USER_DATA.LAYOUT["PWM_USER_DATA_PWM_USER_DATA_SIZE"]["offset"]
+PWM_USER_DATA_CMD_STS_ADDR = PWM_USER_DATA.BASE_ADDRESSES[0] + \
+    PWM_USER_DATA.LAYOUT["PWM_USER_DATA_PWM_USER_DATA_CMD_STS"]["offset"]
+PWM_DECODER_CMD_OFFSET = PWMDecoder.LAYOUT["PWM_DECODER_CMD"]["offset"]
+TOD_WRITE_CMD_OFFSET = TODWrite.LAYOUT["TOD_WRITE_CMD"]["offset"]
+TOD_READ_PRIMARY_CMD_OFFSET = TODReadPrimary.LAYOUT["TOD_READ_PRIMARY_CMD"]["offset"]
+TOD_READ_SECONDARY_COUNTER_OFFSET = \
+    TODReadSecondary.LAYOUT["TOD_READ_SECONDARY_COUNTER"]["offset"]
+TOD_READ_SECONDARY_SEL_CFG_0_OFFSET = \
+    TODReadSecondary.LAYOUT["TOD_READ_SECONDARY_SEL_CFG_0"]["offset"]
+TOD_READ_SECONDARY_CMD_OFFSET = TODReadSecondary.LAYOUT["TOD_READ_SECONDARY_CMD"]["offset"]
+
+# TOD_READ_SECONDARY_CMD, защёлка по 1PPS PWM декодера
+TOD_READ_TRIGGER_PWM_DECODER = 0x4
+
+PWM_USER_DATA_RX_IDLE = 0x0
+PWM_USER_DATA_TX_REQUEST = 0x1
+PWM_USER_DATA_SEND = 0x2
+PWM_USER_DATA_TX_ACK = 0x3
+PWM_USER_DATA_TX_DONE = 0x5
+PWM_USER_DATA_RX_DONE = 0xb
+
+
+def tod_to_bytes(tod_ns):
+    """ TOD в наносекундах -> 11 байтов как в регистрах (subns, ns, секунды) """
+    seconds, ns = divmod(tod_ns, NS_PER_SECOND)
+    return ([0] + list(ns.to_bytes(4, byteorder='little'))
+            + list((seconds & 0xFFFFFFFFFFFF).to_bytes(6, byteorder='little')))
+
+
+def tod_from_bytes(data):
+    ns = int.from_bytes(bytes(data[1:5]), byteorder='little')
+    seconds = int.from_bytes(bytes(data[5:11]), byteorder='little')
+    return seconds * NS_PER_SECOND + ns
+
+
+class SimDPLLBus:
+    """
+    Модель шины I2C платы: 64 КБ памяти DPLL с регистром страницы
+    Интерфейс smbus2.SMBus, который использует miniptm_i2c
+    Запись в отслеживаемые регистры вызывает write_hooks[адрес](значение)
+    """
+
+    def __init__(self):
+        self.mem = bytearray(0x10000)
+        self.page = 0
+        self.lock = threading.RLock()
+        self.write_hooks = {}
+        self.transactions = 0
+
+    def write_byte_data(self, dev, reg, value):
+        self.write_i2c_block_data(dev, reg, [value])
+
+    def write_i2c_block_data(self, dev, reg, data):
+        if dev != SIM_DPLL_ADDRESS:
+            return      # мультиплексор
+        with self.lock:
+            self.transactions += 1
+            if reg == SIM_PAGE_REGISTER:
+                self.page = data[1]
+                return
+            addr = (self.page << 8) + reg
+            self.mem[addr:addr + len(data)] = bytes(data)
+            for pos, value in enumerate(data):
+                hook = self.write_hooks.get(addr + pos)
+                if hook is not None:
+                    hook(value)
+
+    def read_byte_data(self, dev, reg):
+        return self.read_i2c_block_data(dev, reg, 1)[0]
+
+    def read_i2c_block_data(self, dev, reg, length):
+        with self.lock:
+            self.transactions += 1
+            addr = (self.page << 8) + reg
+            return list(self.mem[addr:addr + length])
+
+    def read(self, addr, length=1):
+        """ Прямое чтение памяти моделью, без транзакции """
+        with self.lock:
+            return list(self.mem[addr:addr + length])
+
+    def write(self, addr, data):
+        with self.lock:
+            self.mem[addr:addr + len(data)] = bytes(data)
+
+
+class SimI2C(miniptm_i2c):
+    """ miniptm_i2c поверх SimDPLLBus вместо smbus2 """
+
+    def __init__(self, bus, bus_num):
+        self.bus_num = bus_num
+        self.bus = bus
+        self.DPLL_ADDRESS = SIM_DPLL_ADDRESS
+        self.MUX_ADDRESS = 0x70
+        self.cur_base_addr = None
+        self.cur_mux_open = 0x8
+        self.lock = threading.RLock()
+
+
+class SimMiniPTM(Single_MiniPTM):
+    """ Плата без PCIe, DPLL на SimDPLLBus, DPOF_Top без изменений """
+
+    def __init__(self, board_num, bus):
+        super().__init__(board_num, None, board_num,
+                         i2c_factory=lambda adap_num: SimI2C(bus, adap_num))
+        self.dpof.DEBUG_PRINT = False
+
+
+class SimBoardModel:
+    """ Аппаратная часть одной платы: TOD, защёлки, PWM_USER_DATA """
+
+    def __init__(self, sim, board_num):
+        self.sim = sim
+        self.bus = SimDPLLBus()
+        self.board = SimMiniPTM(board_num, self.bus)
+        self.peer = None
+        start = time.monotonic()
+        # TOD(t) = tod_offset + (t - start) в нс
+        self.tod_start = start
+        self.tod_offset = [0] * len(TODWrite.BASE_ADDRESSES)
+        self.secondary_counter = 0
+
+        for tod_num, base in TODWrite.BASE_ADDRESSES.items():
+            self.bus.write_hooks[base + TOD_WRITE_CMD_OFFSET] = \
+                lambda value, tod_num=tod_num: self._tod_write(tod_num, value)
+        for tod_num, base in TODReadPrimary.BASE_ADDRESSES.items():
+            self.bus.write_hooks[base + TOD_READ_PRIMARY_CMD_OFFSET] = \
+                lambda value, tod_num=tod_num: self._tod_read_primary(tod_num, value)
+        self.bus.write_hooks[PWM_USER_DATA_CMD_STS_ADDR] = self._user_data_cmd
+
+    def tod_ns(self, tod_num, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.tod_offset[tod_num] + int((now - self.tod_start) * NS_PER_SECOND)
+
+    def _tod_write(self, tod_num, value):
+        if value & 0xf == 0:
+            return
+        base = TODWrite.BASE_ADDRESSES[tod_num]
+        written = tod_from_bytes(self.bus.read(base, SIM_TOD_BYTES))
+        write_type = (value >> 4) & 0x3
+        if write_type == 0:
+            self.tod_offset[tod_num] += written - self.tod_ns(tod_num)
+        elif write_type == 1:
+            self.tod_offset[tod_num] += written
+        elif write_type == 2:
+            self.tod_offset[tod_num] -= written
+
+    def _tod_read_primary(self, tod_num, value):
+        if value & 0xf == 0:
+            return
+        base = TODReadPrimary.BASE_ADDRESSES[tod_num]
+        self.bus.write(base, tod_to_bytes(self.tod_ns(tod_num)))
+
+    def decoder_enabled(self, decoder_num):
+        base = PWMDecoder.BASE_ADDRESSES[decoder_num]
+        return bool(self.bus.read(base + PWM_DECODER_CMD_OFFSET)[0] & 0x1)
+
+    def receive_frame(self, decoder_num, data):
+        """ Кадр TOD от соседа на декодере decoder_num """
+        if not self.decoder_enabled(decoder_num):
+            return False
+        now = time.monotonic()
+        self.bus.write(SIM_PWM_RX_BUFFER, data)
+        self.secondary_counter = (self.secondary_counter + 1) & 0xff
+        for tod_num, base in TODReadSecondary.BASE_ADDRESSES.items():
+            cmd = self.bus.read(base + TOD_READ_SECONDARY_CMD_OFFSET)[0]
+            sel_cfg_0 = self.bus.read(base + TOD_READ_SECONDARY_SEL_CFG_0_OFFSET)[0]
+            if (cmd & 0xf) != TOD_READ_TRIGGER_PWM_DECODER or (sel_cfg_0 >> 4) != decoder_num:
+                continue
+            self.bus.write(base, tod_to_bytes(self.tod_ns(tod_num, now)))
+            self.bus.write(base + TOD_READ_SECONDARY_COUNTER_OFFSET, [self.secondary_counter])
+        return True
+
+    def listening_to_peer(self):
+        """ Включён ли декодер, соединённый с соседом """
+        return any(self.decoder_enabled(2 * channel) for channel in self.sim.channels)
+
+    def user_data_status(self):
+        return self.bus.read(PWM_USER_DATA_CMD_STS_ADDR)[0]
+
+    def _user_data_cmd(self, value):
+        if value == PWM_USER_DATA_TX_REQUEST:
+            self.sim.schedule(self.sim.delay, self._user_data_request)
+        elif value == PWM_USER_DATA_SEND:
+            size = self.bus.read(PWM_USER_DATA_SIZE_ADDR)[0]
+            data = self.bus.read(EEPROM_DATA.BASE_ADDRESSES[0], size)
+            self.sim.schedule(self.sim.delay + size * self.sim.byte_time,
+                              lambda: self._user_data_transfer(data))
+
+    def _user_data_request(self):
+        if self.user_data_status() != PWM_USER_DATA_TX_REQUEST:
+            return  # отменён
+        peer = self.peer
+        if peer.user_data_status() == PWM_USER_DATA_RX_IDLE and peer.listening_to_peer():
+            # ответ идёт обратно по линии
+            self.sim.schedule(self.sim.delay, lambda: self.bus.write(
+                PWM_USER_DATA_CMD_STS_ADDR, [PWM_USER_DATA_TX_ACK]))
+        else:
+            self.sim.schedule(self.sim.delay, self._user_data_request)
+
+    def _user_data_transfer(self, data):
+        data = list(data)
+        if data and random.random() < self.sim.fifo_corruption:
+            data[random.randrange(len(data))] ^= 1 << random.randrange(8)
+            self.sim.stats["fifo_corrupted"] += 1
+        peer = self.peer
+        peer.bus.write(EEPROM_DATA.BASE_ADDRESSES[0], data)
+        peer.bus.write(PWM_USER_DATA_SIZE_ADDR, [len(data)])
+        peer.bus.write(PWM_USER_DATA_CMD_STS_ADDR, [PWM_USER_DATA_RX_DONE])
+        self.bus.write(PWM_USER_DATA_CMD_STS_ADDR, [PWM_USER_DATA_TX_DONE])
+        self.sim.stats["fifo_transfers"] += 1
+        self.sim.stats["fifo_bytes"] += len(data)
+
+
+class DPOFLinkSimulator:
+    """
+    Две платы, соединённые линией DPOF
+    channels - каналы DPOF, для которых есть линия (кодировщик i <-> декодер 2*i)
+    frame_period - период кадров TOD, с
+    delay - задержка линии в одну сторону, с
+    frame_loss - вероятность потери кадра TOD
+    fifo_corruption - вероятность порчи одного бита в передаче user data
+    byte_time - время передачи байта user data, с
+    """
+
+    def __init__(self, channels=(0,), frame_period=1.0, delay=0.001, frame_loss=0.0,
+                 fifo_corruption=0.0, byte_time=0.0005, seed=None):
+        self.channels = list(channels)
+        self.frame_period = frame_period
+        self.delay = delay
+        self.frame_loss = frame_loss
+        self.fifo_corruption = fifo_corruption
+        self.byte_time = byte_time
+        if seed is not None:
+            random.seed(seed)
+        self.stats = {"frames_sent": 0, "frames_lost": 0, "frames_decoded": 0,
+                      "frames_ignored": 0, "fifo_transfers": 0, "fifo_bytes": 0,
+                      "fifo_corrupted": 0}
+
+        self.events = []
+        self.event_seq = 0
+        self.events_cv = threading.Condition()
+        self.thread = None
+        self.running = False
+
+        self.models = [SimBoardModel(self, 0), SimBoardModel(self, 1)]
+        self.models[0].peer = self.models[1]
+        self.models[1].peer = self.models[0]
+        self.boards = [model.board for model in self.models]
+
+    def schedule(self, delay, callback):
+        with self.events_cv:
+            heapq.heappush(self.events, (time.monotonic() + delay, self.event_seq, callback))
+            self.event_seq += 1
+            self.events_cv.notify()
+
+    def _send_frames(self, model):
+        for channel in self.channels:
+            self.stats["frames_sent"] += 1
+            if random.random() < self.frame_loss:
+                self.stats["frames_lost"] += 1
+                continue
+            data = tod_to_bytes(model.tod_ns(channel))
+            peer = model.peer
+            self.schedule(self.delay, lambda peer=peer, decoder=2 * channel, data=data:
+                          self._deliver_frame(peer, decoder, data))
+        self.schedule(self.frame_period, lambda: self._send_frames(model))
+
+    def _deliver_frame(self, model, decoder_num, data):
+        if model.receive_frame(decoder_num, data):
+            self.stats["frames_decoded"] += 1
+        else:
+            self.stats["frames_ignored"] += 1
+
+    def _thread_main(self):
+        while True:
+            with self.events_cv:
+                while self.running:
+                    if self.events:
+                        wait = self.events[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self.events_cv.wait(wait)
+                    else:
+                        self.events_cv.wait()
+                if not self.running:
+                    return
+                _, _, callback = heapq.heappop(self.events)
+            callback()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        for index, model in enumerate(self.models):
+            model.board.init_pwm_dplloverfiber()
+            # кадры двух плат не совпадают по фазе
+            self.schedule(self.frame_period * (0.25 + 0.5 * index),
+                          lambda model=model: self._send_frames(model))
+        self.thread = threading.Thread(target=self._thread_main, daemon=True,
+                                       name="dpof_link_sim")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        with self.events_cv:
+            self.running = False
+            self.events_cv.notify()
+        self.thread.join()
+        self.thread = None
+        self.events = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+
+def benchmark_query_latency(sim, count=5, channel_num=0, timeout=120):
+    """
+    Запросы 0x0 с платы 0 на плату 1, возвращает список времён до ответа, с
+    """
+    latencies = []
+    board = sim.boards[0]
+    with DPOFRuntimeGroup(sim.boards) as runtimes:
+        for i in range(count):
+            deadline = time.monotonic() + timeout
+            while not board.dpof.dpof_query(channel_num, 0):
+                if time.monotonic() > deadline:
+                    return latencies
+                time.sleep(0.01)
+            start = time.monotonic()
+            while True:
+                if board.dpof.pop_query_data():
+                    latencies.append(time.monotonic() - start)
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"Query {i} timed out")
+                    return latencies
+                runtimes.wait_for_results(min(remaining, 0.1))
+    return latencies
+
+
+def benchmark_transport(sim, size=1000, channel_num=0, timeout=300):
+    """
+    Сообщение size байтов с платы 0 на плату 1 через DPOFMessageTransport
+    Возвращает (время доставки с или None, статистика отправителя, получателя)
+    """
+    sender = DPOFMessageTransport(sim.boards[0])
+    receiver = DPOFMessageTransport(sim.boards[1])
+    payload = bytes(random.randrange(256) for i in range(size))
+    try:
+        with DPOFRuntimeGroup(sim.boards):
+            start = time.monotonic()
+            sender.send(channel_num, payload)
+            message = receiver.receive(timeout)
+            elapsed = None
+            if message is not None and message.payload == payload:
+                elapsed = time.monotonic() - start
+    finally:
+        sender.close()
+        receiver.close()
+    return elapsed, sender.get_stats(), receiver.get_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Two board DPOF link simulator')
+    parser.add_argument('command', choices=['query', 'transport'])
+    parser.add_argument('--count', type=int, default=5, help='queries to time')
+    parser.add_argument('--size', type=int, default=1000, help='message bytes')
+    parser.add_argument('--frame-period', type=float, default=1.0)
+    parser.add_argument('--delay', type=float, default=0.001)
+    parser.add_argument('--frame-loss', type=float, default=0.0)
+    parser.add_argument('--fifo-corruption', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    with DPOFLinkSimulator(frame_period=args.frame_period, delay=args.delay,
+                           frame_loss=args.frame_loss,
+                           fifo_corruption=args.fifo_corruption, seed=args.seed) as sim:
+        if args.command == 'query':
+            latencies = benchmark_query_latency(sim, args.count)
+            print(f"Query latency: {['%.2f' % latency for latency in latencies]}")
+            if latencies:
+                print(f"Mean {sum(latencies) / len(latencies):.2f} s, max {max(latencies):.2f} s")
+        else:
+            elapsed, sent, received = benchmark_transport(sim, args.size)
+            if elapsed is None:
+                print("Message not delivered")
+            else:
+                print(f"{args.size} bytes in {elapsed:.2f} s, {args.size / elapsed:.1f} B/s")
+            print(f"Sender {sent}")
+            print(f"Receiver {received}")
+        print(f"Link {sim.stats}")
+        for board in sim.boards:
+            print(f"Board {board.board_num} decoders {board.dpof.get_decoder_stats()}")
+
+
+if __name__ == "__main__":
+    main()
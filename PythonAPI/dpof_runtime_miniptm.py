@@ -0,0 +1,107 @@
+
+import threading
+
+#########
+# Фоновое выполнение DPLL over fiber для одной платы
+# Вместо общего цикла с шагом 0.25 с каждая плата получает свой поток.
+# После каждого tick() поток ждёт столько, сколько нужно самому быстрому
+# каналу: опрос PWM_USER_DATA CMD_STS идёт часто, ожидание данных декодера
+# реже, простой ещё реже. dpof_query/dpof_write будят поток сразу.
+# Медленная плата больше не задерживает остальные.
+
+# Пауза после ошибки шины
+DPOF_RUNTIME_ERROR_BACKOFF_SEC = 0.1
+
+
+class DPOFRuntime:
+    """
+    Поток, выполняющий board.dpof.tick() по готовности каналов
+    results_event - общее для нескольких плат событие, выставляется когда
+    появились данные запроса, записи или сравнения TOD
+    """
+
+    def __init__(self, board, results_event=None):
+        self.board = board
+        self.dpof = board.dpof
+        self.results_event = results_event
+        self.thread = None
+        self.running = False
+        self.tick_count = 0
+        self.error_count = 0
+
+    def run_once(self):
+        """ Один tick, возвращает паузу до следующего в секундах """
+        self.dpof.tick()
+        self.tick_count += 1
+        if self.results_event is not None and self.dpof.has_results():
+            self.results_event.set()
+        return self.dpof.next_tick_interval()
+
+    def _thread_main(self):
+        while self.running:
+            try:
+                interval = self.run_once()
+            except OSError as e:
+                self.error_count += 1
+                print(f"Board {self.board.board_num} DPOF tick failed: {e}")
+                interval = DPOF_RUNTIME_ERROR_BACKOFF_SEC
+            if interval > 0:
+                self.dpof.wake_event.wait(interval)
+            self.dpof.wake_event.clear()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._thread_main, daemon=True,
+                                       name=f"dpof_{self.board.board_num}")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.dpof.wake_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None
+
+
+class DPOFRuntimeGroup:
+    """
+    DPOFRuntime для нескольких плат с общим событием результатов
+    Запуск через start()/stop() или with
+    """
+
+    def __init__(self, boards):
+        self.results_event = threading.Event()
+        self.runtimes = {board.board_num: DPOFRuntime(board, self.results_event)
+                         for board in boards}
+
+    def start(self):
+        for runtime in self.runtimes.values():
+            runtime.start()
+
+    def stop(self):
+        for runtime in self.runtimes.values():
+            runtime.stop()
+
+    def wait_for_results(self, timeout=None):
+        """ Ждать результатов от любой платы, True если они появились """
+        got_results = self.results_event.wait(timeout)
+        self.results_event.clear()
+        return got_results
+
+    def tick_counts(self):
+        return {board_num: runtime.tick_count
+                for board_num, runtime in self.runtimes.items()}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
@@ -0,0 +1,155 @@
+
+import time
+
+#########
+# Распределение единственного приёмного буфера PWM (0xCE80) между декодерами
+# Одновременно включён только один декодер. Вместо равных отрезков по 5 с
+# длина отрезка зависит от активности канала:
+#   - пока идёт рукопожатие, декодер не переключается (до max_slice_sec)
+#   - если за min_slice_sec не пришло ни одного кадра TOD, линия считается
+#     мёртвой и декодер переключается сразу; подряд мёртвые линии
+#     пропускаются в нескольких следующих обходах
+#   - после данных рукопожатия декодер держится ещё active_hold_sec
+#   - живая, но тихая линия получает base_slice_sec, увеличенный по
+#     недавней активности
+# Кадр TOD приходит раз в секунду, поэтому min_slice_sec больше секунды.
+
+DPOF_SLICE_MIN_SEC = 1.5
+DPOF_SLICE_BASE_SEC = 2.5
+DPOF_SLICE_MAX_SEC = 15
+DPOF_ACTIVE_HOLD_SEC = 5
+# Сглаживание числа рукопожатий за отрезок
+DPOF_ACTIVITY_ALPHA = 0.3
+# Мёртвая линия пропускается не больше чем в стольких обходах подряд
+DPOF_DEAD_SKIP_MAX = 3
+
+
+class DecoderStats:
+    """
+    Статистика одного декодера DPOF
+    frames - принятые кадры TOD, handshakes - новые байты рукопожатия
+    activity - сглаженное число рукопожатий за отрезок
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.slices = 0
+        self.time_on = 0.0
+        self.frames = 0
+        self.handshakes = 0
+        self.dead_slices = 0
+        self.consecutive_dead = 0
+        self.skip_remaining = 0
+        self.activity = 0.0
+        self.last_frame_time = None
+        self.last_handshake_time = None
+        # текущий отрезок
+        self.slice_start = None
+        self.slice_frames = 0
+        self.slice_handshakes = 0
+
+    def as_dict(self):
+        return {
+            "slices": self.slices,
+            "time_on": self.time_on,
+            "frames": self.frames,
+            "handshakes": self.handshakes,
+            "dead_slices": self.dead_slices,
+            "consecutive_dead": self.consecutive_dead,
+            "activity": self.activity,
+            "last_frame_time": self.last_frame_time,
+            "last_handshake_time": self.last_handshake_time,
+        }
+
+    def __repr__(self):
+        return (f"Decoder {self.decoder}: {self.slices} slices, {self.time_on:.1f} s on, "
+                f"{self.frames} frames, {self.handshakes} handshakes, "
+                f"{self.dead_slices} dead slices, activity {self.activity:.2f}")
+
+
+class DecoderScheduler:
+    """
+    Выбор включённого декодера и длины его отрезка для каналов DPOF_Top
+    Каналы сообщают о начале и конце отрезка и о принятых кадрах,
+    DPOF_Top спрашивает следующий канал при выключении декодера
+    """
+
+    def __init__(self, channels, min_slice_sec=DPOF_SLICE_MIN_SEC,
+                 base_slice_sec=DPOF_SLICE_BASE_SEC, max_slice_sec=DPOF_SLICE_MAX_SEC,
+                 active_hold_sec=DPOF_ACTIVE_HOLD_SEC):
+        self.channels = channels
+        self.min_slice_sec = min_slice_sec
+        self.base_slice_sec = base_slice_sec
+        self.max_slice_sec = max_slice_sec
+        self.active_hold_sec = active_hold_sec
+        self.stats = {chan.decoder: DecoderStats(chan.decoder) for chan in channels}
+
+    def on_slice_start(self, chan):
+        stats = self.stats[chan.decoder]
+        stats.slice_start = time.time()
+        stats.slice_frames = 0
+        stats.slice_handshakes = 0
+
+    def on_slice_end(self, chan):
+        stats = self.stats[chan.decoder]
+        if stats.slice_start is None:
+            return
+        stats.slices += 1
+        stats.time_on += time.time() - stats.slice_start
+        stats.slice_start = None
+        stats.activity += DPOF_ACTIVITY_ALPHA * (stats.slice_handshakes - stats.activity)
+        if stats.slice_frames == 0:
+            stats.dead_slices += 1
+            stats.consecutive_dead += 1
+            stats.skip_remaining = min(stats.consecutive_dead - 1, DPOF_DEAD_SKIP_MAX)
+        else:
+            stats.consecutive_dead = 0
+            stats.skip_remaining = 0
+
+    def on_frame(self, chan, handshake):
+        """ Принят кадр TOD, handshake - в нём новые байты рукопожатия """
+        stats = self.stats[chan.decoder]
+        now = time.time()
+        stats.frames += 1
+        stats.slice_frames += 1
+        stats.last_frame_time = now
+        if handshake:
+            stats.handshakes += 1
+            stats.slice_handshakes += 1
+            stats.last_handshake_time = now
+
+    def slice_limit(self, chan):
+        """ Длина текущего отрезка декодера канала в секундах """
+        stats = self.stats[chan.decoder]
+        if not chan.is_idle():
+            # рукопожатие не закончено, держим декодер
+            return self.max_slice_sec
+        if stats.slice_frames == 0:
+            return self.min_slice_sec
+        limit = self.base_slice_sec * (1 + stats.activity)
+        if stats.slice_handshakes and stats.slice_start is not None:
+            limit = max(limit, stats.last_handshake_time - stats.slice_start
+                        + self.active_hold_sec)
+        return min(limit, self.max_slice_sec)
+
+    def next_channel(self, current_index):
+        """
+        Номер следующего канала для приёма
+        Сначала каналы с незаконченным рукопожатием, потом по кругу,
+        пропуская недавно мёртвые линии
+        """
+        count = len(self.channels)
+        order = [(current_index + step) % count for step in range(1, count + 1)]
+        for index in order[:-1]:
+            if not self.channels[index].is_idle():
+                return index
+        for index in order:
+            stats = self.stats[self.channels[index].decoder]
+            if stats.skip_remaining > 0:
+                stats.skip_remaining -= 1
+                continue
+            return index
+        return order[0]
+
+    def get_stats(self):
+        return {decoder: stats.as_dict() for decoder, stats in self.stats.items()}
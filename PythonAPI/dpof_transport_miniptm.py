@@ -0,0 +1,349 @@
+
+import queue
+import threading
+import time
+from collections import deque
+
+from renesas_cm_registers import EEPROM_DATA_FIFO_SIZE
+
+#########
+# Передача сообщений произвольной длины поверх DPOF_Top.dpof_write
+# Сообщение режется на кадры размером с FIFO PWM user data, каждый кадр
+# уходит отдельной транзакцией записи. Кадр:
+#   [0] номер сообщения, [1] номер кадра, [2] число кадров, [3] тип,
+#   [4:-2] данные, [-2:] CRC-16/CCITT кадра (младший байт первым)
+# Транзакции записи с номерами 8-15 зарезервированы под кадры сообщений,
+# номер транзакции - порядковый номер кадра по модулю 8.
+# FIFO на плате один, поэтому на канал в полёте не больше одного кадра,
+# но каналы к разным соседям идут параллельно, и следующий кадр стартует
+# в том же tick, в котором закончился предыдущий, без участия верхнего уровня.
+# Кадр, проигравший согласование (запись отброшена), отправляется заново.
+# Приёмная сторона проверяет CRC, отбрасывает повторы и собирает сообщение,
+# затем отвечает однокадровым сообщением подтверждения (тип 0xFF). Кадр с
+# ошибкой CRC отбрасывается, сообщение без подтверждения за
+# DPOF_MSG_ACK_TIMEOUT_SEC отправляется целиком заново.
+
+DPOF_MSG_HEADER_BYTES = 4
+DPOF_MSG_CRC_BYTES = 2
+DPOF_MSG_FRAME_PAYLOAD = EEPROM_DATA_FIFO_SIZE - DPOF_MSG_HEADER_BYTES - DPOF_MSG_CRC_BYTES
+DPOF_MSG_MAX_FRAMES = 255
+DPOF_MSG_MAX_SIZE = DPOF_MSG_FRAME_PAYLOAD * DPOF_MSG_MAX_FRAMES
+
+DPOF_MSG_WRITE_ID_BASE = 8
+DPOF_MSG_WRITE_IDS = tuple(range(DPOF_MSG_WRITE_ID_BASE, 16))
+
+# Тип сообщения подтверждения, данные - номер подтверждаемого сообщения
+DPOF_MSG_TYPE_ACK = 0xFF
+
+DPOF_MSG_MAX_RETRIES = 5
+# Сообщение без подтверждения отправляется заново через столько секунд
+# после последнего кадра (подтверждению нужно встречное рукопожатие)
+DPOF_MSG_ACK_TIMEOUT_SEC = 60
+DPOF_MSG_MAX_RESENDS = 3
+# Недособранное сообщение выбрасывается, если кадров нет столько секунд
+DPOF_MSG_REASSEMBLY_TIMEOUT_SEC = 120
+# Сколько последних собранных сообщений помнить для отброса повторов
+DPOF_MSG_RECENT = 16
+
+
+def crc16_ccitt(data, crc=0xFFFF):
+    """ CRC-16/CCITT-FALSE, полином 0x1021 """
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def fragment_message(msg_id, msg_type, payload):
+    """ Кадры сообщения, каждый не длиннее FIFO """
+    if len(payload) > DPOF_MSG_MAX_SIZE:
+        raise ValueError(f"DPOF message {len(payload)} bytes, max {DPOF_MSG_MAX_SIZE}")
+    chunks = [payload[pos:pos + DPOF_MSG_FRAME_PAYLOAD]
+              for pos in range(0, len(payload), DPOF_MSG_FRAME_PAYLOAD)] or [b""]
+    frames = []
+    for index, chunk in enumerate(chunks):
+        frame = [msg_id & 0xff, index, len(chunks), msg_type & 0xff] + list(chunk)
+        crc = crc16_ccitt(frame)
+        frames.append(frame + [crc & 0xff, crc >> 8])
+    return frames
+
+
+def parse_frame(frame):
+    """ (номер сообщения, номер кадра, число кадров, тип, данные) или None при ошибке """
+    if len(frame) < DPOF_MSG_HEADER_BYTES + DPOF_MSG_CRC_BYTES:
+        return None
+    crc = frame[-2] | (frame[-1] << 8)
+    if crc16_ccitt(frame[:-2]) != crc:
+        return None
+    msg_id, index, count, msg_type = frame[:DPOF_MSG_HEADER_BYTES]
+    if count == 0 or index >= count:
+        return None
+    return msg_id, index, count, msg_type, bytes(frame[DPOF_MSG_HEADER_BYTES:-2])
+
+
+class DPOFMessage:
+    """ Собранное сообщение от соседа на канале channel_num (декодер decoder) """
+
+    def __init__(self, board_num, decoder, msg_id, msg_type, payload):
+        self.board_num = board_num
+        self.decoder = decoder
+        self.channel_num = decoder // 2
+        self.msg_id = msg_id
+        self.msg_type = msg_type
+        self.payload = payload
+        self.host_time = time.time()
+
+    def __repr__(self):
+        return (f"DPOFMessage(board {self.board_num}, decoder {self.decoder}, "
+                f"id {self.msg_id}, type {self.msg_type}, {len(self.payload)} bytes)")
+
+
+class MessageReassembler:
+    """ Сборка сообщений из кадров, отдельно для каждого декодера """
+
+    def __init__(self):
+        self.partial = {}       # (декодер, номер) -> [тип, число кадров, {номер кадра: данные}, время]
+        self.recent = {}        # декодер -> deque номеров собранных сообщений
+
+    def is_complete(self, decoder, msg_id):
+        """ Сообщение уже собрано, кадр - повтор """
+        return msg_id in self.recent.get(decoder, ())
+
+    def push(self, decoder, parsed):
+        """ Возвращает (тип, данные) когда сообщение собрано, иначе None """
+        msg_id, index, count, msg_type, data = parsed
+        recent = self.recent.setdefault(decoder, deque(maxlen=DPOF_MSG_RECENT))
+        if msg_id in recent:
+            # повтор кадра уже собранного сообщения
+            return None
+        key = (decoder, msg_id)
+        entry = self.partial.get(key)
+        if entry is None or entry[0] != msg_type or entry[1] != count:
+            entry = [msg_type, count, {}, time.time()]
+            self.partial[key] = entry
+        entry[2][index] = data
+        entry[3] = time.time()
+        if len(entry[2]) < count:
+            return None
+        del self.partial[key]
+        recent.append(msg_id)
+        return msg_type, b"".join(entry[2][i] for i in range(count))
+
+    def expire(self, timeout=DPOF_MSG_REASSEMBLY_TIMEOUT_SEC):
+        """ Выбросить давно не пополнявшиеся сообщения, возвращает их число """
+        now = time.time()
+        stale = [key for key, entry in self.partial.items() if now - entry[3] > timeout]
+        for key in stale:
+            del self.partial[key]
+        return len(stale)
+
+
+class ChannelSender:
+    """ Очередь кадров одного канала DPOF и кадр в полёте """
+
+    def __init__(self):
+        self.frames = deque()   # (номер сообщения, кадр)
+        self.frame_seq = 0
+        self.in_flight = None   # (номер сообщения, кадр, tx_done_count на старте)
+        self.retries = 0
+
+
+class DPOFMessageTransport:
+    """
+    Сообщения между платами поверх DPOF_Top одной платы
+    send() ставит сообщение в очередь канала, отправка и приём идут
+    в tick() DPOF (обычно в потоке DPOFRuntime). Собранные сообщения
+    приходят подписчикам callback(DPOFMessage) и в receive()
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.dpof = board.dpof
+        self.senders = [ChannelSender() for _ in self.dpof.channels]
+        self.reassembler = MessageReassembler()
+        self.next_msg_id = 0
+        # номер сообщения -> [канал, кадры, срок подтверждения или None, повторов]
+        self.unacked = {}
+        self.received = queue.Queue()
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.stats = {
+            "messages_sent": 0,
+            "messages_resent": 0,
+            "messages_dropped": 0,
+            "frames_sent": 0,
+            "frames_retried": 0,
+            "messages_received": 0,
+            "frames_received": 0,
+            "frames_bad_crc": 0,
+            "messages_expired": 0,
+        }
+        self.dpof.add_tick_listener(self._on_tick)
+
+    def close(self):
+        self.dpof.remove_tick_listener(self._on_tick)
+
+    def send(self, channel_num, payload, msg_type=0):
+        """
+        Поставить сообщение в очередь канала channel_num
+        Возвращает номер сообщения
+        """
+        if msg_type == DPOF_MSG_TYPE_ACK:
+            raise ValueError(f"DPOF message type 0x{DPOF_MSG_TYPE_ACK:02x} is reserved")
+        with self.dpof.lock:
+            msg_id = self._queue_message(channel_num, msg_type, bytes(payload))
+            self._pump(channel_num)
+        return msg_id
+
+    def _queue_message(self, channel_num, msg_type, payload):
+        msg_id = self.next_msg_id
+        self.next_msg_id = (self.next_msg_id + 1) & 0xff
+        frames = fragment_message(msg_id, msg_type, payload)
+        if msg_type != DPOF_MSG_TYPE_ACK:
+            self.unacked[msg_id] = [channel_num, frames, None, 0]
+        sender = self.senders[channel_num]
+        for frame in frames:
+            sender.frames.append((msg_id, frame))
+        return msg_id
+
+    def unacknowledged(self):
+        """ Номера отправленных, но ещё не подтверждённых сообщений """
+        with self.dpof.lock:
+            return sorted(self.unacked)
+
+    def pending(self, channel_num=None):
+        """ Число кадров в очереди и в полёте """
+        with self.dpof.lock:
+            senders = self.senders if channel_num is None else [self.senders[channel_num]]
+            return sum(len(sender.frames) + (sender.in_flight is not None)
+                       for sender in senders)
+
+    def subscribe(self, callback):
+        with self.subscribers_lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.subscribers_lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def receive(self, timeout=None):
+        """ Следующее собранное сообщение или None по таймауту """
+        try:
+            return self.received.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_stats(self):
+        with self.dpof.lock:
+            return dict(self.stats)
+
+    ############ внутри tick, под dpof.lock
+
+    def _on_tick(self, dpof):
+        self._drain_received()
+        self._resend_unacked()
+        for channel_num in range(len(self.senders)):
+            self._pump(channel_num)
+
+    def _resend_unacked(self):
+        now = time.monotonic()
+        for msg_id, entry in list(self.unacked.items()):
+            channel_num, frames, deadline, resends = entry
+            if deadline is None or now < deadline:
+                continue
+            if resends >= DPOF_MSG_MAX_RESENDS:
+                print(f"Board {self.board.board_num} DPOF channel {channel_num} "
+                      f"message {msg_id} not acknowledged, dropped")
+                del self.unacked[msg_id]
+                self.stats["messages_dropped"] += 1
+                continue
+            entry[2] = None
+            entry[3] += 1
+            self.stats["messages_resent"] += 1
+            sender = self.senders[channel_num]
+            for frame in frames:
+                sender.frames.append((msg_id, frame))
+
+    def _drop_message(self, channel_num, msg_id):
+        sender = self.senders[channel_num]
+        sender.frames = deque(item for item in sender.frames if item[0] != msg_id)
+        if self.unacked.pop(msg_id, None) is not None:
+            self.stats["messages_dropped"] += 1
+
+    def _pump(self, channel_num):
+        sender = self.senders[channel_num]
+        chan = self.dpof.channels[channel_num]
+        if not chan.can_tx():
+            return
+        if sender.in_flight is not None:
+            msg_id, frame, done_count = sender.in_flight
+            sender.in_flight = None
+            if chan.tx_done_count > done_count:
+                # far side answered 0x2, frame delivered
+                self.stats["frames_sent"] += 1
+                sender.retries = 0
+                entry = self.unacked.get(msg_id)
+                if entry is not None and frame[1] == frame[2] - 1:
+                    # last frame of the message, now wait for the ack
+                    entry[2] = time.monotonic() + DPOF_MSG_ACK_TIMEOUT_SEC
+            elif sender.retries < DPOF_MSG_MAX_RETRIES:
+                # lost negotiation, write was discarded
+                sender.retries += 1
+                self.stats["frames_retried"] += 1
+                sender.frames.appendleft((msg_id, frame))
+            else:
+                print(f"Board {self.board.board_num} DPOF channel {channel_num} "
+                      f"message {msg_id} dropped after {DPOF_MSG_MAX_RETRIES} retries")
+                sender.retries = 0
+                self._drop_message(channel_num, msg_id)
+        if not sender.frames:
+            return
+        msg_id, frame = sender.frames[0]
+        write_id = DPOF_MSG_WRITE_ID_BASE + (sender.frame_seq % len(DPOF_MSG_WRITE_IDS))
+        if self.dpof.dpof_write(channel_num, write_id, frame):
+            sender.frames.popleft()
+            sender.frame_seq += 1
+            sender.in_flight = (msg_id, frame, chan.tx_done_count)
+
+    def _drain_received(self):
+        while True:
+            write_data = self.dpof.pop_write_data(DPOF_MSG_WRITE_IDS)
+            if not write_data:
+                break
+            decoder, write_id, fifo_data = write_data
+            parsed = parse_frame(fifo_data)
+            if parsed is None:
+                self.stats["frames_bad_crc"] += 1
+                continue
+            self.stats["frames_received"] += 1
+            msg_id, index, count, msg_type, data = parsed
+            if self.reassembler.is_complete(decoder, msg_id):
+                # our ack got lost and the far side resent, ack again
+                if msg_type != DPOF_MSG_TYPE_ACK and index == count - 1:
+                    self._queue_message(decoder // 2, DPOF_MSG_TYPE_ACK, bytes([msg_id]))
+                continue
+            done = self.reassembler.push(decoder, parsed)
+            if done is None:
+                continue
+            msg_type, payload = done
+            if msg_type == DPOF_MSG_TYPE_ACK:
+                if payload and self.unacked.pop(payload[0], None) is not None:
+                    self.stats["messages_sent"] += 1
+                continue
+            self.stats["messages_received"] += 1
+            self._queue_message(decoder // 2, DPOF_MSG_TYPE_ACK, bytes([msg_id]))
+            self._deliver(DPOFMessage(self.board.board_num, decoder,
+                                      msg_id, msg_type, payload))
+        self.stats["messages_expired"] += self.reassembler.expire()
+
+    def _deliver(self, message):
+        self.received.put(message)
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(message)
@@ -0,0 +1,366 @@
+
+import heapq
+import math
+from array import array
+
+#########
+# Фильтры для длительных измерений
+# Все фильтры имеют фиксированную память: кольцевой буфер заданного
+# размера или накопленные суммы. Обновление O(1), медиана O(log n)
+# (перестройка куч раз в window обновлений).
+
+
+class RingBuffer:
+    """
+    Кольцевой буфер фиксированного размера
+    append возвращает вытесненное значение или None
+    typecode - хранить числа в array(typecode) вместо списка объектов
+    """
+
+    def __init__(self, capacity, typecode=None):
+        self.capacity = capacity
+        self.typecode = typecode
+        self.values = self._storage()
+        self.head = 0       # индекс следующей записи
+        self.count = 0
+
+    def _storage(self):
+        if self.typecode is None:
+            return [None] * self.capacity
+        return array(self.typecode, bytes(array(self.typecode).itemsize * self.capacity))
+
+    def append(self, value):
+        evicted = None
+        if self.count == self.capacity:
+            evicted = self.values[self.head]
+        else:
+            self.count += 1
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        return evicted
+
+    def clear(self):
+        if self.typecode is None:
+            # не держим ссылки на вытесненные объекты
+            self.values = self._storage()
+        self.head = 0
+        self.count = 0
+
+    def newest(self):
+        if self.count == 0:
+            return None
+        return self.values[(self.head - 1) % self.capacity]
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.values[(self.head - self.count) % self.capacity]
+
+    def is_full(self):
+        return self.count == self.capacity
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ От старого к новому """
+        for i in range(self.count):
+            yield self.values[(self.head - self.count + i) % self.capacity]
+
+    def __reversed__(self):
+        """ От нового к старому """
+        for i in range(self.count):
+            yield self.values[(self.head - 1 - i) % self.capacity]
+
+
+class RunningStats:
+    """
+    Среднее и дисперсия по алгоритму Уэлфорда, без хранения отсчётов
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        """ Выборочная дисперсия, 0 если отсчётов меньше двух """
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+
+class WindowedStats:
+    """
+    Среднее и дисперсия по последним window отсчётам
+    Уэлфорд с добавлением нового и удалением вытесненного отсчёта
+    """
+
+    def __init__(self, window):
+        self.buffer = RingBuffer(window)
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def clear(self):
+        self.buffer.clear()
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        evicted = self.buffer.append(value)
+        count = len(self.buffer)
+        if evicted is not None:
+            # замена отсчёта: среднее и M2 сдвигаются за один шаг
+            old_mean = self.mean
+            self.mean += (value - evicted) / count
+            self.m2 += (value - evicted) * (value - self.mean + evicted - old_mean)
+        else:
+            delta = value - self.mean
+            self.mean += delta / count
+            self.m2 += delta * (value - self.mean)
+        if self.m2 < 0:
+            # погрешность округления
+            self.m2 = 0.0
+
+    @property
+    def count(self):
+        return len(self.buffer)
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+
+class WindowedMedian:
+    """
+    Медиана последних window отсчётов
+    Две кучи (нижняя половина - max-куча, верхняя - min-куча) с ленивым
+    удалением вытесненных отсчётов, обновление O(log n)
+    Каждый отсчёт помечен номером, по нему известно, в какой куче он лежит
+    """
+
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, window):
+        self.buffer = RingBuffer(window)
+        self.clear()
+
+    def clear(self):
+        self.buffer.clear()
+        self.low = []       # (-значение, номер)
+        self.high = []      # (значение, номер)
+        self.low_size = 0   # без учёта удалённых, ещё лежащих в куче
+        self.high_size = 0
+        self.side = {}      # номер -> LOW/HIGH
+        self.removed = set()
+        self.sequence = 0
+
+    def _prune(self, heap):
+        while heap and heap[0][1] in self.removed:
+            self.removed.discard(heapq.heappop(heap)[1])
+
+    def _move(self, src, dst, dst_side):
+        value, seq = heapq.heappop(src)
+        heapq.heappush(dst, (-value, seq))
+        self.side[seq] = dst_side
+        self._prune(src)
+
+    def update(self, value):
+        seq = self.sequence
+        self.sequence += 1
+        evicted = self.buffer.append((value, seq))
+
+        if self.low_size and value <= -self.low[0][0]:
+            heapq.heappush(self.low, (-value, seq))
+            self.side[seq] = self.LOW
+            self.low_size += 1
+        else:
+            heapq.heappush(self.high, (value, seq))
+            self.side[seq] = self.HIGH
+            self.high_size += 1
+
+        if evicted is not None:
+            evicted_seq = evicted[1]
+            self.removed.add(evicted_seq)
+            if self.side.pop(evicted_seq) == self.LOW:
+                self.low_size -= 1
+            else:
+                self.high_size -= 1
+            self._prune(self.low)
+            self._prune(self.high)
+
+        if len(self.removed) > self.buffer.capacity:
+            self._compact()
+
+        while self.low_size > self.high_size + 1:
+            self._move(self.low, self.high, self.HIGH)
+            self.low_size -= 1
+            self.high_size += 1
+        while self.high_size > self.low_size:
+            self._move(self.high, self.low, self.LOW)
+            self.high_size -= 1
+            self.low_size += 1
+
+    def _compact(self):
+        """ Удалённые отсчёты глубоко в кучах, перестраиваем кучи, O(n) раз в n обновлений """
+        self.low = [entry for entry in self.low if entry[1] not in self.removed]
+        self.high = [entry for entry in self.high if entry[1] not in self.removed]
+        heapq.heapify(self.low)
+        heapq.heapify(self.high)
+        self.removed.clear()
+
+    @property
+    def count(self):
+        return len(self.buffer)
+
+    def median(self):
+        """ Медиана окна, None если отсчётов нет """
+        if self.low_size == 0:
+            return None
+        if self.low_size > self.high_size:
+            return -self.low[0][0]
+        return (-self.low[0][0] + self.high[0][0]) / 2
+
+
+class OutlierRejectFilter:
+    """
+    Отбраковка выбросов относительно медианы окна принятых отсчётов
+    Отсчёт отбрасывается, если отличается от медианы больше чем на
+    threshold стандартных отклонений окна (но не меньше min_spread,
+    иначе окно одинаковых отсчётов отбрасывает всё остальное)
+    Первые min_count отсчётов принимаются без проверки
+    После max_rejects отброшенных подряд уровень считается сменившимся:
+    окно заполняется заново этими отсчётами
+    """
+
+    def __init__(self, window=16, threshold=4.0, min_spread=1.0, min_count=4,
+                 max_rejects=8):
+        """
+        min_spread - наименьшее допустимое отклонение от медианы, в единицах
+                     отсчётов, должно быть больше нуля
+        max_rejects - число отброшенных подряд отсчётов до смены уровня
+        """
+        if min_spread <= 0:
+            raise ValueError(f"min_spread must be positive, got {min_spread}")
+        self.median_filter = WindowedMedian(window)
+        self.stats = WindowedStats(window)
+        self.threshold = threshold
+        self.min_spread = min_spread
+        self.min_count = min_count
+        self.recent_rejects = RingBuffer(max(1, min(max_rejects, window)))
+        self.rejected = 0
+        self.level_shifts = 0
+
+    def clear(self):
+        self.median_filter.clear()
+        self.stats.clear()
+        self.recent_rejects.clear()
+        self.rejected = 0
+        self.level_shifts = 0
+
+    def is_outlier(self, value):
+        if self.stats.count < self.min_count:
+            return False
+        spread = max(self.threshold * self.stats.stddev(), self.min_spread)
+        return abs(value - self.median_filter.median()) > spread
+
+    def _accept(self, value):
+        self.median_filter.update(value)
+        self.stats.update(value)
+
+    def update(self, value):
+        """ Возвращает True если отсчёт принят """
+        if not self.is_outlier(value):
+            self.recent_rejects.clear()
+            self._accept(value)
+            return True
+        self.recent_rejects.append(value)
+        if not self.recent_rejects.is_full():
+            self.rejected += 1
+            return False
+        # отброшенные подряд отсчёты - новый уровень, окно заново с них
+        values = list(self.recent_rejects)
+        self.median_filter.clear()
+        self.stats.clear()
+        self.recent_rejects.clear()
+        for recent in values:
+            self._accept(recent)
+        self.level_shifts += 1
+        return True
+
+    def median(self):
+        return self.median_filter.median()
+
+    def mean(self):
+        if self.stats.count == 0:
+            return None
+        return self.stats.mean
+
+
+class AverageFilter:
+    """
+    Накопительное среднее до сброса, память O(1)
+    """
+
+    def __init__(self):
+        self.stats = RunningStats()
+
+    def update(self, value):
+        self.stats.update(value)
+
+    def get_count(self):
+        return self.stats.count
+
+    def has_data(self):
+        return self.stats.count > 0
+
+    def get_average(self, clear_avg=False):
+        if self.stats.count:
+            avg = self.stats.mean
+            if clear_avg:
+                self.stats.clear()
+            return avg
+        return 0
+
+
+class MovingAverageFilter:
+    """
+    Скользящее среднее по window_size отсчётам
+    Отсчёт, отличающийся от предыдущего среднего больше чем на
+    outlier_percentage процентов, игнорируется
+    """
+
+    def __init__(self, window_size=5, outlier_percentage=50):
+        self.window_size = window_size
+        self.outlier_percentage = outlier_percentage / 100.0
+        self.stats = WindowedStats(window_size)
+        self.previous_average = None
+
+    def update(self, new_sample):
+        if self.previous_average is not None and self.previous_average != 0:
+            percentage_change = abs(
+                new_sample - self.previous_average) / abs(self.previous_average)
+
+            if percentage_change > self.outlier_percentage:
+                return self.previous_average  # выброс, возвращаем прежнее среднее
+
+        self.stats.update(new_sample)
+        self.previous_average = self.stats.mean
+        return self.previous_average
@@ -0,0 +1,149 @@
+
+import threading
+import time
+
+from tod_capture_miniptm import TODCaptureService
+
+#########
+# Сходимость frame sync на всех платах одновременно
+# Для каждой платы: режим frame sync на выбранных DPLL и импульс
+# синхронизации, затем TOD по петлевому входу clkin должен несколько раз
+# подряд отличаться ровно на 1e9 нс. После этого frame sync выключается и
+# проверяется ещё один фронт, при ошибке всё начинается заново.
+# Захваты TOD для всех плат идут через один TODCaptureService.
+
+FRAME_SYNC_SYNCING = "syncing"
+FRAME_SYNC_VERIFYING = "verifying"
+FRAME_SYNC_DONE = "done"
+
+NS_PER_SECOND = 1000000000
+
+
+class FrameSyncJob:
+    """
+    Состояние сходимости frame sync одной платы
+    Вызывается из потока захвата этой платы, поэтому запись регистров
+    не пересекается с опросом TOD
+    """
+
+    def __init__(self, board, dpll_nums, good_count_threshold=10, on_progress=None):
+        self.board = board
+        self.dpll_nums = list(dpll_nums)
+        self.good_count_threshold = good_count_threshold
+        self.on_progress = on_progress
+        self.state = FRAME_SYNC_SYNCING
+        self.good_count = 0
+        self.restarts = 0
+        self.last_tod_ns = None
+        self.done_event = threading.Event()
+
+    def set_frame_sync_mode(self, enable):
+        for dpll_num in self.dpll_nums:
+            self.board.dpll.modules["DPLL_Config"].write_field(dpll_num,
+                    "DPLL_CTRL_2", "FRAME_SYNC_MODE", 1 if enable else 0)
+            if enable:
+                self.board.dpll.modules["DPLL_Ctrl"].write_reg(dpll_num,
+                        "DPLL_FRAME_PULSE_SYNC", 0x1)
+
+    def start(self):
+        self.set_frame_sync_mode(True)
+
+    def restart(self):
+        self.set_frame_sync_mode(True)
+        self.state = FRAME_SYNC_SYNCING
+        self.good_count = 0
+        self.last_tod_ns = None
+        self.restarts += 1
+
+    def on_capture(self, capture):
+        if self.state == FRAME_SYNC_DONE:
+            return
+        # Интервал считается только между соседними фронтами
+        exact = (self.last_tod_ns is not None and capture.missed == 0
+                 and capture.tod_ns - self.last_tod_ns == NS_PER_SECOND)
+
+        if self.state == FRAME_SYNC_SYNCING:
+            if exact:
+                self.good_count += 1
+            if self.good_count >= self.good_count_threshold:
+                # достаточно точных секунд, выключаем frame sync и проверяем
+                self.set_frame_sync_mode(False)
+                self.state = FRAME_SYNC_VERIFYING
+        elif self.state == FRAME_SYNC_VERIFYING:
+            if exact:
+                self.state = FRAME_SYNC_DONE
+                self.done_event.set()
+            else:
+                print(f"Board {self.board.board_num} frame sync lost after disable, restart")
+                self.restart()
+                self.report()
+                return
+
+        self.last_tod_ns = capture.tod_ns
+        self.report()
+
+    def report(self):
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def __repr__(self):
+        return (f"Board {self.board.board_num} frame sync {self.state}, "
+                f"{self.good_count}/{self.good_count_threshold} exact seconds, "
+                f"{self.restarts} restarts")
+
+
+class FrameSyncCoordinator:
+    """
+    Сходимость frame sync для всех плат сразу
+    dpll_frame_sync - список DPLL для всех плат или словарь номер платы -> список
+    """
+
+    def __init__(self, boards, tod_num=0, dpll_frame_sync=(0,), clkin=13,
+                 good_count_threshold=10, verbose=True):
+        self.boards = boards
+        self.tod_num = tod_num
+        self.clkin = clkin
+        self.verbose = verbose
+        self.jobs = {}
+        for board in boards:
+            if isinstance(dpll_frame_sync, dict):
+                dpll_nums = dpll_frame_sync[board.board_num]
+            else:
+                dpll_nums = dpll_frame_sync
+            self.jobs[board.board_num] = FrameSyncJob(board, dpll_nums,
+                                                      good_count_threshold,
+                                                      self.print_progress)
+
+    def print_progress(self, job):
+        if self.verbose:
+            print(job)
+
+    def _dispatch(self, capture):
+        self.jobs[capture.board_num].on_capture(capture)
+
+    def progress(self):
+        """ Словарь номер платы -> (состояние, точных секунд, перезапусков) """
+        return {board_num: (job.state, job.good_count, job.restarts)
+                for board_num, job in self.jobs.items()}
+
+    def run(self, timeout=30):
+        """
+        Запуск на всех платах, ожидание до timeout секунд
+        Возвращает словарь номер платы -> True если frame sync сошёлся
+        """
+        service = TODCaptureService(self.boards, (self.tod_num,), True, False, self.clkin)
+        service.subscribe(self._dispatch)
+        for job in self.jobs.values():
+            job.start()
+
+        deadline = time.monotonic() + timeout
+        with service:
+            for job in self.jobs.values():
+                job.done_event.wait(max(0, deadline - time.monotonic()))
+
+        results = {board_num: job.state == FRAME_SYNC_DONE
+                   for board_num, job in self.jobs.items()}
+        for board_num, job in self.jobs.items():
+            if not results[board_num]:
+                print(f"Board {board_num} frame sync timed out: {job}")
+        return results
@@ -4,23 +4,28 @@ import glob
 import smbus2  # Библиотека для работы с I2C/SMBus
 import struct
 import math
+import threading
+import functools
 
 # Константы для адресов I2C модуля SFP
 SFP_ADDRESS_A0 = 0x50  # Адрес для серийного ID и информации о производителе
 SFP_ADDRESS_A2 = 0x51  # Адрес для диагностической информации
 
+SMBUS_BLOCK_MAX = 32   # Максимальная длина блочной транзакции SMBus
 
 
 
-def find_i2c_buses(adapter_name):
+
+def find_i2c_buses(adapter_name, sysfs_root='/sys'):
     """
     Поиск I2C шин по имени адаптера
     adapter_name - имя адаптера для поиска
+    sysfs_root - корень sysfs
     Возвращает список номеров найденных I2C шин
     """
     i2c_buses = []
     # Путь к информации об адаптерах I2C в sysfs
-    i2c_adapter_path = '/sys/class/i2c-adapter/*'
+    i2c_adapter_path = os.path.join(sysfs_root, 'class', 'i2c-adapter', '*')
     for i2c_bus_path in glob.glob(i2c_adapter_path):
         try:
             # Читаем имя адаптера из файла
@@ -36,6 +41,17 @@ def find_i2c_buses(adapter_name):
     return i2c_buses
 
 
+def bus_locked(func):
+    """
+    Декоратор: метод выполняется под блокировкой шины self.lock
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class miniptm_i2c:
     """
     Класс для работы с I2C интерфейсом платы MiniPTM
@@ -51,6 +67,9 @@ class miniptm_i2c:
         self.MUX_ADDRESS = 0x70     # Адрес мультиплексора I2C
         self.cur_base_addr = None   # Текущий базовый адрес (используется кодом DPLL)
         self.cur_mux_open = 0       # Текущее состояние мультиплексора
+        # Выбор страницы и обращение - две транзакции, между ними шину
+        # не должен занять другой поток
+        self.lock = threading.RLock()
 
     def __str__(self):
         return "MiniPTM i2c"
@@ -67,6 +86,7 @@ class miniptm_i2c:
             self.cur_mux_open = 0x8
         self.cur_base_addr = None
 
+    @bus_locked
     def write_dpll_reg(self, base_addr, offset, value):
         """
         Запись в регистр DPLL
@@ -89,6 +109,7 @@ class miniptm_i2c:
         self.bus.write_byte_data(self.DPLL_ADDRESS, baseaddr_lower, value)
         #print(f"Write DPLL register, module {base_addr:#04x}, addr {offset:#02x} = {value:#02x}")
 
+    @bus_locked
     def write_dpll_reg_direct(self, addr, value):
         """
         Прямая запись в регистр DPLL по абсолютному адресу
@@ -107,6 +128,18 @@ class miniptm_i2c:
 
         self.bus.write_byte_data(self.DPLL_ADDRESS, baseaddr_lower, value)
 
+    @bus_locked
+    def write_dpll_reg_current_page(self, addr, value):
+        """
+        Запись в регистр DPLL одной I2C транзакцией, без записи регистра страницы
+        Страница addr должна быть выбрана предыдущим обращением к ней
+        Используется там, где важен момент записи (защёлкивание TOD)
+        addr - абсолютный адрес регистра
+        value - записываемое значение
+        """
+        self.bus.write_byte_data(self.DPLL_ADDRESS, addr & 0xff, value)
+
+    @bus_locked
     def write_dpll_multiple(self, addr, data_bytes):
         """
         Запись нескольких байтов в DPLL начиная с указанного адреса
@@ -126,7 +159,26 @@ class miniptm_i2c:
         self.bus.write_i2c_block_data(
             self.DPLL_ADDRESS, baseaddr_lower, data_bytes)
 
+    @bus_locked
+    def write_dpll_block(self, addr, data_bytes):
+        """
+        Запись блока произвольной длины в DPLL
+        Блок делится на транзакции не длиннее SMBUS_BLOCK_MAX байтов,
+        которые не пересекают границу страницы в 256 байтов
+        addr - начальный адрес
+        data_bytes - байты для записи (list, bytes или memoryview)
+        """
+        pos = 0
+        while pos < len(data_bytes):
+            cur_addr = addr + pos
+            chunk_len = min(SMBUS_BLOCK_MAX, len(data_bytes) - pos,
+                            0x100 - (cur_addr & 0xff))
+            self.write_dpll_multiple(
+                cur_addr, list(data_bytes[pos:pos + chunk_len]))
+            pos += chunk_len
+
 
+    @bus_locked
     def read_dpll_reg(self, base_addr, offset):
         """
         Чтение регистра DPLL
@@ -149,6 +201,7 @@ class miniptm_i2c:
         #print(f"Read dpll reg {full_addr:#02x} = {val:#02x}")
         return val
 
+    @bus_locked
     def read_dpll_reg_direct(self, addr):
         """
         Прямое чтение регистра DPLL по абсолютному адресу
@@ -178,6 +231,7 @@ class miniptm_i2c:
         #print(f"Called read dpll reg multiple direct addr={addr} len={length}")
         return self.read_dpll_reg_multiple(addr, 0, length)
 
+    @bus_locked
     def read_dpll_reg_multiple(self, base_addr, offset, numbytes):
         """
         Чтение нескольких регистров DPLL
@@ -202,6 +256,45 @@ class miniptm_i2c:
 
 
 
+    @bus_locked
+    def read_dpll_block(self, addr, length):
+        """
+        Чтение блока произвольной длины из DPLL
+        Блок делится на транзакции не длиннее SMBUS_BLOCK_MAX байтов,
+        которые не пересекают границу страницы в 256 байтов
+        addr - начальный адрес
+        length - количество байтов для чтения
+        Возвращает bytearray
+        """
+        data = bytearray()
+        while len(data) < length:
+            cur_addr = addr + len(data)
+            chunk_len = min(SMBUS_BLOCK_MAX, length - len(data),
+                            0x100 - (cur_addr & 0xff))
+            data += bytes(self.read_dpll_reg_multiple(cur_addr, 0, chunk_len))
+        return data
+
+    @bus_locked
+    def read_dpll_regs(self, addresses):
+        """
+        Чтение набора отдельных регистров DPLL
+        Регистр страницы пишется только при смене страницы, поэтому
+        адреса одной страницы лучше передавать подряд
+        addresses - список абсолютных адресов
+        Возвращает список значений в том же порядке
+        """
+        self.open_i2c_dpll()
+        values = []
+        for addr in addresses:
+            baseaddr_lower = addr & 0xff
+            baseaddr_upper = (addr >> 8) & 0xff
+            if self.cur_base_addr != baseaddr_upper:
+                self.bus.write_i2c_block_data(self.DPLL_ADDRESS, 0xfc, [
+                                              baseaddr_lower, baseaddr_upper, 0x10, 0x20])
+                self.cur_base_addr = baseaddr_upper
+            values.append(self.bus.read_byte_data(self.DPLL_ADDRESS, baseaddr_lower))
+        return values
+
     # Функция для чтения данных с устройства I2C
 
     def read_i2c_data(self, address, start_reg, length):
@@ -231,6 +324,7 @@ class miniptm_i2c:
             return None, None, None, None
 
     # Function to read SFP module information
+    @bus_locked
     def read_sfp_module(self, sfp_num=1):
         if (sfp_num >= 1 and sfp_num <= 4):
             pass
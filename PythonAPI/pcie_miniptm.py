@@ -1,7 +1,7 @@
+import array
 import mmap      # Для работы с отображением памяти
 import os
 import struct    # Для упаковки/распаковки двоичных данных
-import subprocess # Для запуска системных команд
 import re        # Регулярные выражения
 from enum import Enum
 import time
@@ -92,78 +92,107 @@ class PCIeDevice:
         self.close()
 
 
-def get_ethernet_devices():
-    try:
-        output = subprocess.check_output(["lspci", "-nn"]).decode()
-        ethernet_devices = re.findall(
-            r'(\w\w:\w\w.\w) Ethernet controller.*\[(\w+):(\w+)\]', output)
-        return ethernet_devices
-    except subprocess.CalledProcessError as e:
-        print("An error occurred while running lspci:", e)
-        return []
+# Корень sysfs, может быть подменён для тестов на поддельном дереве
+SYSFS_ROOT = "/sys"
+PCI_CLASS_ETHERNET = 0x020000
+IORESOURCE_MEM = 0x200  # Флаг ресурса памяти в файле resource
 
+MINIPTM_VENDOR_ID = "8086"
+MINIPTM_DEVICE_ID = "125b"
+MINIPTM_MAC_ADDRESS = "00:a0:c9:00:00:00"
+
+
+def pci_devices_path(sysfs_root=SYSFS_ROOT):
+    return os.path.join(sysfs_root, "bus", "pci", "devices")
 
-def get_mac_address(pci_address):
-    interface_path = f"/sys/bus/pci/devices/0000:{pci_address}/net/"
-    try:
-        interface_name = os.listdir(interface_path)[0]
-    except IndexError:
-        return None
 
+def read_sysfs_attr(path):
+    """
+    Чтение атрибута sysfs
+    Возвращает строку без пробелов или None, если файл не читается
+    """
     try:
-        with open(f"/sys/class/net/{interface_name}/address") as f:
+        with open(path, 'r') as f:
             return f.read().strip()
-    except IOError:
+    except (IOError, OSError):
         return None
 
 
-def get_bar_address_and_size(pci_id):
+def get_ethernet_devices(sysfs_root=SYSFS_ROOT):
+    """
+    Перечисление Ethernet контроллеров через sysfs
+    Возвращает список (pci адрес, vendor id, device id), например
+    ("0000:01:00.0", "8086", "125b")
+    """
+    ethernet_devices = []
+    devices_path = pci_devices_path(sysfs_root)
     try:
-        # Run the lspci command with the specific PCI ID
-        output = subprocess.check_output(
-            ["lspci", "-s", pci_id, "-vvv"], universal_newlines=True)
+        pci_addresses = sorted(os.listdir(devices_path))
+    except OSError:
+        return ethernet_devices
+
+    for pci_address in pci_addresses:
+        dev_path = os.path.join(devices_path, pci_address)
+        dev_class = read_sysfs_attr(os.path.join(dev_path, "class"))
+        vendor_id = read_sysfs_attr(os.path.join(dev_path, "vendor"))
+        device_id = read_sysfs_attr(os.path.join(dev_path, "device"))
+        if dev_class is None or vendor_id is None or device_id is None:
+            continue
+        if (int(dev_class, 16) & 0xffff00) != PCI_CLASS_ETHERNET:
+            continue
+        ethernet_devices.append(
+            (pci_address, vendor_id.lower().replace("0x", ""),
+             device_id.lower().replace("0x", "")))
+    return ethernet_devices
+
+
+def get_mac_address(pci_address, sysfs_root=SYSFS_ROOT):
+    """
+    MAC адрес первого сетевого интерфейса PCI устройства
+    """
+    interface_path = os.path.join(pci_devices_path(sysfs_root), pci_address, "net")
+    try:
+        interface_name = sorted(os.listdir(interface_path))[0]
+    except (OSError, IndexError):
+        return None
+    return read_sysfs_attr(os.path.join(interface_path, interface_name, "address"))
 
-        # Extract the Memory Regions (BAR) information
-        bar_info = re.findall(
-            r'Region \d: Memory at (\w+) .* \[size=(\w+)\]', output)
 
-        return bar_info
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while running lspci for device {pci_id}:", e)
+def get_bar_address_and_size(pci_id, sysfs_root=SYSFS_ROOT):
+    """
+    Адреса и размеры BAR памяти из файла resource
+    Возвращает список (адрес hex, размер в байтах строкой) или None
+    """
+    resource = read_sysfs_attr(
+        os.path.join(pci_devices_path(sysfs_root), pci_id, "resource"))
+    if resource is None:
         return None
 
+    bar_info = []
+    # Первые 6 строк - BAR0..BAR5: начало, конец, флаги
+    for line in resource.splitlines()[:6]:
+        start, end, flags = (int(part, 16) for part in line.split())
+        if start == 0 or not (flags & IORESOURCE_MEM):
+            continue
+        bar_info.append((f"{start:x}", str(end - start + 1)))
+    return bar_info
 
-# returns [ [miniptm0 device like 01:00.0, bar address 0, bar size 0] [][] ]
-def get_miniptm_devices():
-    # Define your specific values here
-    specific_vendor_id = "8086"
-    specific_device_id = "125b"
-    specific_mac_address = "00:a0:c9:00:00:00"
 
+# returns [ [miniptm0 device like 0000:01:00.0, bar address 0, bar size 0] [][] ]
+def get_miniptm_devices(sysfs_root=SYSFS_ROOT):
     miniptm_pcie_devices = []
-    # Get Ethernet devices
-    ethernet_devices = get_ethernet_devices()
-
-    # Process each device
-    for pci_address, vendor_id, device_id in ethernet_devices:
-        mac_address = get_mac_address(pci_address)
-
-        # Check if the device matches specific criteria
-        if vendor_id == specific_vendor_id and device_id == specific_device_id and mac_address == specific_mac_address:
-            bar_info = get_bar_address_and_size(pci_address)
-            miniptm_pcie_devices.append(
-                [pci_address, bar_info[0][0], bar_info[0][1]])
-            if bar_info:
-                # for i, (address, size) in enumerate(bar_info):
-                #    print(f"Region {i}: Address = {address}, Size = {size}")
-                # print(f"Match found: PCI Address: {pci_address}, Vendor ID: {vendor_id}, Device ID: {device_id}, MAC Address: {mac_address}, BAR0 Address: {bar_info[0][0]} BAR0 Size: {bar_info[0][1]}")
-                pass
-            else:
-                # print(f"BAR information not found for PCI Address: {pci_address}")
-                pass
-        else:
-            # print(f"No match: PCI Address: {pci_address}, Vendor ID: {vendor_id}, Device ID: {device_id}, MAC Address: {mac_address}")
-            pass
+
+    for pci_address, vendor_id, device_id in get_ethernet_devices(sysfs_root):
+        if vendor_id != MINIPTM_VENDOR_ID or device_id != MINIPTM_DEVICE_ID:
+            continue
+        if get_mac_address(pci_address, sysfs_root) != MINIPTM_MAC_ADDRESS:
+            continue
+        bar_info = get_bar_address_and_size(pci_address, sysfs_root)
+        if not bar_info:
+            # print(f"BAR information not found for PCI Address: {pci_address}")
+            continue
+        miniptm_pcie_devices.append(
+            [pci_address, bar_info[0][0], bar_info[0][1]])
 
     return miniptm_pcie_devices
 
@@ -174,13 +203,267 @@ def get_miniptm_devices():
 # i2c is handled through kernel module
 
 
-class MiniPTM_PCIe(PCIeDevice):
-    def __init__(self, bar_address_hex, bar_size):
-        super().__init__(bar_address_hex, bar_size)
+# Регистры времени I225 (SYSTIM, PTP часы сетевой карты)
+I225_SYSTIML = 0xB600   # наносекунды
+I225_SYSTIMH = 0xB604   # секунды
+I225_SYSTIMR = 0xB6F8   # остаток, чтение защёлкивает SYSTIML/SYSTIMH
+
+
+# Окна BAR для снимков состояния I225: (имя, смещение, число 32-битных слов)
+# Регистры с очисткой при чтении (TSICR, TXSTMP/RXSTMP, AUXSTMP) не
+# читаются - это сломало бы PTP в драйвере igc
+I225_SNAPSHOT_WINDOWS = [
+    ("ctrl", 0x0000, 3),        # CTRL, CTRL (дубль), STATUS
+    ("ctrl_ext", 0x0018, 1),    # CTRL_EXT
+    ("tssdp", 0x003C, 1),       # TSSDP, назначение SDP для синхронизации
+    ("ledctl", 0x0E00, 1),      # LEDCTL
+    ("systim", 0xB600, 4),      # SYSTIML, SYSTIMH, TIMINCA, TIMADJ
+    ("tsynctxctl", 0xB614, 1),  # TSYNCTXCTL
+    ("tsyncrxctl", 0xB620, 1),  # TSYNCRXCTL
+    ("tsauxc", 0xB640, 7),      # TSAUXC, TRGTTIML/H0, TRGTTIML/H1, FREQOUT0/1
+]
+
+# Регистры, которые читаются до окон по порядку после чтения защёлки
+# SYSTIMR, чтобы секунды и наносекунды относились к одному моменту
+I225_SNAPSHOT_LATCHED = (I225_SYSTIMR, [I225_SYSTIML, I225_SYSTIMH])
+
+# Именованные поля: имя -> (смещение регистра, первый бит, ширина)
+I225_SNAPSHOT_FIELDS = {
+    # Синхронизация времени
+    "SYSTIM_NS": (0xB600, 0, 32),
+    "SYSTIM_SEC": (0xB604, 0, 32),
+    "TIMINCA_INCVALUE": (0xB608, 0, 31),
+    "TIMINCA_ISGN": (0xB608, 31, 1),
+    "TIMADJ": (0xB60C, 0, 32),
+    "TSYNCTXCTL_VALID": (0xB614, 0, 1),
+    "TSYNCTXCTL_EN": (0xB614, 4, 1),
+    "TSYNCRXCTL_VALID": (0xB620, 0, 1),
+    "TSYNCRXCTL_TYPE": (0xB620, 1, 3),
+    "TSYNCRXCTL_EN": (0xB620, 4, 1),
+    "TSAUXC_EN_TT0": (0xB640, 0, 1),
+    "TSAUXC_EN_TT1": (0xB640, 1, 1),
+    "TSAUXC_EN_CLK0": (0xB640, 2, 1),
+    "TSAUXC_EN_CLK1": (0xB640, 5, 1),
+    "TSAUXC_EN_TS0": (0xB640, 8, 1),
+    "TSAUXC_EN_TS1": (0xB640, 10, 1),
+    "TSAUXC_DISABLE_SYSTIME": (0xB640, 31, 1),
+    "TRGTTIM0_NS": (0xB644, 0, 32),
+    "TRGTTIM0_SEC": (0xB648, 0, 32),
+    "TRGTTIM1_NS": (0xB64C, 0, 32),
+    "TRGTTIM1_SEC": (0xB650, 0, 32),
+    "FREQOUT0": (0xB654, 0, 32),
+    "FREQOUT1": (0xB658, 0, 32),
+    # SDP / GPIO
+    "SDP0_DATA": (0x0000, 2, 1),
+    "SDP1_DATA": (0x0000, 3, 1),
+    "SDP0_IODIR": (0x0000, 22, 1),
+    "SDP1_IODIR": (0x0000, 23, 1),
+    "SDP2_DATA": (0x0018, 6, 1),
+    "SDP3_DATA": (0x0018, 7, 1),
+    "SDP2_IODIR": (0x0018, 10, 1),
+    "SDP3_IODIR": (0x0018, 11, 1),
+    "TSSDP_TS_SDP0_SEL": (0x003C, 0, 2),
+    "TSSDP_TS_SDP0_EN": (0x003C, 2, 1),
+    "TSSDP_TS_SDP1_SEL": (0x003C, 3, 2),
+    "TSSDP_TS_SDP1_EN": (0x003C, 5, 1),
+    "TSSDP_TS_SDP2_SEL": (0x003C, 6, 2),
+    "TSSDP_TS_SDP2_EN": (0x003C, 8, 1),
+    "TSSDP_TS_SDP3_SEL": (0x003C, 9, 2),
+    "TSSDP_TS_SDP3_EN": (0x003C, 11, 1),
+    "LEDCTL": (0x0E00, 0, 32),
+    # Состояние линка
+    "STATUS_FD": (0x0008, 0, 1),
+    "STATUS_LU": (0x0008, 1, 1),
+    "STATUS_SPEED": (0x0008, 6, 2),
+    "STATUS_SPEED_2500": (0x0008, 22, 1),
+}
+
+
+class BarSnapshotLayout:
+    """
+    Описание снимка: набор окон BAR и именованных полей
+    Положение каждого поля в буфере снимка вычисляется один раз
+    latched - (регистр защёлки, [регистры]) или None; защёлкнутые регистры
+    читаются первыми и исключаются из копирования окон
+    """
+
+    def __init__(self, windows=I225_SNAPSHOT_WINDOWS, fields=I225_SNAPSHOT_FIELDS,
+                 latched=I225_SNAPSHOT_LATCHED):
+        self.windows = []
+        word_index = {}
+        num_words = 0
+        for name, offset, count in windows:
+            self.windows.append((name, offset, count, num_words))
+            for i in range(count):
+                word_index[offset + 4 * i] = num_words + i
+            num_words += count
+        self.num_words = num_words
+        self.word_index = word_index
+
+        # latch_reg и (смещение, позиция) защёлкнутых регистров в порядке чтения
+        self.latch_reg = None
+        self.latched = []
+        skip = set()
+        if latched is not None:
+            latch_reg, regs = latched
+            if all(offset in word_index for offset in regs):
+                self.latch_reg = latch_reg
+                self.latched = [(offset, word_index[offset]) for offset in regs]
+                skip = set(regs)
+
+        # непрерывные отрезки окон без защёлкнутых регистров:
+        # (смещение, число слов, позиция в буфере)
+        self.runs = []
+        for name, offset, count, word_pos in self.windows:
+            start = None
+            for i in range(count + 1):
+                if i < count and offset + 4 * i not in skip:
+                    if start is None:
+                        start = i
+                elif start is not None:
+                    self.runs.append((offset + 4 * start, i - start, word_pos + start))
+                    start = None
+
+        self.fields = []
+        for name, (offset, start_bit, length) in fields.items():
+            if offset not in word_index:
+                raise ValueError(f"Field {name} at 0x{offset:x} is outside the snapshot windows")
+            self.fields.append((name, word_index[offset], start_bit,
+                                (1 << length) - 1))
+
+
+class BarSnapshot:
+    """
+    Снимок окон BAR в заранее выделенном буфере array('I')
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.words = array.array('I', bytes(4 * layout.num_words))
+        self.host_time = None
+
+    def read_reg(self, offset):
+        """ Значение регистра по смещению в BAR """
+        return self.words[self.layout.word_index[offset]]
+
+    def fields(self):
+        """ Словарь имя поля -> значение """
+        words = self.words
+        return {name: (words[index] >> start_bit) & mask
+                for name, index, start_bit, mask in self.layout.fields}
+
+    def diff(self, other):
+        """
+        Поля, отличающиеся от снимка other
+        Возвращает словарь имя поля -> (значение в other, значение здесь)
+        """
+        changes = {}
+        for name, index, start_bit, mask in self.layout.fields:
+            old = (other.words[index] >> start_bit) & mask
+            new = (self.words[index] >> start_bit) & mask
+            if old != new:
+                changes[name] = (old, new)
+        return changes
+
+    def print_fields(self):
+        for name, value in self.fields().items():
+            print(f" - {name}: 0x{value:x}")
+
+
+class BarRegister:
+    """
+    Регистр BAR с фиксированным смещением
+    Индекс слова вычисляется один раз при создании
+    """
+    __slots__ = ("words", "index", "offset")
+
+    def __init__(self, words, offset):
+        self.words = words
+        self.offset = offset
+        self.index = offset >> 2
+
+    def read(self):
+        return self.words[self.index]
+
+    def write(self, value):
+        self.words[self.index] = value
+
+
+class PCIeBar:
+    """
+    Доступ к BAR через /sys/bus/pci/devices/<bdf>/resource<N>
+    Не требует /dev/mem и CAP_SYS_RAWIO, только права на файл resource.
+    Регистры доступны как memoryview 32-битных слов, чтение и запись по
+    индексу не создают промежуточных буферов.
+    """
+
+    def __init__(self, pci_address, bar_num=0, sysfs_root=SYSFS_ROOT, writable=True):
+        """
+        pci_address - адрес PCI функции (0000:01:00.0)
+        bar_num - номер BAR
+        sysfs_root - корень sysfs
+        writable - отображать на запись
+        """
+        self.pci_address = pci_address
+        self.path = os.path.join(pci_devices_path(sysfs_root), pci_address,
+                                 f"resource{bar_num}")
+        mode = os.O_RDWR if writable else os.O_RDONLY
+        fd = os.open(self.path, mode | os.O_SYNC)
+        try:
+            self.size = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, self.size, mmap.MAP_SHARED,
+                                mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0))
+        finally:
+            os.close(fd)
+        self.words = memoryview(self.mm).cast('I')
+
+    def read32(self, offset):
+        """ Чтение 32-битного регистра по смещению в байтах """
+        return self.words[offset >> 2]
+
+    def write32(self, offset, value):
+        """ Запись 32-битного регистра по смещению в байтах """
+        self.words[offset >> 2] = value
+
+    def register(self, offset):
+        """ Ручка регистра с фиксированным смещением """
+        if offset & 0x3 or offset + 4 > self.size:
+            raise ValueError(f"Bad BAR register offset 0x{offset:x}")
+        return BarRegister(self.words, offset)
+
+    def snapshot(self, offset, count, out, out_index=0):
+        """
+        Копирование count слов начиная со смещения offset в заранее
+        выделенный буфер out (array('I'), bytearray или memoryview)
+        out_index - позиция в out в словах
+        Копируется по одному слову: регистры I225 допускают только
+        выровненный 32-битный доступ, а копирование срезом может читать
+        память байтами или широкими словами
+        """
+        words = self.words
+        index = offset >> 2
+        dest = memoryview(out).cast('B').cast('I')
+        for i in range(count):
+            dest[out_index + i] = words[index + i]
+
+    def numpy_view(self):
+        """
+        Представление BAR как numpy.uint32 массива (нужен numpy)
+        Массив держит буфер self.words, его нужно удалить до close(),
+        иначе close() выбросит BufferError
+        """
+        import numpy as np
+        return np.frombuffer(self.words, dtype=np.uint32)
 
     def close(self):
-        if self.mm:
-            self.clib.unmap_memory(self.mm, self.mapped_size)
+        if self.mm is not None:
+            try:
+                self.words.release()
+                self.mm.close()
+            except BufferError:
+                # отображение остаётся рабочим, пока его держит массив
+                self.words = memoryview(self.mm).cast('I')
+                raise BufferError(f"{self.path} is still in use by a numpy_view() array")
             self.mm = None
 
     def __enter__(self):
@@ -190,8 +473,85 @@ class MiniPTM_PCIe(PCIeDevice):
         self.close()
 
 
+I225_SNAPSHOT_LAYOUT = BarSnapshotLayout()
 
 
+class MiniPTM_PCIe(PCIeDevice):
+    def __init__(self, bar_address_hex, bar_size, pci_address=None):
+        # если известен PCI адрес - отображаем resource0 из sysfs,
+        # /dev/mem остаётся запасным вариантом
+        self.bar_map = None
+        if pci_address is not None:
+            try:
+                self.bar_map = PCIeBar(pci_address, 0)
+            except OSError as e:
+                print(f"Could not map {pci_address} resource0, using /dev/mem: {e}")
+
+        if self.bar_map is not None:
+            self.bar_address = int(bar_address_hex, 16)
+            self.bar_size = self.bar_map.size
+            self.access = mmap.ACCESS_WRITE
+            self.mm = None
+        else:
+            super().__init__(bar_address_hex, bar_size)
+
+    def read32(self, offset):
+        if self.bar_map is not None:
+            return self.bar_map.read32(offset)
+        return super().read32(offset)
+
+    def snapshot(self, into=None, layout=None):
+        """
+        Снимок окон BAR за один проход
+        into - BarSnapshot для повторного использования (без выделения памяти)
+        layout - BarSnapshotLayout, по умолчанию I225_SNAPSHOT_LAYOUT
+        Возвращает BarSnapshot
+        """
+        if into is None:
+            into = BarSnapshot(layout if layout is not None else I225_SNAPSHOT_LAYOUT)
+        layout = into.layout
+        words = into.words
+        into.host_time = time.monotonic()
+        if layout.latch_reg is not None:
+            # SYSTIMR защёлкивает SYSTIML/SYSTIMH, читаем их сразу после
+            self.read32(layout.latch_reg)
+            for offset, word_pos in layout.latched:
+                words[word_pos] = self.read32(offset)
+        for offset, count, word_pos in layout.runs:
+            if self.bar_map is not None:
+                self.bar_map.snapshot(offset, count, words, word_pos)
+            else:
+                for i in range(count):
+                    words[word_pos + i] = self.read32(offset + 4 * i)
+        return into
+
+    def read_systim_ns(self):
+        """
+        Время PTP часов I225 в наносекундах
+        Чтение SYSTIMR защёлкивает SYSTIML/SYSTIMH, как в драйвере igc
+        """
+        self.read32(I225_SYSTIMR)
+        nanoseconds = self.read32(I225_SYSTIML)
+        seconds = self.read32(I225_SYSTIMH)
+        return seconds * 1000000000 + nanoseconds
+
+    def write32(self, offset, value):
+        if self.bar_map is not None:
+            self.bar_map.write32(offset, value)
+            return
+        super().write32(offset, value)
+
+    def close(self):
+        if self.bar_map is not None:
+            self.bar_map.close()
+            self.bar_map = None
+        super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 if __name__ == "__main__":
@@ -201,4 +561,4 @@ if __name__ == "__main__":
 
     for [pci_dev, bar, bar_size] in miniptm_devs:
         # Create an instance of PCIeDevice
-        driver = MiniPTM_PCIe(bar, bar_size)
+        driver = MiniPTM_PCIe(bar, bar_size, pci_dev)
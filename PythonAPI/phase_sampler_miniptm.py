@@ -0,0 +1,347 @@
+
+import threading
+import time
+
+from renesas_cm_registers import int_to_signed_nbit
+from filters_miniptm import RingBuffer
+
+#########
+# Потоковое чтение фазы DPLLn_PHASE_STATUS
+# Регистр обновляется каждые 100 мкс, что быстрее любого чтения по I2C,
+# поэтому опрос идёт без пауз. Фазы выбранных каналов лежат подряд
+# (шаг 8 байтов, 5 байтов на канал) и читаются одним блоком.
+# Каждому отсчёту приписывается time.monotonic() середины блочного чтения.
+# Отсчёты хранятся в кольцевом буфере фиксированного размера.
+
+PHASE_STATUS_BITS = 36
+PHASE_STATUS_BYTES = 5
+PHASE_STATUS_STRIDE = 8
+PHASE_STATUS_UNIT_PS = 50
+PHASE_STATUS_RANGE = 1 << PHASE_STATUS_BITS
+
+# Развёртка фазы: соседние отсчёты считаются непрерывными, пока
+# отклонение от прогноза меньше четверти диапазона регистра
+UNWRAP_TOLERANCE = PHASE_STATUS_RANGE // 4
+# Допустимая ошибка оценки частоты для прогноза, 100 ppm
+UNWRAP_MAX_RATE_ERROR = 100e-6 / (PHASE_STATUS_UNIT_PS * 1e-12)
+
+
+class PhaseUnwrapper:
+    """
+    Развёртка 36-битной фазы DPLLn_PHASE_STATUS в неограниченную
+    Следующее значение прогнозируется по последнему и скорости изменения
+    фазы (известное частотное смещение, затем оценка по отсчётам), из
+    всех значений raw + k * 2^36 берётся ближайшее к прогнозу.
+    Если прогноз слишком неточен или отсчёт далеко от него, непрерывность
+    потеряна и update возвращает None
+    """
+
+    def __init__(self, frequency_offset=None, tolerance=UNWRAP_TOLERANCE,
+                 max_rate_error=UNWRAP_MAX_RATE_ERROR, rate_alpha=0.1):
+        """
+        frequency_offset - известное смещение частоты (доля, не ppm) или None
+        tolerance - допустимое отклонение от прогноза в 50 пс
+        max_rate_error - ошибка скорости в 50 пс/с, пока она не оценена
+        rate_alpha - коэффициент сглаживания оценки скорости
+        """
+        self.tolerance = tolerance
+        self.max_rate_error = max_rate_error
+        self.rate_alpha = rate_alpha
+        self.known_rate = None
+        if frequency_offset is not None:
+            self.known_rate = frequency_offset / (PHASE_STATUS_UNIT_PS * 1e-12)
+        self.reset()
+
+    def reset(self):
+        self.last_time = None
+        self.last_phase = None
+        self.rate = self.known_rate or 0.0
+        self.rate_estimated = self.known_rate is not None
+        self.wraps = 0
+
+    def update(self, t, phase):
+        """
+        t - время отсчёта в секундах, phase - знаковое 36-битное значение
+        Возвращает развёрнутую фазу или None при потере непрерывности
+        """
+        if self.last_time is None:
+            self.last_time = t
+            self.last_phase = phase
+            return phase
+
+        dt = t - self.last_time
+        rate_error = 0 if self.rate_estimated else self.max_rate_error * dt
+        if rate_error > self.tolerance:
+            return None
+
+        predicted = self.last_phase + self.rate * dt
+        wraps = round((predicted - phase) / PHASE_STATUS_RANGE)
+        unwrapped = phase + wraps * PHASE_STATUS_RANGE
+        if abs(unwrapped - predicted) > self.tolerance:
+            return None
+
+        if dt > 0:
+            observed_rate = (unwrapped - self.last_phase) / dt
+            if self.rate_estimated:
+                self.rate += self.rate_alpha * (observed_rate - self.rate)
+            else:
+                self.rate = observed_rate
+                self.rate_estimated = True
+        self.wraps = wraps
+        self.last_time = t
+        self.last_phase = unwrapped
+        return unwrapped
+
+
+class PhaseRingBuffer:
+    """
+    Кольцевой буфер пар (время, фаза) одного канала
+    times - time.monotonic() в секундах, phases - фаза в единицах 50 пс
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = RingBuffer(capacity, 'd')
+        self.phases = RingBuffer(capacity, 'q')
+
+    def append(self, t, phase):
+        self.times.append(t)
+        self.phases.append(phase)
+
+    def clear(self):
+        self.times.clear()
+        self.phases.clear()
+
+    def latest(self):
+        """ Последний отсчёт (время, фаза) или None """
+        if len(self.times) == 0:
+            return None
+        return self.times.newest(), self.phases.newest()
+
+    def window(self, window_s=None):
+        """
+        Отсчёты за последние window_s секунд (все, если None) по порядку времени
+        Возвращает (список времён, список фаз)
+        """
+        times = []
+        phases = []
+        last_time = self.times.newest()
+        for t, phase in zip(reversed(self.times), reversed(self.phases)):
+            if window_s is not None and last_time - t > window_s:
+                break
+            times.append(t)
+            phases.append(phase)
+        times.reverse()
+        phases.reverse()
+        return times, phases
+
+    def __len__(self):
+        return len(self.times)
+
+
+class PhaseSampler:
+    """
+    Непрерывный сбор фазы каналов DPLL одной платы
+    Запуск в фоне через start()/stop() или синхронно через poll()/run()
+    Запросы mean/slope/variance берут окно последних window_s секунд
+    С unwrap=True в буфер пишется развёрнутая фаза, переходы через
+    границу 36 битов не прерывают измерение. Перезапуск измерения
+    (restart_phase_measurement) только при потере непрерывности
+    """
+
+    def __init__(self, board, channels=(1,), capacity=4096, unwrap=True,
+                 frequency_offset=None, restart_on_discontinuity=False):
+        """
+        board - Single_MiniPTM
+        channels - номера каналов DPLL (0-7), фаза читается из DPLLn_PHASE_STATUS
+        capacity - число отсчётов в буфере каждого канала
+        unwrap - развёртка 36-битной фазы
+        frequency_offset - известное смещение частоты измеряемого клока (доля)
+        restart_on_discontinuity - перезапускать измерение при потере непрерывности
+        """
+        self.board = board
+        self.channels = sorted(set(channels))
+        status = board.dpll.modules["Status"]
+        base_addr = status.BASE_ADDRESSES[0]
+        self.addresses = {channel: base_addr + status.LAYOUT[
+            f"DPLL{channel}_PHASE_STATUS_7_0"]["offset"] for channel in self.channels}
+        # Один блок от первого до последнего канала
+        self.block_addr = self.addresses[self.channels[0]]
+        self.block_len = (self.addresses[self.channels[-1]] - self.block_addr
+                          + PHASE_STATUS_BYTES)
+        self.buffers = {channel: PhaseRingBuffer(capacity) for channel in self.channels}
+        self.unwrappers = None
+        if unwrap:
+            self.unwrappers = {channel: PhaseUnwrapper(frequency_offset)
+                               for channel in self.channels}
+        self.restart_on_discontinuity = restart_on_discontinuity
+        # restart_phase_measurement меняет местами клоки, знак фазы меняется
+        self.polarity = {channel: 1 for channel in self.channels}
+        # Номер непрерывного участка, растёт при каждой потере непрерывности
+        self.segments = {channel: 0 for channel in self.channels}
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.sample_count = 0
+        self.dropped_count = 0
+
+    def poll(self):
+        """
+        Одно блочное чтение всех каналов
+        Возвращает число записанных отсчётов
+        """
+        t_before = time.monotonic()
+        data = self.board.i2c.read_dpll_block(self.block_addr, self.block_len)
+        t_after = time.monotonic()
+        host_time = (t_before + t_after) / 2
+
+        stored = 0
+        with self.lock:
+            for channel in self.channels:
+                pos = self.addresses[channel] - self.block_addr
+                raw = data[pos:pos + PHASE_STATUS_BYTES]
+                # Нули - неудачное чтение, как и в read_pcie_clk_phase_measurement
+                if not any(raw):
+                    self.dropped_count += 1
+                    continue
+                if self._push(channel, host_time,
+                              int.from_bytes(raw, byteorder='little')):
+                    stored += 1
+                else:
+                    self.dropped_count += 1
+            self.sample_count += 1
+        return stored
+
+    def _push(self, channel, host_time, raw):
+        """
+        Запись сырого 36-битного значения фазы в буфер канала
+        Возвращает False, если отсчёт отброшен
+        """
+        phase = int_to_signed_nbit(raw, PHASE_STATUS_BITS) * self.polarity[channel]
+        if self.unwrappers is not None:
+            unwrapper = self.unwrappers[channel]
+            unwrapped = unwrapper.update(host_time, phase)
+            if unwrapped is None:
+                if self._discontinuity(channel):
+                    # отсчёт снят до перезапуска измерения, развёртка
+                    # начнётся со следующего
+                    return False
+                unwrapped = unwrapper.update(host_time, phase)
+            phase = unwrapped
+        self.buffers[channel].append(host_time, phase)
+        return True
+
+    def _discontinuity(self, channel):
+        """
+        Непрерывность потеряна: новый участок с пустым буфером,
+        при restart_on_discontinuity измерение перезапускается
+        Возвращает True, если измерение перезапущено
+        """
+        print(f"Board {self.board.board_num} DPLL{channel} phase continuity lost")
+        self.segments[channel] += 1
+        self.buffers[channel].clear()
+        self.unwrappers[channel].reset()
+        if self.restart_on_discontinuity:
+            self.board.restart_phase_measurement(channel)
+            self.polarity[channel] = -self.polarity[channel]
+            return True
+        return False
+
+    def run(self, duration):
+        """ Опрос без пауз в текущем потоке в течение duration секунд """
+        end_time = time.monotonic() + duration
+        while time.monotonic() < end_time:
+            self.poll()
+
+    def _thread_main(self):
+        while self.running:
+            try:
+                self.poll()
+            except OSError as e:
+                print(f"Board {self.board.board_num} phase sampler read failed: {e}")
+                time.sleep(0.01)
+
+    def start(self):
+        """ Фоновый опрос, шина делится с другими потоками через i2c.lock """
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._thread_main, daemon=True,
+                                       name=f"phase_sampler_{self.board.board_num}")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+
+    def clear(self):
+        with self.lock:
+            for buffer in self.buffers.values():
+                buffer.clear()
+
+    def window(self, channel, window_s=None):
+        """ (времена, фазы) канала за последние window_s секунд, фазы в 50 пс """
+        with self.lock:
+            return self.buffers[channel].window(window_s)
+
+    def latest(self, channel):
+        with self.lock:
+            return self.buffers[channel].latest()
+
+    def mean(self, channel, window_s=None):
+        """ Средняя фаза за окно в 50 пс, None если отсчётов нет """
+        times, phases = self.window(channel, window_s)
+        if not phases:
+            return None
+        return sum(phases) / len(phases)
+
+    def variance(self, channel, window_s=None):
+        """ Дисперсия фазы за окно в (50 пс)^2, None если отсчётов меньше двух """
+        times, phases = self.window(channel, window_s)
+        if len(phases) < 2:
+            return None
+        mean = sum(phases) / len(phases)
+        return sum((phase - mean) ** 2 for phase in phases) / (len(phases) - 1)
+
+    def slope(self, channel, window_s=None):
+        """
+        Скорость изменения фазы за окно по методу наименьших квадратов
+        в 50 пс за секунду (частотное смещение: slope * 50e-12 = доля)
+        None если отсчётов меньше двух или все в один момент
+        """
+        times, phases = self.window(channel, window_s)
+        if len(phases) < 2:
+            return None
+        t0 = times[0]
+        p0 = phases[0]
+        # Смещение к первому отсчёту сохраняет точность float
+        n = len(times)
+        mean_t = sum(t - t0 for t in times) / n
+        mean_p = sum(p - p0 for p in phases) / n
+        cov = 0.0
+        var_t = 0.0
+        for t, p in zip(times, phases):
+            dt = t - t0 - mean_t
+            cov += dt * (p - p0 - mean_p)
+            var_t += dt * dt
+        if var_t == 0:
+            return None
+        return cov / var_t
+
+    def mean_ps(self, channel, window_s=None):
+        """ Средняя фаза за окно в пикосекундах """
+        mean = self.mean(channel, window_s)
+        if mean is None:
+            return None
+        return mean * PHASE_STATUS_UNIT_PS
+
+    def frequency_offset(self, channel, window_s=None):
+        """ Частотное смещение (доля, не ppm) по наклону фазы за окно """
+        slope = self.slope(channel, window_s)
+        if slope is None:
+            return None
+        return slope * PHASE_STATUS_UNIT_PS * 1e-12
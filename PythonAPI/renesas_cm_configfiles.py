@@ -1,3 +1,10 @@
+import array
+import hashlib
+import mmap
+import os
+import struct
+
+
 def parse_dpll_tcs_config_file(file_path):
     """
     Parses the DPLL configuration file to extract register addresses and values.
@@ -28,6 +35,350 @@ def parse_dpll_tcs_config_file(file_path):
 
 
 
+# Bytes 0xFC-0xFF of every 256 byte page are the I2C page address register,
+# they are never part of a configuration write
+DPLL_PAGE_SIZE = 0x100
+DPLL_PAGE_REG_OFFSET = 0xFC
+
+TCS_PLAN_MAGIC = b"CMPLAN01"
+# magic, number of runs, total payload bytes
+TCS_PLAN_HEADER = struct.Struct("<8sII")
+
+
+class TCSWritePlan:
+    """
+    Compiled TCS configuration, contiguous runs of register writes.
+    starts / lengths are array('I') with one entry per run, data holds the
+    payload of all runs back to back (bytes, bytearray or an mmap).
+    """
+
+    def __init__(self, starts, lengths, data, source=None):
+        self.starts = starts
+        self.lengths = lengths
+        self.data = data
+        self.source = source
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        """ Yields (start address, memoryview of bytes) for every run """
+        view = memoryview(self.data)
+        pos = 0
+        for start, length in zip(self.starts, self.lengths):
+            yield start, view[pos:pos + length]
+            pos += length
+
+    def num_bytes(self):
+        return sum(self.lengths)
+
+    def to_pairs(self):
+        """ Expands the plan back into (register, value) pairs """
+        pairs = []
+        for start, run in self:
+            pairs.extend((start + i, value) for i, value in enumerate(run))
+        return pairs
+
+    def to_bytes(self):
+        header = TCS_PLAN_HEADER.pack(TCS_PLAN_MAGIC, len(self.starts),
+                                      self.num_bytes())
+        return (header + self.starts.tobytes() + self.lengths.tobytes()
+                + bytes(self.data[:self.num_bytes()]))
+
+    @classmethod
+    def from_buffer(cls, buf, source=None):
+        """ Builds a plan on top of a serialized buffer without copying the payload """
+        magic, num_runs, num_bytes = TCS_PLAN_HEADER.unpack_from(buf, 0)
+        if magic != TCS_PLAN_MAGIC:
+            raise ValueError("Not a compiled TCS write plan")
+        pos = TCS_PLAN_HEADER.size
+        index_size = num_runs * array.array('I').itemsize
+        starts = array.array('I')
+        starts.frombytes(buf[pos:pos + index_size])
+        pos += index_size
+        lengths = array.array('I')
+        lengths.frombytes(buf[pos:pos + index_size])
+        pos += index_size
+        if len(buf) < pos + num_bytes:
+            raise ValueError("Truncated compiled TCS write plan")
+        return cls(starts, lengths, memoryview(buf)[pos:pos + num_bytes], source)
+
+
+def compile_tcs_write_plan(config_data):
+    """
+    Turns a list of (register, value) pairs into a TCSWritePlan.
+    Write order is kept, consecutive addresses are merged into one run and
+    runs are split at page boundaries. Page register writes are dropped.
+    """
+    starts = array.array('I')
+    lengths = array.array('I')
+    data = bytearray()
+    next_addr = None
+
+    for register, value in config_data:
+        if (register & 0xff) >= DPLL_PAGE_REG_OFFSET:
+            next_addr = None
+            continue
+        if register == next_addr and (register & 0xff) != 0:
+            lengths[-1] += 1
+        else:
+            starts.append(register)
+            lengths.append(1)
+        data.append(value & 0xff)
+        next_addr = register + 1
+
+    return TCSWritePlan(starts, lengths, data)
+
+
+def get_config_cache_path(file_path, cache_dir, suffix, cache_tag=None):
+    """
+    Cache file path for a config file, keyed by the sha256 of its contents.
+    cache_dir defaults to .config_cache next to the config file.
+    """
+    with open(file_path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    if cache_tag is not None:
+        digest += "-" + cache_tag
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)),
+                                 ".config_cache")
+    return os.path.join(cache_dir, digest + suffix)
+
+
+def map_config_cache(cache_path):
+    """ Maps a cache file read-only, returns None if it does not exist """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+def store_config_cache(cache_path, data):
+    """ Writes a cache file atomically, a failure only costs the cache """
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write cache {cache_path}: {e}")
+
+
+def load_tcs_write_plan(file_path, cache_dir=None, transform=None, cache_tag=None):
+    """
+    Returns the compiled write plan for a TCS file.
+    Plans are cached in cache_dir (see get_config_cache_path) and mapped
+    back in with mmap, so the text is only parsed the first time a given
+    file is seen.
+    transform optionally rewrites the (register, value) list before it is
+    compiled, cache_tag must then identify the transform in the cache.
+    """
+    cache_path = get_config_cache_path(file_path, cache_dir, ".plan", cache_tag)
+    mapped = map_config_cache(cache_path)
+    if mapped is not None:
+        try:
+            return TCSWritePlan.from_buffer(mapped, file_path)
+        except (ValueError, struct.error):
+            # bad cache entry, rebuild it
+            pass
+
+    config_data = parse_dpll_tcs_config_file(file_path)
+    if transform is not None:
+        config_data = transform(config_data)
+    plan = compile_tcs_write_plan(config_data)
+    plan.source = file_path
+    store_config_cache(cache_path, plan.to_bytes())
+    return plan
+
+
+HEX_IMAGE_MAGIC = b"CMHEXIMG"
+# magic, base address, image length, number of regions
+HEX_IMAGE_HEADER = struct.Struct("<8sIII")
+
+
+class IntelHexImage:
+    """
+    Contents of an Intel HEX file as one contiguous image.
+    data covers base .. base+len(data), bytes not present in the file are
+    fill (0xFF). regions is the sparse map, sorted [start, end) absolute
+    address pairs of the populated bytes.
+    """
+
+    def __init__(self, base, data, regions):
+        self.base = base
+        self.data = data
+        self.regions = regions
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_bytes(self, addr, length):
+        """ memoryview of length bytes at absolute address addr """
+        pos = addr - self.base
+        return memoryview(self.data)[pos:pos + length]
+
+    def num_bytes(self):
+        return sum(end - start for start, end in self.regions)
+
+    def pages(self, page_size=128):
+        """
+        Yields (address, memoryview) for every page_size aligned page that
+        holds data, trimmed to the populated part of the page
+        """
+        view = memoryview(self.data)
+        for start, end in self.regions:
+            addr = start
+            while addr < end:
+                page_end = min(end, (addr // page_size + 1) * page_size)
+                yield addr, view[addr - self.base:page_end - self.base]
+                addr = page_end
+
+    def to_bytes(self):
+        regions = array.array('I', [addr for region in self.regions
+                                    for addr in region])
+        header = HEX_IMAGE_HEADER.pack(HEX_IMAGE_MAGIC, self.base,
+                                       len(self.data), len(self.regions))
+        return header + regions.tobytes() + bytes(self.data)
+
+    @classmethod
+    def from_buffer(cls, buf):
+        magic, base, length, num_regions = HEX_IMAGE_HEADER.unpack_from(buf, 0)
+        if magic != HEX_IMAGE_MAGIC:
+            raise ValueError("Not a cached Intel HEX image")
+        pos = HEX_IMAGE_HEADER.size
+        regions = array.array('I')
+        regions.frombytes(buf[pos:pos + 2 * num_regions * regions.itemsize])
+        pos += 2 * num_regions * regions.itemsize
+        if len(buf) < pos + length:
+            raise ValueError("Truncated Intel HEX image")
+        return cls(base, memoryview(buf)[pos:pos + length],
+                   [(regions[i], regions[i + 1]) for i in range(0, len(regions), 2)])
+
+
+def parse_intel_hex_image(file_path, fill=0xFF):
+    """
+    Parses an Intel HEX file into an IntelHexImage.
+    Checksums are validated, extended segment / linear address records are applied.
+    """
+    records = []
+    upper_address = 0
+
+    with open(file_path, 'r') as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(':'):
+                raise ValueError(f"{file_path}:{line_number} missing start code")
+            try:
+                raw = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ValueError(f"{file_path}:{line_number} bad hex digits")
+            if len(raw) < 5 or len(raw) != raw[0] + 5:
+                raise ValueError(f"{file_path}:{line_number} bad record length")
+            if sum(raw) & 0xFF:
+                raise ValueError(f"{file_path}:{line_number} checksum mismatch")
+
+            record_type = raw[3]
+            data = raw[4:-1]
+            if record_type == 0:  # Data record
+                records.append((upper_address + ((raw[1] << 8) | raw[2]), data))
+            elif record_type == 1:  # End of file
+                break
+            elif record_type == 2:  # Extended segment address
+                upper_address = int.from_bytes(data, 'big') << 4
+            elif record_type == 4:  # Extended linear address
+                upper_address = int.from_bytes(data, 'big') << 16
+
+    if not records:
+        return IntelHexImage(0, bytearray(), [])
+
+    records.sort(key=lambda record: record[0])
+    base = records[0][0]
+    end = max(addr + len(data) for addr, data in records)
+    image = bytearray([fill]) * (end - base)
+    regions = []
+    for addr, data in records:
+        image[addr - base:addr - base + len(data)] = data
+        if regions and addr <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], addr + len(data))
+        else:
+            regions.append([addr, addr + len(data)])
+
+    return IntelHexImage(base, image, [tuple(region) for region in regions])
+
+
+def load_intel_hex_image(file_path, cache_dir=None):
+    """ parse_intel_hex_image with the result cached like the TCS write plans """
+    cache_path = get_config_cache_path(file_path, cache_dir, ".img")
+    mapped = map_config_cache(cache_path)
+    if mapped is not None:
+        try:
+            return IntelHexImage.from_buffer(mapped)
+        except (ValueError, struct.error):
+            pass
+
+    hex_image = parse_intel_hex_image(file_path)
+    store_config_cache(cache_path, hex_image.to_bytes())
+    return hex_image
+
+
+def write_intel_hex_file(file_path, hex_image, record_size=16):
+    """
+    Writes the populated regions of an IntelHexImage as an Intel HEX file,
+    with extended linear address records and an end of file record.
+    """
+    def record(address, record_type, data):
+        raw = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF,
+                     record_type]) + bytes(data)
+        return f":{raw.hex().upper()}{(-sum(raw)) & 0xFF:02X}\n"
+
+    lines = []
+    upper_address = None
+    for start, end in hex_image.regions:
+        addr = start
+        while addr < end:
+            if (addr >> 16) != upper_address:
+                upper_address = addr >> 16
+                lines.append(record(0, 4, upper_address.to_bytes(2, 'big')))
+            # records never cross a 64k boundary
+            length = min(record_size, end - addr, 0x10000 - (addr & 0xFFFF))
+            lines.append(record(addr & 0xFFFF, 0,
+                                hex_image.get_bytes(addr, length)))
+            addr += length
+    lines.append(record(0, 1, b""))
+
+    with open(file_path, 'w') as file:
+        file.writelines(lines)
+
+
+def diff_intel_hex_images(reference, hex_image):
+    """
+    Compares hex_image against the populated regions of reference.
+    Returns a list of (address, length) spans that differ or are missing.
+    """
+    mismatches = []
+    for start, end in reference.regions:
+        if (start >= hex_image.base and end <= hex_image.base + len(hex_image)
+                and reference.get_bytes(start, end - start)
+                == hex_image.get_bytes(start, end - start)):
+            continue
+        for addr in range(start, end):
+            expected = reference.get_bytes(addr, 1)[0]
+            pos = addr - hex_image.base
+            if 0 <= pos < len(hex_image) and hex_image.data[pos] == expected:
+                continue
+            if mismatches and mismatches[-1][0] + mismatches[-1][1] == addr:
+                mismatches[-1][1] += 1
+            else:
+                mismatches.append([addr, 1])
+    return [tuple(span) for span in mismatches]
+
+
 def parse_intel_hex(file_path):
     """
     Parses an Intel HEX file.
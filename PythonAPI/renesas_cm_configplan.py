@@ -0,0 +1,264 @@
+import hashlib
+import os
+import struct
+
+from renesas_cm_configfiles import *
+from renesas_cm_registers import *
+
+
+# Reset default image of the 8A34002 configuration space
+RESET_DEFAULTS_MAGIC = b"CMRSTDEF"
+# magic, start address of the image
+RESET_DEFAULTS_HEADER = struct.Struct("<8sI")
+RESET_DEFAULTS_START = 0xC000
+RESET_DEFAULTS_END = 0xD000
+
+# Modules of the register model, used for trigger lookup and naming
+CONFIG_PLAN_MODULES = [Status, PWMEncoder, PWMDecoder, TOD, TODWrite, TODReadPrimary,
+                       TODReadSecondary, Input, Output, REFMON, PWM_USER_DATA,
+                       OUTPUT_TDC_CFG, OUTPUT_TDC, INPUT_TDC, PWM_SYNC_ENCODER,
+                       PWM_SYNC_DECODER, EEPROM, EEPROM_DATA, PWM_Rx_Info, DPLL_Ctrl,
+                       DPLL_Freq_Write, DPLL_Config, DPLL_GeneralStatus]
+
+# GPIO config registers (base + 0x10) and output latches are triggers too
+GPIO_TRIGGER_ADDRESSES = [base + 0x10 for base in
+                          [0xc8c2, 0xc8d4, 0xc8e6, 0xc900, 0xc912,
+                           0xc924, 0xc936, 0xc948, 0xc95a, 0xc980, 0xc992,
+                           0xc9a4, 0xc9b6, 0xc9c8, 0xc9da, 0xca00]] + [0xc160, 0xc161]
+
+# Bumped whenever minimize_tcs_config keeps a different set of writes,
+# so minimized plans cached by an older rule are not reused
+MINIMIZE_CACHE_VERSION = 2
+
+
+class ResetDefaults:
+    """
+    Register values the device holds after reset, as one contiguous image
+    starting at start_addr. Addresses outside the image have no known default.
+    """
+
+    def __init__(self, image, start_addr=RESET_DEFAULTS_START):
+        self.image = bytes(image)
+        self.start_addr = start_addr
+        self.digest = hashlib.sha256(
+            struct.pack("<I", start_addr) + self.image).hexdigest()
+
+    def get(self, register):
+        """ Returns the reset value of register, or None if unknown """
+        pos = register - self.start_addr
+        if 0 <= pos < len(self.image):
+            return self.image[pos]
+        return None
+
+    def save(self, file_path):
+        with open(file_path, 'wb') as file:
+            file.write(RESET_DEFAULTS_HEADER.pack(RESET_DEFAULTS_MAGIC,
+                                                  self.start_addr))
+            file.write(self.image)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'rb') as file:
+            buf = file.read()
+        magic, start_addr = RESET_DEFAULTS_HEADER.unpack_from(buf, 0)
+        if magic != RESET_DEFAULTS_MAGIC:
+            raise ValueError(f"{file_path} is not a reset default table")
+        return cls(buf[RESET_DEFAULTS_HEADER.size:], start_addr)
+
+
+def capture_reset_defaults(i2c_dev, start_addr=RESET_DEFAULTS_START,
+                           end_addr=RESET_DEFAULTS_END):
+    """
+    Reads the configuration space of a freshly reset board into a
+    ResetDefaults table. The page register window reads back as 0.
+    """
+    image = bytearray()
+    for page in range(start_addr, end_addr, DPLL_PAGE_SIZE):
+        for addr in range(page, page + DPLL_PAGE_REG_OFFSET, 32):
+            length = min(32, page + DPLL_PAGE_REG_OFFSET - addr)
+            image += bytes(i2c_dev.read_dpll_reg_multiple(addr, 0, length))
+        image += bytes(DPLL_PAGE_SIZE - DPLL_PAGE_REG_OFFSET)
+    return ResetDefaults(image, start_addr)
+
+
+def get_trigger_addresses(extra_addresses=()):
+    """
+    Returns the set of trigger register addresses. For every module instance
+    in the register model the last register of its layout is the trigger.
+    """
+    triggers = set(GPIO_TRIGGER_ADDRESSES)
+    triggers.update(extra_addresses)
+    for mod in CONFIG_PLAN_MODULES:
+        last_offset = max(reg['offset'] for reg in mod.LAYOUT.values())
+        for base_addr in mod.BASE_ADDRESSES.values():
+            triggers.add(base_addr + last_offset)
+    return triggers
+
+
+def get_modeled_addresses():
+    """
+    Returns the set of addresses covered by a module instance of the register
+    model, from its base address up to and including its trigger register.
+    """
+    modeled = set()
+    for mod in CONFIG_PLAN_MODULES:
+        last_offset = max(reg['offset'] for reg in mod.LAYOUT.values())
+        for base_addr in mod.BASE_ADDRESSES.values():
+            modeled.update(range(base_addr, base_addr + last_offset + 1))
+    return modeled
+
+
+def minimize_tcs_config(config_data, defaults, triggers=None, modeled=None):
+    """
+    Drops (register, value) writes that match the reset default.
+    Writes to trigger registers are always kept so modules still latch.
+    Writes outside the modeled modules are always kept too: their trigger
+    is unknown, any of them may be the one that latches its module.
+    """
+    if triggers is None:
+        triggers = get_trigger_addresses()
+    if modeled is None:
+        modeled = get_modeled_addresses()
+    minimized = []
+    for register, value in config_data:
+        if (register in triggers or register not in modeled
+                or defaults.get(register) != value):
+            minimized.append((register, value))
+    return minimized
+
+
+def load_minimized_write_plan(file_path, defaults, cache_dir=None):
+    """
+    Same as load_tcs_write_plan but with writes equal to the reset defaults
+    removed. Cached separately per reset default table.
+    The plan is only correct on a freshly reset device: a register dropped
+    as default keeps whatever value the board held before.
+    """
+    return load_tcs_write_plan(
+        file_path, cache_dir,
+        transform=lambda config_data: minimize_tcs_config(config_data, defaults),
+        cache_tag=f"min{MINIMIZE_CACHE_VERSION}-{defaults.digest[:16]}")
+
+
+def build_register_name_map():
+    """
+    Maps register address -> list of (name, fields) from the register model.
+    name is MODULE<num>.REGISTER, a few addresses belong to more than one module.
+    """
+    name_map = {}
+    for mod in CONFIG_PLAN_MODULES:
+        for module_num, base_addr in mod.BASE_ADDRESSES.items():
+            for reg_name, reg_info in mod.LAYOUT.items():
+                name_map.setdefault(base_addr + reg_info['offset'], []).append(
+                    (f"{mod.__name__}{module_num}.{reg_name}", reg_info['fields']))
+    return name_map
+
+
+def get_module_trigger_map():
+    """ Maps register address -> trigger address of the module instance that owns it """
+    trigger_map = {}
+    for mod in CONFIG_PLAN_MODULES:
+        last_offset = max(reg['offset'] for reg in mod.LAYOUT.values())
+        for base_addr in mod.BASE_ADDRESSES.values():
+            for reg_info in mod.LAYOUT.values():
+                trigger_map.setdefault(base_addr + reg_info['offset'],
+                                       base_addr + last_offset)
+    return trigger_map
+
+
+class TCSRegisterDiff:
+    """ One register that differs between two configs, old/new are None when absent """
+
+    def __init__(self, address, old, new, names):
+        self.address = address
+        self.old = old
+        self.new = new
+        self.names = names
+
+    def field_changes(self):
+        """ Returns list of (register name, field name, old, new) for changed fields """
+        changes = []
+        if self.old is None or self.new is None:
+            return changes
+        for reg_name, fields in self.names:
+            for field_name, bit_field in fields.items():
+                old_field = bit_field.get_value(self.old)
+                new_field = bit_field.get_value(self.new)
+                if old_field != new_field:
+                    changes.append((reg_name, field_name, old_field, new_field))
+        return changes
+
+    def __str__(self):
+        old_str = "--" if self.old is None else f"0x{self.old:02x}"
+        new_str = "--" if self.new is None else f"0x{self.new:02x}"
+        name = " / ".join(reg_name for reg_name, _ in self.names) or "unknown"
+        return f"0x{self.address:04X} {name}: {old_str} -> {new_str}"
+
+
+def tcs_final_values(config_data):
+    """ Last value written to each register, page register window excluded """
+    values = {}
+    for register, value in config_data:
+        if (register & 0xff) < DPLL_PAGE_REG_OFFSET:
+            values[register] = value
+    return values
+
+
+def diff_tcs_configs(config_a, config_b):
+    """
+    Compares two parsed TCS configs (lists of (register, value)).
+    Returns a list of TCSRegisterDiff sorted by address.
+    """
+    values_a = tcs_final_values(config_a)
+    values_b = tcs_final_values(config_b)
+    name_map = build_register_name_map()
+    diffs = []
+    for address in sorted(values_a.keys() | values_b.keys()):
+        old = values_a.get(address)
+        new = values_b.get(address)
+        if old != new:
+            diffs.append(TCSRegisterDiff(address, old, new,
+                                         name_map.get(address, [])))
+    return diffs
+
+
+def print_tcs_diff(diffs):
+    for diff in diffs:
+        print(diff)
+        for reg_name, field_name, old, new in diff.field_changes():
+            print(f" - {reg_name}.{field_name}: 0x{old:x} -> 0x{new:x}")
+    print(f"{len(diffs)} registers differ")
+
+
+def delta_tcs_config(config_a, config_b):
+    """
+    Minimal list of (register, value) writes that moves a board running
+    config_a to config_b. The trigger register of every module touched by
+    the delta is rewritten last with its config_b value so the change latches.
+    """
+    values_b = tcs_final_values(config_b)
+    trigger_map = get_module_trigger_map()
+    delta = []
+    triggers = []
+    for diff in diff_tcs_configs(config_a, config_b):
+        if diff.new is None:
+            # register only set in config_a, nothing to write towards config_b
+            continue
+        delta.append((diff.address, diff.new))
+        trigger = trigger_map.get(diff.address)
+        if (trigger is not None and trigger != diff.address
+                and trigger in values_b and trigger not in triggers):
+            triggers.append(trigger)
+
+    written = {address for address, _ in delta}
+    for trigger in triggers:
+        if trigger not in written:
+            delta.append((trigger, values_b[trigger]))
+    return delta
+
+
+def load_delta_write_plan(file_path_a, file_path_b):
+    """ Compiled write plan that moves a board from TCS file a to TCS file b """
+    return compile_tcs_write_plan(
+        delta_tcs_config(parse_dpll_tcs_config_file(file_path_a),
+                         parse_dpll_tcs_config_file(file_path_b)))
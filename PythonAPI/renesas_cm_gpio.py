@@ -14,6 +14,24 @@ class gpiomode(Enum):
     OUTPUT = 1     # Режим выхода
     FUNCTION = 2   # Специальная функция
     
+
+GPIO_CFG_OFFSET = 0x10          # Регистр конфигурации пина (триггерный)
+GPIO_CFG_INPUT = 0x0
+GPIO_CFG_OUTPUT = 0x4
+GPIO_OUTPUT_LATCH_ADDR = 0xc160 # Защёлка выходов, 0xc160 пины 0-7, 0xc161 (триггер) пины 8-15
+GPIO_LEVEL_ADDR = 0xc0c6        # Уровни пинов, Status 0x8a/0x8b
+
+
+def decode_pin_mode(cfg):
+    """
+    Режим пина по значению регистра конфигурации
+    """
+    if cfg & 0x1:
+        return gpiomode.FUNCTION
+    if cfg & 0x4:
+        return gpiomode.OUTPUT
+    return gpiomode.INPUT
+
     
 # Класс для управления GPIO пинами Renesas CM
 class cm_gpios:
@@ -29,6 +47,72 @@ class cm_gpios:
                 0xc9a4, 0xc9b6, 0xc9c8, 0xc9da, 0xca00]
         # Допустимые номера пинов
         self.valid_num = [i for i in range(0,16)]
+        # Кэш защёлки выходов (16 битов) и регистров конфигурации,
+        # None - значение ещё не читалось
+        self.latch_cache = None
+        self.cfg_cache = [None] * 16
+
+    def invalidate_cache(self):
+        """
+        Сброс кэша, нужен после записи конфигурации в обход этого класса
+        (программирование платы, сброс DPLL)
+        """
+        self.latch_cache = None
+        self.cfg_cache = [None] * 16
+
+    def read_output_latch(self, refresh=False):
+        """
+        Значение защёлки выходов всех 16 пинов, из кэша если оно известно
+        """
+        if self.latch_cache is None or refresh:
+            data = self.i2c_dev.read_dpll_reg_multiple(GPIO_OUTPUT_LATCH_ADDR, 0x0, 2)
+            self.latch_cache = data[0] | (data[1] << 8)
+        return self.latch_cache
+
+    def configure_pins(self, outputs=0, levels=0, inputs=0):
+        """
+        Групповая конфигурация GPIO
+        outputs - маска пинов, переводимых в режим выхода
+        levels - уровни выходов (биты вне outputs не используются)
+        inputs - маска пинов, переводимых в режим входа
+        Защёлка обоих банков пишется одной транзакцией и только при
+        изменении, регистр конфигурации - только у пинов со сменой режима
+        """
+        outputs &= 0xffff
+        inputs &= 0xffff & ~outputs
+        with self.i2c_dev.lock:
+            if outputs:
+                latch = self.read_output_latch()
+                new_latch = (latch & ~outputs) | (levels & outputs)
+                if new_latch != latch:
+                    # Последний байт 0xc161 - триггерный регистр защёлки
+                    self.i2c_dev.write_dpll_multiple(GPIO_OUTPUT_LATCH_ADDR,
+                                                     [new_latch & 0xff, new_latch >> 8])
+                    self.latch_cache = new_latch
+
+            for pin_num in self.valid_num:
+                if outputs & (1 << pin_num):
+                    cfg = GPIO_CFG_OUTPUT
+                elif inputs & (1 << pin_num):
+                    cfg = GPIO_CFG_INPUT
+                else:
+                    continue
+                if self.cfg_cache[pin_num] != cfg:
+                    self.i2c_dev.write_dpll_reg(self.base_addrs[pin_num], GPIO_CFG_OFFSET, cfg)
+                    self.cfg_cache[pin_num] = cfg
+
+    def read_all_pins(self):
+        """
+        Режимы и уровни всех пинов за одно групповое чтение
+        Возвращает список [режим, значение] для пинов 0-15
+        """
+        addresses = [GPIO_LEVEL_ADDR, GPIO_LEVEL_ADDR + 1] + [
+            base_addr + GPIO_CFG_OFFSET for base_addr in self.base_addrs]
+        values = self.i2c_dev.read_dpll_regs(addresses)
+        levels = values[0] | (values[1] << 8)
+        self.cfg_cache = values[2:]
+        return [[decode_pin_mode(cfg), (levels >> pin_num) & 0x1]
+                for pin_num, cfg in enumerate(self.cfg_cache)]
 
     # Режим может иметь много значений в теории
     # Кодирование: 1 = выход, 0 = вход
@@ -42,32 +126,13 @@ class cm_gpios:
         if pin_num not in self.valid_num:
             return
         #print(f"Configure DPLL GPIO{pin_num} mode {mode} value {value}")
-        # Записываем функцию включения GPIO и режим CMOS
+        # 0x10 в руководстве по программированию v4.9, 0x11 в 5.3, предполагаем 4.9
         if ( mode == gpiomode.INPUT ):
-            # 0x10 в руководстве по программированию v4.9, 0x11 в 5.3, предполагаем 4.9
-            self.i2c_dev.write_dpll_reg(self.base_addrs[pin_num], 0x10, 0x0) # Триггерный регистр
-        elif ( mode == gpiomode.OUTPUT ):            
+            self.configure_pins(inputs=1 << pin_num)
+        elif ( mode == gpiomode.OUTPUT ):
             # 0x2 в 5.3, 0x0 в v4.9, предполагаем 4.9
-            if ( pin_num >= 8 ):
-                # Для пинов 8-15 используем регистр 0xc161
-                read_val = self.i2c_dev.read_dpll_reg(0xc161, 0x0)
-                if ( value ):                
-                    read_val |= (1 << pin_num-8)  # Устанавливаем бит
-                else:
-                    read_val &= ~(1 << pin_num-8)  # Сбрасываем бит
-                self.i2c_dev.write_dpll_reg(0xc161, 0x0, read_val)
-                self.i2c_dev.write_dpll_reg(0xc161, 0x0, self.i2c_dev.read_dpll_reg(0xc161, 0x0) ) # Триггерный регистр
-                self.i2c_dev.write_dpll_reg(self.base_addrs[pin_num], 0x10, 0x4) # Триггерный регистр GPIO и установка на выход
-            else:
-                # Для пинов 0-7 используем регистр 0xc160
-                read_val = self.i2c_dev.read_dpll_reg(0xc160, 0x0)
-                if ( value ):                
-                    read_val |= (1 << pin_num)
-                else:
-                    read_val &= ~(1 << pin_num)
-                self.i2c_dev.write_dpll_reg(0xc160, 0x0, read_val)
-                self.i2c_dev.write_dpll_reg(0xc160, 0x1, self.i2c_dev.read_dpll_reg(0xc160, 0x1) ) # Триггерный регистр
-                self.i2c_dev.write_dpll_reg(self.base_addrs[pin_num], 0x10, 0x4) # Триггерный регистр GPIO и установка на выход
+            self.configure_pins(outputs=1 << pin_num,
+                                levels=(1 << pin_num) if value else 0)
 
     # Возвращает [режим, значение]
     def read_pin_mode(self, pin_num: int) -> [int, int]:
@@ -91,14 +156,7 @@ class cm_gpios:
         val = (val >> pin_num) & 0x1  # Извлекаем бит для нужного пина
         return [ mode, val ] 
         
-    def print_status(self, pin_num: int):
-        """
-        Вывод статуса GPIO пина
-        pin_num - номер пина
-        """
-        if pin_num not in self.valid_num:
-            return
-        [mode,val] = self.read_pin_mode(pin_num)
+    def format_status(self, pin_num: int, mode, val) -> str:
         mode_str = ""
         if ( mode == gpiomode.INPUT ):
             mode_str = "Input"
@@ -108,16 +166,21 @@ class cm_gpios:
             mode_str = "Function"
         else:
             mode_str = "UNKNOWN"
-        print(f"GPIO{pin_num} mode={mode_str} value={val}")
-        
+        return f"GPIO{pin_num} mode={mode_str} value={val}"
+
+    def print_status(self, pin_num: int):
+        """
+        Вывод статуса GPIO пина
+        pin_num - номер пина
+        """
+        if pin_num not in self.valid_num:
+            return
+        [mode,val] = self.read_pin_mode(pin_num)
+        print(self.format_status(pin_num, mode, val))
+
     def __str__(self):
         """
-        Строковое представление - выводит статус всех GPIO
+        Строковое представление - статус всех GPIO, одно групповое чтение
         """
-        # Читаем обратно все конфигурации
-        for i in self.valid_num:
-            self.print_status(i)
-            
-        
-        
- 
+        return "\n".join(self.format_status(pin_num, mode, val) for pin_num, [mode, val]
+                         in enumerate(self.read_all_pins()))
@@ -1,5 +1,6 @@
 import re
 from renesas_cm_gpio import cm_gpios
+from i2c_miniptm import SMBUS_BLOCK_MAX
 
 
 class BitField:
@@ -975,6 +976,11 @@ class EEPROM(Module):
                          EEPROM.BASE_ADDRESSES)
 
 
+# EEPROM_DATA is 128 bytes at 0xCF80, but 0xCFFC-0xCFFF is the page register
+# window with 1-byte i2c addressing, so only the first 124 bytes are usable
+EEPROM_DATA_FIFO_SIZE = 0x7C
+
+
 class EEPROM_DATA(Module):
     BASE_ADDRESSES = {0: 0xCF80}  # Only one base address for PWM_USER_DATA
     LAYOUT = BYTE_BUFFER_LAYOUT
@@ -983,6 +989,26 @@ class EEPROM_DATA(Module):
         super().__init__("EEPROM_DATA", EEPROM_DATA.LAYOUT,
                          EEPROM_DATA.BASE_ADDRESSES)
 
+    def write_fifo(self, data, module_num=0):
+        # whole PWM user data / EEPROM payload in block writes
+        self._validate_module_num(module_num)
+        if len(data) > EEPROM_DATA_FIFO_SIZE:
+            raise ValueError(f"FIFO payload {len(data)} bytes, max {EEPROM_DATA_FIFO_SIZE}")
+        base_address = self.base_addresses[module_num]
+        for pos in range(0, len(data), SMBUS_BLOCK_MAX):
+            self.write_mul_func(base_address + pos, list(data[pos:pos + SMBUS_BLOCK_MAX]))
+
+    def read_fifo(self, length, module_num=0):
+        self._validate_module_num(module_num)
+        if length > EEPROM_DATA_FIFO_SIZE:
+            raise ValueError(f"FIFO payload {length} bytes, max {EEPROM_DATA_FIFO_SIZE}")
+        base_address = self.base_addresses[module_num]
+        data = []
+        for pos in range(0, length, SMBUS_BLOCK_MAX):
+            data += list(self.read_mul_func(base_address + pos,
+                                            min(SMBUS_BLOCK_MAX, length - pos)))
+        return data
+
 
 class OUTPUT_TDC_CFG(Module):
     BASE_ADDRESSES = {0: 0xCCD0}  # Example of multiple base addresses
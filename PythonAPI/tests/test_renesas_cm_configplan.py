@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from renesas_cm_configplan import (ResetDefaults, RESET_DEFAULTS_START, RESET_DEFAULTS_END,
+                                   get_modeled_addresses, get_trigger_addresses,
+                                   minimize_tcs_config)
+from renesas_cm_registers import Input
+
+
+def zero_defaults():
+    return ResetDefaults(bytes(RESET_DEFAULTS_END - RESET_DEFAULTS_START))
+
+
+def test_unmodeled_default_trigger_is_kept():
+    # 0xCD26-0xCD7F is not covered by any module of the register model
+    config = [(0xCD26, 0x5), (0xCD27, 0x3), (0xCD28, 0x0)]
+    assert not any(register in get_modeled_addresses() for register, _ in config)
+    assert minimize_tcs_config(config, zero_defaults()) == config
+
+
+def test_modeled_default_write_is_dropped():
+    base = Input.BASE_ADDRESSES[0]
+    trigger = max(reg['offset'] for reg in Input.LAYOUT.values()) + base
+    assert trigger in get_trigger_addresses()
+    config = [(base, 0x0), (base + 1, 0x7), (trigger, 0x0)]
+    assert minimize_tcs_config(config, zero_defaults()) == [(base + 1, 0x7), (trigger, 0x0)]
@@ -0,0 +1,360 @@
+
+import math
+import queue
+import threading
+import time
+
+from crosstimestamp_miniptm import tod_bytes_to_nanoseconds
+from i2c_miniptm import SMBUS_BLOCK_MAX
+
+#########
+# Захват TOD по фронту PPS (или другого входа) на всех платах сразу
+# Чтение TOD в непрерывном режиме защёлкивает TOD на каждом фронте и
+# увеличивает счётчик COUNTER. Вместо опроса каждые 100 мс сервис
+# предсказывает следующий фронт по прошлым захватам, спит до момента
+# чуть раньше него и опрашивает счётчик без пауз в коротком окне.
+# Между фронтами шина свободна. Захваты передаются подписчикам.
+
+TOD_READ_CMD_DISABLE = 0x0
+TOD_READ_CMD_REF = 0x3
+TOD_READ_CMD_PWM_DECODER = 0x4
+TOD_READ_TRIGGER_CONTINUOUS = 0x10   # TOD_READ_TRIGGER_MODE, защёлка на каждом фронте
+
+TOD_BYTES = 11
+TOD_COUNTER_OFFSET = 0xB             # COUNTER сразу за байтами TOD
+
+CAPTURE_GUARD = 0.02          # начало опроса до предсказанного фронта, с
+CAPTURE_WINDOW = 0.05         # опрос после предсказанного фронта, с
+CAPTURE_POLL_INTERVAL = 0.0005
+CAPTURE_SEARCH_INTERVAL = 0.01  # опрос, пока фронт не предсказан
+CAPTURE_MAX_MISSES = 3        # пропущенных фронтов до возврата к поиску
+
+
+class TODCapture:
+    """
+    Один захват TOD
+    tod - 11 байтов TOD (subns, ns, секунды)
+    tod_ns - TOD в целых наносекундах
+    counter - значение COUNTER, missed - пропущенные фронты перед этим
+    host_time - time.monotonic() фронта, середина между опросами
+    host_uncertainty - половина интервала между опросами, с
+    """
+    __slots__ = ("board_num", "tod_num", "tod", "tod_ns", "counter", "missed",
+                 "host_time", "host_uncertainty")
+
+    def __init__(self, board_num, tod_num, tod, counter, missed, host_time,
+                 host_uncertainty):
+        self.board_num = board_num
+        self.tod_num = tod_num
+        self.tod = tod
+        self.tod_ns = tod_bytes_to_nanoseconds(tod)
+        self.counter = counter
+        self.missed = missed
+        self.host_time = host_time
+        self.host_uncertainty = host_uncertainty
+
+    def __repr__(self):
+        return (f"Board {self.board_num} TOD{self.tod_num} = {self.tod_ns} ns "
+                f"(count {self.counter}, host {self.host_time:.4f} "
+                f"+/- {self.host_uncertainty * 1e3:.2f} ms)")
+
+
+class EdgePredictor:
+    """
+    Предсказание следующего фронта по времени прошлых захватов
+    Предсказание начинается после двух захватов с точным временем подряд,
+    период затем уточняется сглаживанием
+    """
+
+    def __init__(self, period=1.0, alpha=0.2, max_misses=CAPTURE_MAX_MISSES):
+        self.nominal_period = period
+        self.period = period
+        self.alpha = alpha
+        self.max_misses = max_misses
+        self.last_edge = None
+        self.period_measured = False
+
+    def reset(self):
+        self.period = self.nominal_period
+        self.last_edge = None
+        self.period_measured = False
+
+    def update(self, capture, max_uncertainty=CAPTURE_GUARD):
+        if capture.host_uncertainty >= max_uncertainty:
+            # фронт пришёл раньше окна, момент неизвестен - снова поиск
+            self.last_edge = None
+            self.period_measured = False
+            return
+        if self.last_edge is not None:
+            # COUNTER точно говорит, сколько периодов прошло
+            measured = (capture.host_time - self.last_edge) / (capture.missed + 1)
+            if not self.period_measured or abs(measured - self.period) > 0.1 * self.period:
+                self.period = measured
+                self.period_measured = True
+            else:
+                self.period += self.alpha * (measured - self.period)
+        self.last_edge = capture.host_time
+
+    def next_edge(self, now, window=CAPTURE_WINDOW):
+        """
+        Ближайший фронт не раньше now - window, None если фронт не предсказуем
+        """
+        if self.last_edge is None or not self.period_measured:
+            return None
+        periods = max(1, math.ceil((now - window - self.last_edge) / self.period))
+        if periods > self.max_misses + 1:
+            # слишком долго без захватов, начинаем поиск заново
+            self.reset()
+            return None
+        return self.last_edge + periods * self.period
+
+
+class TODTrigger:
+    """
+    Непрерывное чтение TOD tod_num платы по фронту входа input_num
+    use_sec - TODReadSecondary вместо TODReadPrimary
+    is_pwm_decoder - фронт от PWM декодера input_num, иначе от входа
+    """
+
+    def __init__(self, board, tod_num=0, use_sec=True, is_pwm_decoder=False, input_num=0):
+        self.board = board
+        self.tod_num = tod_num
+        self.is_pwm_decoder = is_pwm_decoder
+        self.input_num = input_num
+        if use_sec:
+            self.module = board.dpll.modules["TODReadSecondary"]
+            self.prefix = "TOD_READ_SECONDARY"
+        else:
+            self.module = board.dpll.modules["TODReadPrimary"]
+            self.prefix = "TOD_READ_PRIMARY"
+        self.last_counter = None
+        self.last_poll = None
+
+    def arm(self):
+        module = self.module
+        module.write_reg(self.tod_num, f"{self.prefix}_CMD", TOD_READ_CMD_DISABLE)
+        if self.is_pwm_decoder:
+            module.write_reg(self.tod_num, f"{self.prefix}_SEL_CFG_0", (self.input_num & 0xf) << 4)
+            cmd = TOD_READ_CMD_PWM_DECODER
+        else:
+            module.write_reg(self.tod_num, f"{self.prefix}_SEL_CFG_0", self.input_num & 0xf)
+            cmd = TOD_READ_CMD_REF
+        self.last_counter = module.read_reg(self.tod_num, f"{self.prefix}_COUNTER")
+        self.last_poll = time.monotonic()
+        module.write_reg(self.tod_num, f"{self.prefix}_CMD", cmd | TOD_READ_TRIGGER_CONTINUOUS)
+
+    def disarm(self):
+        self.module.write_reg(self.tod_num, f"{self.prefix}_CMD", TOD_READ_CMD_DISABLE)
+
+    def poll(self):
+        """
+        Одно чтение TOD и счётчика, возвращает TODCapture при новом фронте или None
+        """
+        data = self.module.read_reg_mul(self.tod_num, f"{self.prefix}_SUBNS",
+                                        TOD_BYTES + 1)
+        now = time.monotonic()
+        prev_poll = self.last_poll
+        self.last_poll = now
+        counter = data[TOD_COUNTER_OFFSET]
+        if counter == self.last_counter:
+            return None
+
+        # Счётчик читается после байтов TOD, фронт мог прийти между ними.
+        # Перечитываем, пока счётчик не совпадёт до и после TOD
+        for i in range(3):
+            data = self.module.read_reg_mul(self.tod_num, f"{self.prefix}_SUBNS",
+                                            TOD_BYTES + 1)
+            if data[TOD_COUNTER_OFFSET] == counter:
+                break
+            counter = data[TOD_COUNTER_OFFSET]
+
+        missed = ((counter - self.last_counter) & 0xff) - 1
+        self.last_counter = counter
+        return TODCapture(self.board.board_num, self.tod_num, list(data[:TOD_BYTES]),
+                          counter, missed, (prev_poll + now) / 2, (now - prev_poll) / 2)
+
+
+class TODSecondaryGroup:
+    """
+    Четыре TODReadSecondary одной платы на одном триггере
+    Все четыре лежат на одной странице и читаются одним блоком (две
+    транзакции SMBus). Счётчики всех четырёх растут на одном фронте, поэтому
+    разность счётчиков между TOD постоянна - по ней видно, что фронт не
+    пришёл посреди чтения
+    """
+
+    def __init__(self, board):
+        self.board = board
+        module = board.dpll.modules["TODReadSecondary"]
+        self.bases = [module.BASE_ADDRESSES[tod_num] for tod_num in range(4)]
+        self.sel_offset = module.LAYOUT["TOD_READ_SECONDARY_SEL_CFG_0"]["offset"]
+        self.cmd_offset = module.LAYOUT["TOD_READ_SECONDARY_CMD"]["offset"]
+        self.length = self.bases[-1] - self.bases[0] + TOD_BYTES + 1
+        # разность счётчиков TOD1-3 относительно TOD0, None - ещё не известна
+        self.counter_skew = None
+
+    def arm(self, cmd, pwm_decoder=None, ref_index=None):
+        """
+        cmd - значение TOD_READ_SECONDARY_CMD (например 0x14, PWM декодер непрерывно)
+        pwm_decoder, ref_index - источник в SEL_CFG_0, None - оставить как есть
+        Сначала все четыре выключаются с новым SEL_CFG, затем включаются подряд
+        """
+        i2c = self.board.i2c
+        with i2c.lock:
+            # SEL_CFG_0 и SEL_CFG_1 всех четырёх одним блочным чтением
+            sel_cfg = i2c.read_dpll_block(self.bases[0] + self.sel_offset,
+                                          self.bases[-1] - self.bases[0] + 2)
+            for base in self.bases:
+                sel_cfg_0 = sel_cfg[base - self.bases[0]]
+                sel_cfg_1 = sel_cfg[base - self.bases[0] + 1]
+                if pwm_decoder is not None:
+                    sel_cfg_0 = (sel_cfg_0 & 0x0f) | ((pwm_decoder & 0xf) << 4)
+                if ref_index is not None:
+                    sel_cfg_0 = (sel_cfg_0 & 0xf0) | (ref_index & 0xf)
+                i2c.write_dpll_multiple(base + self.sel_offset,
+                                        [sel_cfg_0, sel_cfg_1, TOD_READ_CMD_DISABLE])
+            for base in self.bases:
+                i2c.write_dpll_reg_direct(base + self.cmd_offset, cmd)
+            self.counter_skew = None
+
+    def _counters(self, data):
+        return [data[base - self.bases[0] + TOD_COUNTER_OFFSET] for base in self.bases]
+
+    def read(self, retries=3):
+        """
+        Согласованное чтение четырёх TOD
+        Пока разность счётчиков не известна, первая транзакция читается
+        повторно и сравнивается
+        Возвращает кортеж из четырёх списков по 11 байтов TOD
+        """
+        i2c = self.board.i2c
+        check_len = min(self.length, SMBUS_BLOCK_MAX)
+        with i2c.lock:
+            for i in range(retries):
+                data = i2c.read_dpll_block(self.bases[0], self.length)
+                counters = self._counters(data)
+                skew = [(counter - counters[0]) & 0xff for counter in counters]
+                if skew == self.counter_skew:
+                    break
+                check = i2c.read_dpll_reg_multiple(self.bases[0], 0, check_len)
+                if bytes(check) == bytes(data[:check_len]):
+                    self.counter_skew = skew
+                    break
+            else:
+                print(f"Board {self.board.board_num} TOD secondary read not coherent "
+                      f"after {retries} tries")
+        return tuple(list(data[base - self.bases[0]:base - self.bases[0] + TOD_BYTES])
+                     for base in self.bases)
+
+
+class TODCaptureService:
+    """
+    Захват TOD на всех платах и TOD одновременно
+    Один поток на плату (у каждой своя I2C шина), подписчики вызываются
+    из этих потоков: callback(TODCapture)
+    """
+
+    def __init__(self, boards, tod_nums=(0,), use_sec=True, is_pwm_decoder=False,
+                 input_num=0, period=1.0, guard=CAPTURE_GUARD, window=CAPTURE_WINDOW,
+                 poll_interval=CAPTURE_POLL_INTERVAL,
+                 search_interval=CAPTURE_SEARCH_INTERVAL):
+        """
+        boards - список Single_MiniPTM
+        tod_nums - номера TOD на каждой плате
+        period - номинальный период фронтов, с
+        guard, window - окно опроса вокруг предсказанного фронта, с
+        """
+        self.boards = boards
+        self.guard = guard
+        self.window = window
+        self.poll_interval = poll_interval
+        self.search_interval = search_interval
+        self.triggers = {board.board_num: [TODTrigger(board, tod_num, use_sec,
+                                                      is_pwm_decoder, input_num)
+                                           for tod_num in tod_nums]
+                         for board in boards}
+        self.predictors = {(board.board_num, tod_num): EdgePredictor(period)
+                           for board in boards for tod_num in tod_nums}
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def subscribe(self, callback):
+        with self.subscribers_lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.subscribers_lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def capture_queue(self):
+        """ Подписка через очередь, возвращает queue.Queue с TODCapture """
+        capture_q = queue.Queue()
+        self.subscribe(capture_q.put)
+        return capture_q
+
+    def _deliver(self, capture):
+        self.predictors[(capture.board_num, capture.tod_num)].update(capture, self.guard)
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(capture)
+
+    def _board_main(self, board_num):
+        triggers = self.triggers[board_num]
+        predictors = [self.predictors[(board_num, trigger.tod_num)] for trigger in triggers]
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            edges = [predictor.next_edge(now, self.window) for predictor in predictors]
+            if None in edges:
+                # фронт ещё не предсказан, редкий опрос
+                interval = self.search_interval
+            else:
+                delay = min(edges) - self.guard - now
+                if delay > 0:
+                    # до фронта далеко, шина свободна
+                    self.stop_event.wait(delay)
+                    continue
+                interval = self.poll_interval
+
+            try:
+                for trigger in triggers:
+                    capture = trigger.poll()
+                    if capture is not None:
+                        self._deliver(capture)
+            except OSError as e:
+                print(f"Board {board_num} TOD capture read failed: {e}")
+            self.stop_event.wait(interval)
+
+    def start(self):
+        if self.threads:
+            return
+        self.stop_event.clear()
+        for board in self.boards:
+            for trigger in self.triggers[board.board_num]:
+                trigger.arm()
+        for board in self.boards:
+            thread = threading.Thread(target=self._board_main, args=(board.board_num,),
+                                      daemon=True, name=f"tod_capture_{board.board_num}")
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        if not self.threads:
+            return
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for board in self.boards:
+            for trigger in self.triggers[board.board_num]:
+                trigger.disarm()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,8 +1,12 @@
 # Импорт модулей для работы с устройствами MiniPTM
-from pcie_miniptm import get_miniptm_devices
-from i2c_miniptm import find_i2c_buses
-from board_miniptm import Single_MiniPTM
+from topology_miniptm import get_board_table
+from board_miniptm import Single_MiniPTM, EEPROM_SIZE
+from tod_capture_miniptm import TODCaptureService
+from frame_sync_miniptm import FrameSyncCoordinator
+from dpof_runtime_miniptm import DPOFRuntimeGroup
+from filters_miniptm import MovingAverageFilter
 from renesas_cm_configfiles import *
+from renesas_cm_configplan import *
 import concurrent.futures  # Для параллельного выполнения задач
 import time
 import argparse  # Для обработки аргументов командной строки
@@ -199,29 +203,15 @@ def calculate_cost_function(
 # END Genetic functions
 
 
-class MovingAverageFilter:
-    def __init__(self, window_size=5, outlier_percentage=50):
-        self.window_size = window_size
-        self.outlier_percentage = outlier_percentage / 100.0
-        self.rolling_window = []
-        self.previous_average = None
-
-    def update(self, new_sample):
-        if self.previous_average is not None and self.previous_average != 0:
-            percentage_change = abs(
-                new_sample - self.previous_average) / abs(self.previous_average)
-
-            if percentage_change > self.outlier_percentage:
-                return self.previous_average  # Ignore outlier and return previous average
-
-        self.rolling_window.append(new_sample)
-        if len(self.rolling_window) > self.window_size:
-            self.rolling_window.pop(0)
-
-        if len(self.rolling_window) > 0:
-            self.previous_average = np.mean(self.rolling_window)
-
-        return self.previous_average
+def load_program_plan(config_file, defaults_file=None, fresh_reset=False):
+    if defaults_file is None:
+        return load_tcs_write_plan(config_file)
+    # registers dropped as default keep their old value on a configured board
+    if not fresh_reset:
+        raise ValueError("A plan minimized against reset defaults is only correct "
+                         "on a freshly reset board, confirm with fresh_reset")
+    return load_minimized_write_plan(config_file,
+                                     ResetDefaults.load(defaults_file))
 
 
 class MiniPTM:
@@ -233,22 +223,41 @@ class MiniPTM:
     PFM_KI = 0.3
 
     def __init__(self):
-        miniptm_devs = get_miniptm_devices()
-        # print(f"Got {len(miniptm_devs)} mini ptm devices: {miniptm_devs}")
-
-        i2c_busses = find_i2c_buses("MiniPTM I2C Adapter")
-        # print(f"Matching i2c buses: {i2c_busses}")
+        # board table maps each i2c adapter to its PCI parent, cached between runs
+        self.board_table = get_board_table()
+        # print(f"Board table: {self.board_table}")
 
-        if (len(miniptm_devs) != len(i2c_busses)):
-            print("Mismatch between number of pcie devices and i2c busses, end!")
-            return
-
-        # assume theyre in order, probably terrible assumption but oh well
         self.boards = []
-
-        for i in range(len(miniptm_devs)):
+        for board_info in self.board_table:
             self.boards.append(Single_MiniPTM(
-                i, miniptm_devs[i], i2c_busses[i]))
+                board_info.board_id, board_info.devinfo(), board_info.i2c_bus))
+
+    def get_board(self, board_num):
+        # board numbers are stable and may have gaps, dont index self.boards
+        for board in self.boards:
+            if board.board_num == board_num:
+                return board
+        raise ValueError(f"No board {board_num}")
+
+    def tod_capture_service(self, tod_nums=(0,), use_sec=True, is_pwm_decoder=False,
+                            input_num=0, board_list=None):
+        # TOD captures on the same trigger input for all (or listed) boards,
+        # use start()/stop() or a with block and subscribe() for the captures
+        boards = self.boards
+        if board_list is not None:
+            boards = [self.get_board(board_num) for board_num in board_list]
+        return TODCaptureService(boards, tod_nums, use_sec, is_pwm_decoder, input_num)
+
+    def frame_sync_all_boards(self, tod_num=0, dpll_frame_sync=[0], clkin=13,
+                              timeout=30, good_count_threshold=10, board_list=None):
+        # frame sync convergence on all (or listed) boards at the same time,
+        # returns dict board number -> True if it converged
+        boards = self.boards
+        if board_list is not None:
+            boards = [self.get_board(board_num) for board_num in board_list]
+        coordinator = FrameSyncCoordinator(boards, tod_num, dpll_frame_sync,
+                                           clkin, good_count_threshold)
+        return coordinator.run(timeout)
 
     def check_user_input(self):
         # pop the latest
@@ -280,17 +289,30 @@ class MiniPTM:
             print(
                 f"Board {board.adap_num} 0x{address:x}=0x{value:x}")
             board.i2c.write_dpll_reg_direct(address, value)
+        board.dpll.gpio.invalidate_cache()
+        return board.adap_num
+
+    def program_one_board_plan(self, board, plan):
+        # block writes of the compiled runs instead of one transaction per byte
+        for start, run in plan:
+            print(
+                f"Board {board.adap_num} 0x{start:x} {len(run)} bytes")
+            board.i2c.write_dpll_block(start, run)
+        # конфигурация могла переписать GPIO и защёлку выходов
+        board.dpll.gpio.invalidate_cache()
         return board.adap_num
 
     def program_all_boards(
             self,
             config_file="8A34002_MiniPTMV3_12-24-2023_Julian.tcs",
-            check_first=False):
+            check_first=False,
+            defaults_file=None,
+            fresh_reset=False):
         # now lets do some initialization if needed. Do a simple check on each board
         # if the GPIOs for LEDs are set for output, then assume the board is
         # configured
-        parsed_config_tcs = parse_dpll_tcs_config_file(config_file)
-        # print(f"First few tcs lines: {parsed_config_tcs[:10]}")
+        plan = load_program_plan(config_file, defaults_file, fresh_reset)
+        print(f"{config_file}: {len(plan)} runs, {plan.num_bytes()} bytes")
 
         with concurrent.futures.ThreadPoolExecutor() as executor:
             futures = []
@@ -300,39 +322,117 @@ class MiniPTM:
                         print(
                             f"Board {board.adap_num} not configured, configuring!")
                         futures.append(executor.submit(
-                            self.program_one_board, board, parsed_config_tcs))
+                            self.program_one_board_plan, board, plan))
                         # self.program_one_board(board, parsed_config_tcs)
                     else:
                         print(f"Board {board.adap_num} already configured!")
                 else:
                     print(f"Board {board.adap_num} configuring!")
                     futures.append(executor.submit(
-                        self.program_one_board, board, parsed_config_tcs))
+                        self.program_one_board_plan, board, plan))
                     # self.program_one_board(board, parsed_config_tcs)
             print(futures)
             for future in concurrent.futures.as_completed(futures):
                 pass
 
+    def set_all_dpll_loop_params(self, board_list, dpll_nums,
+            loopbw=1000, loopbw_units=1, decimator_bw_mult=4, psl=0):
+        # same loop parameters on every listed board, boards in parallel
+        # since each one is on its own i2c bus
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [executor.submit(
+                self.get_board(board_num).set_dpll_loop_params_multi,
+                dpll_nums, loopbw, loopbw_units, decimator_bw_mult, psl)
+                for board_num in board_list]
+            for future in futures:
+                future.result()
+
     def flash_eeprom_one_board(
             self,
             board,
-            eeprom_file="8A34002_MiniPTMV3_12-29-2023_Julian_AllPhaseMeas_EEPROM.hex"):
+            eeprom_file="8A34002_MiniPTMV3_12-29-2023_Julian_AllPhaseMeas_EEPROM.hex",
+            incremental=False):
         print(f"Start flash board {board.board_num} EEPROM = {eeprom_file}")
-        board.write_eeprom_file(eeprom_file)
-        print(f"DONE flash board {board.board_num} EEPROM = {eeprom_file}")
+        if incremental:
+            written, failed = board.write_eeprom_file_incremental(eeprom_file)
+        else:
+            failed = board.write_eeprom_file(eeprom_file)
+        if failed:
+            print(f"FAILED flash board {board.board_num} EEPROM = {eeprom_file}, "
+                  f"{len(failed)} pages: " + ", ".join(f"0x{addr:x}" for addr in failed))
+        else:
+            print(f"DONE flash board {board.board_num} EEPROM = {eeprom_file}")
+        return failed
 
     def flash_all_boards_eeprom(
             self,
-            eeprom_file="8A34002_MiniPTMV3_12-29-2023_Julian_AllPhaseMeas_EEPROM.hex"):
+            eeprom_file="8A34002_MiniPTMV3_12-29-2023_Julian_AllPhaseMeas_EEPROM.hex",
+            incremental=False):
         with concurrent.futures.ThreadPoolExecutor() as executor:
             futures = []
             for board in self.boards:
                 futures.append(executor.submit(
-                    self.flash_eeprom_one_board, board, eeprom_file))
+                    self.flash_eeprom_one_board, board, eeprom_file, incremental))
 
             for future in concurrent.futures.as_completed(futures):
                 pass
 
+    def read_all_boards_eeprom(self, regions=None):
+        # one worker per adapter, each board has its own i2c bus
+        if regions is None:
+            regions = [(0, EEPROM_SIZE)]
+        images = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(self.boards))) as executor:
+            futures = {}
+            for board in self.boards:
+                futures[executor.submit(
+                    self.read_eeprom_regions, board, regions)] = board
+            for future in concurrent.futures.as_completed(futures):
+                images[futures[future].board_num] = future.result()
+        return images
+
+    def read_eeprom_regions(self, board, regions):
+        start = min(region[0] for region in regions)
+        end = max(region[1] for region in regions)
+        data = bytearray([0xFF]) * (end - start)
+        for region_start, region_end in regions:
+            region_data = board.read_from_eeprom(
+                region_start, region_end - region_start)
+            if region_data is None:
+                print(f"Board {board.board_num} EEPROM read failed at 0x{region_start:x}")
+                return None
+            data[region_start - start:region_end - start] = region_data
+        return IntelHexImage(start, data, list(regions))
+
+    def dump_all_boards_eeprom(self, dump_prefix="eeprom_dump_board"):
+        images = self.read_all_boards_eeprom()
+        for board_num in sorted(images):
+            if images[board_num] is None:
+                continue
+            file_path = f"{dump_prefix}{board_num}.hex"
+            write_intel_hex_file(file_path, images[board_num])
+            print(f"Board {board_num} EEPROM dumped to {file_path}")
+
+    def verify_all_boards_eeprom(self, eeprom_file):
+        # only the regions present in the reference file are read back
+        reference = load_intel_hex_image(eeprom_file)
+        images = self.read_all_boards_eeprom(reference.regions)
+        all_match = True
+        for board_num in sorted(images):
+            if images[board_num] is None:
+                all_match = False
+                continue
+            mismatches = diff_intel_hex_images(reference, images[board_num])
+            if mismatches:
+                all_match = False
+                print(f"Board {board_num} EEPROM differs from {eeprom_file} in {len(mismatches)} spans")
+                for addr, length in mismatches[:16]:
+                    print(f" - 0x{addr:05x} {length} bytes")
+            else:
+                print(f"Board {board_num} EEPROM matches {eeprom_file}")
+        return all_match
+
     def board_led_blink_test(self):
         # do ID test with GPIOs, toggle DPLL GPIO, then toggle I225 LEDs
         for index, board in enumerate(self.boards):
@@ -584,9 +684,8 @@ class MiniPTM:
         psl_val = int(psl)
 
         # ok now have integer values I can write to DPLL
-        for board_num in board_list:
-            self.boards[board_num].set_dpll_loop_params(
-                sacrifice_num, loopbw_val, loopbw_units, dec_bw_val, psl_val)
+        self.set_all_dpll_loop_params(board_list, [sacrifice_num],
+                loopbw_val, loopbw_units, dec_bw_val, psl_val)
 
         # now read back the ratio between the two boards and take difference to zero
         # use as error term
@@ -717,9 +816,8 @@ class MiniPTM:
                     for psl in psl_list:
 
                         # set the DUT loop parameters
-                        for board_num in board_list:
-                            self.boards[board_num].set_dpll_loop_params(
-                                sacrifice_num, loopbw, loopbw_units, dec_bw, psl)
+                        self.set_all_dpll_loop_params(board_list,
+                                [sacrifice_num], loopbw, loopbw_units, dec_bw, psl)
 
                         # Toggle squelch on generator board to force downstream boards to relock
                         # outputs 8 and 9
@@ -1138,6 +1236,8 @@ class MiniPTM:
         alternate_query_write_flag = 0
         for board in self.boards:
             board.init_pwm_dplloverfiber()
+            # the runtime ticks as fast as the channels need, per tick prints would flood
+            board.dpof.DEBUG_PRINT = False
 
         time_between_queries = 45
 
@@ -1146,67 +1246,67 @@ class MiniPTM:
         time_board_query_response = [0, 0]
         loop_count = 0
 
-        while (True):
-            print(
-                f"\n\n****** DPLL over fiber Top level loop number {loop_count} *******\n\n")
-            for index, board in enumerate(self.boards):
-                # Do periodic queries as necessary and possible
-                time_debug = time.time() - time_board_query_response[index]
-                tx_ready = self.boards[index].dpof.get_chan_tx_ready(0)
-                print(f"Board{index} time {time_debug} , tx_ready={tx_ready}")
-                if (((time.time() - time_board_query_response[index]) >
-                        time_between_queries) and self.boards[index].dpof.get_chan_tx_ready(0)):
-
-                    print(f"Board {board.board_num} start query chan 0")
-                    self.boards[index].dpof.dpof_query(0, 0)
-                    break
+        # each board runs its DPOF state machines in its own thread,
+        # this loop only starts queries and handles results
+        with DPOFRuntimeGroup(self.boards) as runtimes:
+            while (True):
+                print(
+                    f"\n\n****** DPLL over fiber Top level loop number {loop_count} *******\n\n")
+                for index, board in enumerate(self.boards):
+                    # Do periodic queries as necessary and possible
+                    time_debug = time.time() - time_board_query_response[index]
+                    tx_ready = self.boards[index].dpof.get_chan_tx_ready(0)
+                    print(f"Board{index} time {time_debug} , tx_ready={tx_ready}")
+                    if (((time.time() - time_board_query_response[index]) >
+                            time_between_queries) and self.boards[index].dpof.get_chan_tx_ready(0)):
+
+                        print(f"Board {board.board_num} start query chan 0")
+                        self.boards[index].dpof.dpof_query(0, 0)
+                        break
 
-            # run all the dpll loops
-            for board in self.boards:
-                # print(f"\n DPLL Over fiber loop board {board.board_num} \n")
-                board.dpll_over_fiber_loop()
+                # wait for any board to produce results, or check queries again
+                runtimes.wait_for_results(1)
 
-            # check the results from all the dpll over fiber loops
-            for index, board in enumerate(self.boards):
-                query_data = board.dpof.pop_query_data()
-                if (len(query_data)):
-                    print(
-                        f"Board {board.board_num} at top level, got query data {query_data}")
-                    board_query_response[index].append(query_data)
-                    time_board_query_response[index] = time.time()
+                # check the results from all the dpll over fiber loops
+                for index, board in enumerate(self.boards):
+                    query_data = board.dpof.pop_query_data()
+                    if (len(query_data)):
+                        print(
+                            f"Board {board.board_num} at top level, got query data {query_data}")
+                        board_query_response[index].append(query_data)
+                        time_board_query_response[index] = time.time()
 
-                tod_compare_data = board.dpof.get_tod_compare()
-                if (len(tod_compare_data) > 0):
-                    print(
-                        f"Board {board.board_num} at top level, got TOD comparison {tod_compare_data}")
-                    board_tod_comparison[index].append(tod_compare_data)
+                    tod_compare_data = board.dpof.get_tod_compare()
+                    if (len(tod_compare_data) > 0):
+                        print(
+                            f"Board {board.board_num} at top level, got TOD comparison {tod_compare_data}")
+                        board_tod_comparison[index].append(tod_compare_data)
 
-                write_data = board.dpof.pop_write_data()
-                if (len(write_data)):
-                    print(
-                        f"Board {board.board_num} at top level, got write data {write_data}")
-
-            # now do something with the DPLL data
-            for index, board in enumerate(self.boards):
-                while len(board_tod_comparison[index]) > 0:
-                    print(f"Got board {index} tod comparison")
-                    tod_compare = board_tod_comparison[index].pop(0)
-                    self.handle_tod_compare(board, tod_compare)
-
-                while len(board_query_response[index]) > 0:
-                    print(f"Got board {index} query response")
-                    response = board_query_response[index].pop(0)
-                    self.handle_query_response(board, response)
-
-            # check for channels where acting as master
-            for index, board in enumerate(self.boards):
-                master_channels = board.dpof.get_channels_following()
-                if len(master_channels):
-                    print(
-                        f"Board {index} has master channels {master_channels}")
+                    write_data = board.dpof.pop_write_data()
+                    if (len(write_data)):
+                        print(
+                            f"Board {board.board_num} at top level, got write data {write_data}")
+
+                # now do something with the DPLL data
+                for index, board in enumerate(self.boards):
+                    while len(board_tod_comparison[index]) > 0:
+                        print(f"Got board {index} tod comparison")
+                        tod_compare = board_tod_comparison[index].pop(0)
+                        self.handle_tod_compare(board, tod_compare)
+
+                    while len(board_query_response[index]) > 0:
+                        print(f"Got board {index} query response")
+                        response = board_query_response[index].pop(0)
+                        self.handle_query_response(board, response)
+
+                # check for channels where acting as master
+                for index, board in enumerate(self.boards):
+                    master_channels = board.dpof.get_channels_following()
+                    if len(master_channels):
+                        print(
+                            f"Board {index} has master channels {master_channels}")
 
-            time.sleep(0.25)
-            loop_count += 1
+                loop_count += 1
 
 
 #############
@@ -2675,7 +2775,7 @@ if __name__ == "__main__":
     parser.add_argument(
         'command',
         type=str,
-        help='What command to run, blinktest / program / debug_dpof / debug_pfm / flash / read / write')
+        help='What command to run, blinktest / program / program_delta / diff / capture_defaults / debug_dpof / debug_pfm / flash / dump_eeprom / verify_eeprom / read / write')
     parser.add_argument(
         '--config_file',
         type=str,
@@ -2686,6 +2786,22 @@ if __name__ == "__main__":
         type=str,
         default="8A34002_MiniPTMV3_1-17-2024_Julian_PFM_PMOS_Master_EEPROM.hex",
         help="File to flash to EEPROM")
+    parser.add_argument(
+        '--target_config_file',
+        type=str,
+        help="Config to move to, for diff / program_delta")
+    parser.add_argument(
+        '--defaults_file',
+        type=str,
+        help="Reset default table, writes matching it are skipped when programming. "
+             "Only correct on freshly reset boards, needs --fresh_reset")
+    parser.add_argument('--fresh_reset', action='store_true',
+                        help="program: confirm the boards were reset and not programmed since, "
+                             "required with --defaults_file")
+    parser.add_argument('--dump_prefix', type=str, default="eeprom_dump_board",
+                        help="dump_eeprom: output files are <prefix><board>.hex")
+    parser.add_argument('--incremental', action='store_true',
+                        help="flash: only write EEPROM pages that differ, then verify them")
     parser.add_argument('--board_id', type=int, help="Board number to program")
     parser.add_argument("--reg_addr", type=str, default="0xc024",
                         help="Register address to read or write")
@@ -2706,12 +2822,38 @@ if __name__ == "__main__":
     if args.command == "program":
         top=MiniPTM()
         if args.board_id is not None:
-            parsed_config_tcs=parse_dpll_tcs_config_file(args.config_file)
-            top.program_one_board(top.boards[args.board_id], parsed_config_tcs)
+            plan=load_program_plan(args.config_file, args.defaults_file,
+                                   args.fresh_reset)
+            top.program_one_board_plan(top.get_board(args.board_id), plan)
         else:
-            top.program_all_boards(config_file=args.config_file)
+            top.program_all_boards(config_file=args.config_file,
+                                   defaults_file=args.defaults_file,
+                                   fresh_reset=args.fresh_reset)
 
         # top.set_all_boards_leds_idcode()
+    elif args.command == "diff":
+        # no hardware needed, compare config_file against target_config_file
+        print_tcs_diff(diff_tcs_configs(
+            parse_dpll_tcs_config_file(args.config_file),
+            parse_dpll_tcs_config_file(args.target_config_file)))
+    elif args.command == "program_delta":
+        # boards are assumed to be running config_file already
+        top=MiniPTM()
+        plan=load_delta_write_plan(args.config_file, args.target_config_file)
+        print(f"Delta {args.config_file} -> {args.target_config_file}: {plan.num_bytes()} bytes")
+        if args.board_id is not None:
+            top.program_one_board_plan(top.get_board(args.board_id), plan)
+        else:
+            for board in top.boards:
+                top.program_one_board_plan(board, plan)
+    elif args.command == "capture_defaults":
+        # run right after a reset, before the board is programmed
+        top=MiniPTM()
+        board_id=args.board_id if args.board_id is not None else 0
+        defaults_file=args.defaults_file or "8A34002_reset_defaults.bin"
+        defaults=capture_reset_defaults(top.get_board(board_id).i2c)
+        defaults.save(defaults_file)
+        print(f"Board {board_id} reset defaults saved to {defaults_file}")
     elif args.command == "blinktest":
         top=MiniPTM()
         top.board_led_blink_test()
@@ -2739,14 +2881,21 @@ if __name__ == "__main__":
         top=MiniPTM()
         if args.board_id is not None:
             top.flash_eeprom_one_board(
-                top.boards[args.board_id], args.eeprom_file)
+                top.get_board(args.board_id), args.eeprom_file, args.incremental)
         else:
-            top.flash_all_boards_eeprom(args.eeprom_file)
+            top.flash_all_boards_eeprom(args.eeprom_file, args.incremental)
+    elif args.command == "dump_eeprom":
+        top=MiniPTM()
+        top.dump_all_boards_eeprom(args.dump_prefix)
+    elif args.command == "verify_eeprom":
+        top=MiniPTM()
+        if not top.verify_all_boards_eeprom(args.eeprom_file):
+            sys.exit(1)
     elif args.command == "read":
         top=MiniPTM()
         print(f"Starting read register")
         if args.board_id is not None:
-            val=top.boards[args.board_id].i2c.read_dpll_reg_direct(
+            val=top.get_board(args.board_id).i2c.read_dpll_reg_direct(
                 int(args.reg_addr, 16))
             print(
                 f"Board {args.board_id} Read Register {args.reg_addr} = 0x{val:02x}")
@@ -2758,7 +2907,7 @@ if __name__ == "__main__":
     elif args.command == "write":
         top=MiniPTM()
         if args.board_id is not None:
-            top.boards[args.board_id].i2c.write_dpll_reg_direct(
+            top.get_board(args.board_id).i2c.write_dpll_reg_direct(
                 int(args.reg_addr, 16), int(args.reg_val, 16))
             print(
                 f"Board {args.board_id} Write Register {args.reg_addr} = {args.reg_val}")
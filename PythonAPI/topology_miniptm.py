@@ -0,0 +1,192 @@
+
+import json
+import os
+import re
+
+from pcie_miniptm import (SYSFS_ROOT, get_miniptm_devices, get_bar_address_and_size,
+                          get_mac_address, MINIPTM_MAC_ADDRESS)
+from i2c_miniptm import find_i2c_buses
+
+#########
+# Сопоставление плат MiniPTM: PCI устройство I225 <-> I2C адаптер
+# Драйвер регистрирует I2C адаптер дочерним устройством PCI функции,
+# поэтому родитель находится по иерархии /sys/devices.
+# Таблица плат кэшируется в файле, номера плат не меняются между
+# перезагрузками, пока плата стоит в том же слоте.
+
+MINIPTM_ADAPTER_NAME = "MiniPTM I2C Adapter"
+BOARD_TABLE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 ".config_cache", "board_table.json")
+
+PCI_BDF_PATTERN = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$")
+
+
+class BoardInfo:
+    """
+    Одна плата MiniPTM
+    board_id - постоянный номер платы
+    pci_address - адрес PCI функции I225 (0000:01:00.0)
+    i2c_bus - номер I2C шины адаптера платы
+    bar, bar_size - адрес BAR0 (hex строка) и размер в байтах (строка)
+    in_order - адаптер без PCI родителя, пара найдена по порядку
+    """
+
+    def __init__(self, board_id, pci_address, i2c_bus, bar, bar_size, in_order=False):
+        self.board_id = board_id
+        self.pci_address = pci_address
+        self.i2c_bus = i2c_bus
+        self.bar = bar
+        self.bar_size = bar_size
+        self.in_order = in_order
+
+    def devinfo(self):
+        """ Формат get_miniptm_devices: [pci адрес, BAR, размер BAR] """
+        return [self.pci_address, self.bar, self.bar_size]
+
+    def to_dict(self):
+        return {"board_id": self.board_id, "pci_address": self.pci_address,
+                "i2c_bus": self.i2c_bus, "bar": self.bar, "bar_size": self.bar_size,
+                "in_order": self.in_order}
+
+    def __repr__(self):
+        return (f"Board {self.board_id}: PCI {self.pci_address} i2c-{self.i2c_bus} "
+                f"BAR 0x{self.bar} size {self.bar_size}")
+
+
+def get_i2c_adapter_pci_parent(bus_num, sysfs_root=SYSFS_ROOT):
+    """
+    PCI адрес ближайшего PCI предка I2C адаптера
+    bus_num - номер I2C шины
+    Возвращает строку вида 0000:01:00.0 или None
+    """
+    adapter_path = os.path.realpath(
+        os.path.join(sysfs_root, "class", "i2c-adapter", f"i2c-{bus_num}"))
+    path = os.path.dirname(adapter_path)
+    while len(path) > 1:
+        if PCI_BDF_PATTERN.match(os.path.basename(path)):
+            return os.path.basename(path)
+        path = os.path.dirname(path)
+    return None
+
+
+def resolve_board_topology(sysfs_root=SYSFS_ROOT, adapter_name=MINIPTM_ADAPTER_NAME,
+                           previous=None):
+    """
+    Построение таблицы плат по иерархии sysfs
+    previous - предыдущая таблица, номера известных PCI адресов сохраняются
+    Возвращает список BoardInfo, отсортированный по board_id
+    """
+    devices = {dev[0]: dev for dev in get_miniptm_devices(sysfs_root)}
+    buses = sorted(find_i2c_buses(adapter_name, sysfs_root))
+
+    pairs = {}
+    in_order = False
+    for bus_num in buses:
+        parent = get_i2c_adapter_pci_parent(bus_num, sysfs_root)
+        if parent in devices:
+            pairs[parent] = bus_num
+
+    if len(pairs) != len(buses) or len(pairs) != len(devices):
+        # старый драйвер без родителя у адаптера, как раньше - по порядку
+        print("Could not map every MiniPTM i2c adapter to its PCI device, pairing in order")
+        if len(buses) != len(devices):
+            print("Mismatch between number of pcie devices and i2c busses!")
+            return []
+        pairs = dict(zip(sorted(devices), buses))
+        in_order = True
+
+    known_ids = {}
+    if previous:
+        known_ids = {board.pci_address: board.board_id for board in previous}
+
+    boards = []
+    used_ids = set()
+    for pci_address in sorted(pairs):
+        board_id = known_ids.get(pci_address)
+        if board_id is not None and board_id not in used_ids:
+            used_ids.add(board_id)
+            boards.append(BoardInfo(board_id, pci_address, pairs[pci_address],
+                                    devices[pci_address][1], devices[pci_address][2],
+                                    in_order))
+    for pci_address in sorted(pairs):
+        if pci_address in [board.pci_address for board in boards]:
+            continue
+        board_id = 0
+        while board_id in used_ids:
+            board_id += 1
+        used_ids.add(board_id)
+        boards.append(BoardInfo(board_id, pci_address, pairs[pci_address],
+                                devices[pci_address][1], devices[pci_address][2],
+                                in_order))
+
+    return sorted(boards, key=lambda board: board.board_id)
+
+
+def load_board_table(cache_path=BOARD_TABLE_CACHE):
+    """ Чтение таблицы плат из файла, None если файла нет или он испорчен """
+    try:
+        with open(cache_path, 'r') as f:
+            boards = [BoardInfo(**entry) for entry in json.load(f)]
+    except (OSError, ValueError, TypeError):
+        return None
+    return sorted(boards, key=lambda board: board.board_id)
+
+
+def save_board_table(boards, cache_path=BOARD_TABLE_CACHE):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump([board.to_dict() for board in boards], f, indent=1)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not save board table {cache_path}: {e}")
+
+
+def validate_board_table(boards, sysfs_root=SYSFS_ROOT, adapter_name=MINIPTM_ADAPTER_NAME):
+    """
+    Быстрая проверка кэшированной таблицы: набор адаптеров тот же, каждый
+    адаптер под своим PCI устройством, BAR и MAC не изменились
+    Для пар, найденных по порядку (старый драйвер), адаптер по-прежнему
+    не должен находиться под PCI устройством платы, иначе таблица строится
+    заново уже по иерархии sysfs
+    """
+    if not boards:
+        return False
+    if sorted(find_i2c_buses(adapter_name, sysfs_root)) != sorted(
+            board.i2c_bus for board in boards):
+        return False
+    pci_addresses = {board.pci_address for board in boards}
+    for board in boards:
+        parent = get_i2c_adapter_pci_parent(board.i2c_bus, sysfs_root)
+        if board.in_order:
+            if parent in pci_addresses:
+                return False
+        elif parent != board.pci_address:
+            return False
+        if get_mac_address(board.pci_address, sysfs_root) != MINIPTM_MAC_ADDRESS:
+            return False
+        bar_info = get_bar_address_and_size(board.pci_address, sysfs_root)
+        if not bar_info or list(bar_info[0]) != [board.bar, board.bar_size]:
+            return False
+    return True
+
+
+def get_board_table(cache_path=BOARD_TABLE_CACHE, sysfs_root=SYSFS_ROOT,
+                    adapter_name=MINIPTM_ADAPTER_NAME):
+    """
+    Таблица плат: из кэша, если он прошёл проверку, иначе заново из sysfs
+    """
+    cached = load_board_table(cache_path)
+    if cached is not None and validate_board_table(cached, sysfs_root, adapter_name):
+        return cached
+
+    boards = resolve_board_topology(sysfs_root, adapter_name, cached)
+    if boards:
+        save_board_table(boards, cache_path)
+    return boards
+
+
+if __name__ == "__main__":
+    for board in get_board_table():
+        print(board)